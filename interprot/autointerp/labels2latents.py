@@ -1,6 +1,6 @@
 import csv
 import math
-from typing import Callable, TextIO
+from typing import Iterable, TextIO
 
 import click
 import numpy as np
@@ -9,18 +9,17 @@ from tqdm import tqdm
 from transformers import AutoTokenizer, EsmModel
 
 from interprot.sae_model import SparseAutoencoder
-from interprot.utils import get_layer_activations
+from interprot.utils import iter_layer_activations, optimize_plm_for_cpu
 
 
 def compute_scores_matrix(
     sequence_target: list[tuple[str, np.ndarray]],
-    sequence2latents: Callable[[str], torch.Tensor],
+    sequence_latents: Iterable[torch.Tensor],
     sae_dim: int,
 ) -> np.ndarray:
     """
-    Given a list of tuples like [(MVLSEGEWQL, 0001111110), ...] and a function
-    that can convert a protein sequence to SAE latents, returns a matrix of
-    scores like this:
+    Given a list of tuples like [(MVLSEGEWQL, 0001111110), ...] and the SAE latents
+    of each of those sequences, in the same order, returns a matrix of scores like this:
 
     +----------------+----------------+----------------+----------------+
     | Sequence       | SAE Dim 1      | SAE Dim 2      | ...            |
@@ -50,12 +49,11 @@ def compute_scores_matrix(
     """
     scores = np.zeros((len(sequence_target), sae_dim))
 
-    for seq_idx, (sequence, target) in tqdm(
-        enumerate(sequence_target),
+    for seq_idx, ((sequence, target), sae_acts) in tqdm(
+        enumerate(zip(sequence_target, sequence_latents)),
         total=len(sequence_target),
         desc="Processing sequences",
     ):
-        sae_acts = sequence2latents(sequence)
         for dim_idx in range(sae_dim):
             hidden_dim_acts = sae_acts[:, dim_idx]
 
@@ -91,15 +89,19 @@ def compute_scores_matrix(
     "--sae-checkpoint",
     type=click.Path(exists=True),
     required=True,
-    help="Path to the SAE checkpoint file",
+    help="Path to the SAE checkpoint file, in any format SparseAutoencoder.from_checkpoint reads",
+)
+@click.option(
+    "--sae-dim",
+    type=int,
+    default=None,
+    help="Dimension of the sparse autoencoder. Defaults to the checkpoint's",
 )
-@click.option("--plm-dim", type=int, required=True, help="Dimension of the protein language model")
-@click.option("--sae-dim", type=int, required=True, help="Dimension of the sparse autoencoder")
 @click.option(
     "--plm-layer",
     type=int,
-    required=True,
-    help="Layer of the protein language model to use",
+    default=None,
+    help="Layer of the protein language model to use. Defaults to the checkpoint's",
 )
 @click.option(
     "--out-path",
@@ -108,14 +110,28 @@ def compute_scores_matrix(
     help="Path to save the output CSV file",
 )
 @click.option("--max-seqs", type=int, default=100, help="Maximum number of sequences to process")
+@click.option(
+    "--sae-thresholds",
+    type=click.Path(exists=True),
+    default=None,
+    help="Path to calibrated SAE thresholds. If given, use them instead of top-k",
+)
+@click.option(
+    "--cpu-profile",
+    is_flag=True,
+    help="Run on CPU with the pLM quantized to int8, see utils.optimize_plm_for_cpu",
+)
+@click.option("--num-threads", type=int, default=None, help="Number of CPU threads to use")
 def labels2latents(
     labels_csv: TextIO,
     sae_checkpoint: str,
-    plm_dim: int,
     plm_layer: int,
     sae_dim: int,
     out_path: str,
     max_seqs: int,
+    sae_thresholds: str,
+    cpu_profile: bool,
+    num_threads: int,
 ):
     """
     Takes in a labels CSV file like this
@@ -129,7 +145,7 @@ def labels2latents(
     find SAE latents that tend to activate at positions with the 1 label.
     """
     click.echo(f"Processing {labels_csv.name}...")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda" if torch.cuda.is_available() and not cpu_profile else "cpu")
     click.echo(f"Using device: {device}")
 
     sequence_target = []
@@ -141,29 +157,43 @@ def labels2latents(
         target = np.array([int(x) for x in row["target"]])
         sequence_target.append((sequence, target))
 
-    sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
-    sae_model.load_state_dict(torch.load(sae_checkpoint, map_location=device))
+    sae_model = SparseAutoencoder.from_checkpoint(sae_checkpoint, map_location=device)
+    if sae_thresholds:
+        sae_model.load_thresholds(sae_thresholds)
     sae_model.eval()
+    if sae_dim is not None and sae_dim != sae_model.d_hidden_full:
+        raise click.BadParameter(
+            f"the checkpoint has {sae_model.d_hidden_full} hidden dims, not {sae_dim}",
+            param_hint="--sae-dim",
+        )
+    sae_dim = sae_model.d_hidden_full
+    plm_layer = plm_layer if plm_layer is not None else sae_model.layer
+    if plm_layer is None:
+        raise ValueError("The checkpoint does not record its pLM layer, pass --plm-layer")
 
     tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
     plm = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device)
+    if cpu_profile:
+        plm = optimize_plm_for_cpu(plm, num_threads=num_threads)
 
-    def sequence2latents(sequence: str) -> torch.Tensor:
+    def iter_latents(sequences: list[str]) -> Iterable[torch.Tensor]:
         """
-        Get the SAE latents for a given sequence.
+        Get the SAE latents of each sequence, running the pLM on batches of sequences.
         """
-        esm_acts = get_layer_activations(
+        for esm_acts in iter_layer_activations(
             tokenizer=tokenizer,
             plm=plm,
-            seqs=[sequence],
+            seqs=sequences,
             layer=plm_layer,
             device=device,
-        )[0]
-        sae_acts = sae_model.get_acts(esm_acts)
-        sae_acts = sae_acts[1:-1]  # Trim BoS & EoS tokens
-        return sae_acts
-
-    scores = compute_scores_matrix(sequence_target, sequence2latents, sae_dim)
+        ):
+            sae_acts = sae_model.get_acts(esm_acts)
+            sae_acts = sae_acts[1:-1]  # Trim BoS & EoS tokens
+            yield sae_acts
+
+    scores = compute_scores_matrix(
+        sequence_target, iter_latents([sequence for sequence, _ in sequence_target]), sae_dim
+    )
 
     # Get the mean score for each SAE dimension, sort in descending order.
     mean_scores = scores.mean(axis=0)
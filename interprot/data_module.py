@@ -1,54 +1,473 @@
+import json
 import multiprocessing
+import os
+import tempfile
 
+import numpy as np
 import polars as pr
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import Dataset
-from utils import train_val_test_split
+from torch.utils.data import Dataset, DistributedSampler, IterableDataset, Sampler
+from utils import bucket_by_length, train_val_test_split
 
 
 class PolarsDataset(Dataset):
+    """
+    The sequences and ids of a DataFrame with sequence and id columns.
+
+    The columns are written once to an uncompressed Arrow IPC file in a temporary
+    directory, and read back memory-mapped. DataLoader workers map the file again instead
+    of getting a pickled copy of the DataFrame, and share its pages with the main process.
+    The file is deleted with the dataset.
+    """
+
+    COLUMNS = {"Sequence": "sequence", "Entry": "id"}
+
     def __init__(self, df):
-        self.df = df
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp_dir.name, "data.arrow")
+        # One record batch, so reading it back needs no rechunking copy
+        df.select(list(self.COLUMNS.values())).rechunk().write_ipc(
+            self.path, compression="uncompressed"
+        )
+        self._open()
+
+    def _open(self):
+        self.df = pr.read_ipc(self.path, memory_map=True, rechunk=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Only the main process owns, and deletes, the file
+        state["_tmp_dir"] = None
+        state["df"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
 
     def __len__(self):
         return len(self.df)
 
     def __getitem__(self, idx):
-        row = self.df.row(idx, named=True)
-        return {"Sequence": row["sequence"], "Entry": row["id"]}
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        # Called by the DataLoader with the indices of a whole batch, which are gathered
+        # from the memory-mapped columns at once
+        batch = self.df[indices]
+        columns = [batch[column].to_list() for column in self.COLUMNS.values()]
+        return [dict(zip(self.COLUMNS, row)) for row in zip(*columns)]
+
+
+class StreamingParquetDataset(IterableDataset):
+    """
+    Stream the sequences of one split of a parquet file (or glob of files) without
+    loading it into memory. The rows are read in slices of slice_rows rows with
+    polars.scan_parquet, which only reads the row groups overlapping each slice.
+
+    The split is decided per row from the seed, the slice and the row's position in it,
+    in the same proportions as utils.train_val_test_split, so it is the same in every
+    process and epoch. Each epoch, the slices are shuffled, as are the rows of each
+    slice, and the resulting sequence of rows is cut into equal contiguous ranges, one
+    per DataLoader worker of each DDP rank. Every worker yields the same number of rows,
+    so that all ranks run the same number of steps, and only the fewer than
+    num_replicas * num_workers rows left over are skipped for the epoch. A slice may be
+    shared by several workers, each reading it and taking its part.
+    """
+
+    SPLITS = ("train", "val", "test")
+
+    def __init__(
+        self,
+        data_path,
+        split,
+        slice_rows=65536,
+        shuffle=True,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+        train_frac=0.9,
+    ):
+        if split not in self.SPLITS:
+            raise ValueError(f"Unknown split {split}, expected one of {self.SPLITS}")
+        self.data_path = data_path
+        self.split = split
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.train_frac = train_frac
+        self.epoch = 0
+
+        num_rows = pr.scan_parquet(data_path).select(pr.len()).collect().item()
+        self.slices = [
+            (start, min(slice_rows, num_rows - start)) for start in range(0, num_rows, slice_rows)
+        ]
+        self.split_counts = [
+            self._split_mask(i, length).sum().item() for i, (_, length) in enumerate(self.slices)
+        ]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _split_mask(self, slice_idx, num_rows):
+        u = np.random.default_rng([self.seed, slice_idx]).random(num_rows)
+        # As in train_val_test_split, 10% of the non-training rows are for validation
+        val_end = self.train_frac + (1 - self.train_frac) * 0.1
+        if self.split == "train":
+            return u < self.train_frac
+        if self.split == "val":
+            return (u >= self.train_frac) & (u < val_end)
+        return u >= val_end
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info else 1
+        worker_id = worker_info.id if worker_info else 0
+        num_shards = self.num_replicas * num_workers
+        shard = self.rank * num_workers + worker_id
+
+        order = np.arange(len(self.slices))
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(order)
+        counts = np.array(self.split_counts, dtype=np.int64)[order]
+        slice_ends = np.cumsum(counts)
+        quota = int(counts.sum()) // num_shards
+        shard_start, shard_end = shard * quota, (shard + 1) * quota
+
+        slices = zip(order.tolist(), counts.tolist(), slice_ends.tolist())
+        for slice_idx, count, slice_end in slices:
+            slice_start = slice_end - count
+            if slice_end <= shard_start or count == 0:
+                continue
+            if slice_start >= shard_end:
+                return
+            start, length = self.slices[slice_idx]
+            rows = np.flatnonzero(self._split_mask(slice_idx, length))
+            if self.shuffle:
+                rows = np.random.default_rng([self.seed, self.epoch, slice_idx]).permutation(rows)
+            rows = rows[max(shard_start - slice_start, 0) : shard_end - slice_start]
+            df = (
+                pr.scan_parquet(self.data_path)
+                .slice(start, length)
+                .select(["sequence", "id"])
+                .collect()[rows.tolist()]
+            )
+            for seq, seq_id in zip(df["sequence"].to_list(), df["id"].to_list()):
+                yield {"Sequence": seq, "Entry": seq_id}
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sequences of similar length together, with each batch's padded size capped at
+    max_tokens, see utils.bucket_by_length. Sequences of equal length are shuffled between
+    batches, and the batch order is shuffled, differently each epoch.
+
+    For distributed training, every rank builds the same batches from the seed and epoch
+    and takes every num_replicas-th of them. Batches are repeated so that all ranks get
+    the same number of batches.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # Ties don't change the number of batches, so it is the same every epoch
+        self.num_batches = len(bucket_by_length(lengths, max_tokens))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-self.num_batches // self.num_replicas)
+
+    def __iter__(self):
+        if not self.shuffle:
+            batches = bucket_by_length(self.lengths, self.max_tokens)
+        else:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            # bucket_by_length sorts stably, so permuting its input shuffles the ties
+            order = rng.permutation(len(self.lengths))
+            batches = [
+                [order[i].item() for i in batch]
+                for batch in bucket_by_length([self.lengths[i] for i in order], self.max_tokens)
+            ]
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        num_padding = len(self) * self.num_replicas - len(batches)
+        batches += [batches[i % len(batches)] for i in range(num_padding)]
+        return iter(batches[self.rank :: self.num_replicas])
+
+
+class TokenShuffleBuffer:
+    """
+    Shuffle pLM activations at the token level, so that training batches mix tokens of
+    many proteins and all have the same number of tokens.
+
+    Tokens are added to a reservoir of `capacity` tokens. Once it is full, batches of
+    `batch_size` tokens are drawn uniformly at random from it, and the incoming tokens
+    take the place of the drawn ones. Batches are only drawn on request, so that DDP ranks
+    can agree on how many to draw: every rank draws as many as the rank with the most
+    num_ready, as long as each has num_available. A rank asked for fewer batches than it
+    has ready, because another rank is short of tokens, evicts tokens at random down to
+    `capacity` on its next add, so the buffer holds at most `capacity` plus one add.
+    """
+
+    def __init__(self, capacity, batch_size):
+        if capacity < batch_size:
+            raise ValueError(f"capacity ({capacity}) must be at least batch_size ({batch_size})")
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.storage = None
+        self.size = 0
+
+    def add(self, acts):
+        """
+        Add (num_tokens, d_model) activations to the buffer.
+        """
+        if self.size > self.capacity:
+            self._remove(
+                torch.randperm(self.size, device=self.storage.device)[: self.size - self.capacity]
+            )
+        if self.storage is None:
+            self.storage = acts.new_empty(max(self.capacity, len(acts)), acts.shape[-1])
+        elif self.size + len(acts) > len(self.storage):
+            # Only grows when the buffer reaches a new maximum size
+            storage = self.storage.new_empty(self.size + len(acts), self.storage.shape[-1])
+            storage[: self.size] = self.storage[: self.size]
+            self.storage = storage
+        self.storage[self.size : self.size + len(acts)] = acts
+        self.size += len(acts)
+
+    def num_ready(self):
+        """
+        The number of batches that can be drawn before the buffer drops below capacity.
+        """
+        return max(0, (self.size - self.capacity) // self.batch_size + 1)
+
+    def num_available(self):
+        """
+        The number of batches that can be drawn before the buffer runs out of tokens.
+        """
+        return self.size // self.batch_size
+
+    def pop(self):
+        """
+        Draw a (batch_size, d_model) batch uniformly at random from the buffer.
+        """
+        idx = torch.randperm(self.size, device=self.storage.device)[: self.batch_size]
+        batch = self.storage[idx].clone()
+        self._remove(idx)
+        return batch
+
+    def _remove(self, idx):
+        # Move the tokens at the end of the buffer into the slots that were removed
+        new_size = self.size - len(idx)
+        removed = torch.zeros(self.size, dtype=torch.bool, device=self.storage.device)
+        removed[idx] = True
+        holes = idx[idx < new_size]
+        tail = torch.arange(new_size, self.size, device=self.storage.device)[~removed[new_size:]]
+        self.storage[holes] = self.storage[tail]
+        self.size = new_size
+
+
+class ActivationStoreDataset(Dataset):
+    """
+    Batches of pLM activations from an activation store written by
+    scripts/dump_activations.py. Each item is a (batch_tokens, d_model) tensor of
+    consecutive tokens of a shard, which the dump writes in random order, and the last
+    batch of a shard may be smaller.
+
+    The shards are memory-mapped the first time an item is read in each process, so
+    DataLoader workers don't copy them.
+    """
+
+    def __init__(self, store_dir, batch_tokens):
+        with open(os.path.join(store_dir, "index.json")) as f:
+            self.index = json.load(f)
+        self.paths = [os.path.join(store_dir, shard["path"]) for shard in self.index["shards"]]
+        self.batches = [
+            (shard_idx, start)
+            for shard_idx, shard in enumerate(self.index["shards"])
+            for start in range(0, shard["num_tokens"], batch_tokens)
+        ]
+        self.batch_tokens = batch_tokens
+        self._shards = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, idx):
+        if self._shards is None:
+            self._shards = [np.load(path, mmap_mode="r") for path in self.paths]
+        shard_idx, start = self.batches[idx]
+        acts = torch.from_numpy(
+            np.ascontiguousarray(self._shards[shard_idx][start : start + self.batch_tokens])
+        )
+        if self.index["dtype"] == "bfloat16":
+            # numpy has no bfloat16, so it is stored as int16 bit patterns
+            acts = acts.view(torch.bfloat16)
+        return acts
 
 
 # Data Module
 class SequenceDataModule(pl.LightningDataModule):
-    def __init__(self, data_path, batch_size, num_workers=None):
+    def __init__(
+        self,
+        data_path,
+        batch_size,
+        num_workers=None,
+        max_tokens=None,
+        seed=0,
+        streaming=False,
+        slice_rows=65536,
+    ):
+        """
+        If max_tokens is given, training batches are built by LengthBucketBatchSampler
+        instead of being batch_size random sequences. The Trainer must then be created
+        with use_distributed_sampler=False, since the sampler shards itself across ranks,
+        and the validation and test sets are sharded with a DistributedSampler here.
+
+        If streaming is True, the parquet file is read in slices of slice_rows rows by
+        StreamingParquetDataset instead of being loaded into memory.
+        """
         super().__init__()
+        if streaming and max_tokens is not None:
+            raise ValueError("max_tokens is not supported with streaming")
         self.data_path = data_path
         self.batch_size = batch_size
-        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count() - 1
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.streaming = streaming
+        self.slice_rows = slice_rows
+        self.num_workers = (
+            num_workers if num_workers is not None else multiprocessing.cpu_count() - 1
+        )
 
     def setup(self, stage=None):
+        # Lightning calls setup again for testing, so only build the datasets once
+        if getattr(self, "train_data", None) is not None:
+            return
+        if self.streaming:
+            self.train_data, self.val_data, self.test_data = [
+                StreamingParquetDataset(
+                    self.data_path,
+                    split,
+                    slice_rows=self.slice_rows,
+                    shuffle=split == "train",
+                    seed=self.seed,
+                    num_replicas=self.trainer.world_size if self.trainer else 1,
+                    rank=self.trainer.global_rank if self.trainer else 0,
+                )
+                for split in ["train", "val", "test"]
+            ]
+            return
         df = pr.read_parquet(self.data_path)
-        self.train_data, self.val_data, self.test_data = train_val_test_split(df)
+        self.train_data, self.val_data, self.test_data = [
+            PolarsDataset(data) for data in train_val_test_split(df)
+        ]
 
     def train_dataloader(self):
+        if self.max_tokens is not None:
+            lengths = (self.train_data.df["sequence"].str.len_chars() + 2).to_list()
+            batch_sampler = LengthBucketBatchSampler(
+                lengths,
+                self.max_tokens,
+                seed=self.seed,
+                num_replicas=self.trainer.world_size if self.trainer else 1,
+                rank=self.trainer.global_rank if self.trainer else 0,
+            )
+            return torch.utils.data.DataLoader(
+                self.train_data, batch_sampler=batch_sampler, num_workers=self.num_workers
+            )
         return torch.utils.data.DataLoader(
-            PolarsDataset(self.train_data),
+            self.train_data,
             batch_size=self.batch_size,
+            # A StreamingParquetDataset shuffles itself
+            shuffle=not self.streaming,
+            num_workers=self.num_workers,
+        )
+
+    def _eval_dataloader(self, dataset):
+        sampler = None
+        if self.max_tokens is not None and self.trainer and self.trainer.world_size > 1:
+            # The Trainer doesn't add a distributed sampler with max_tokens, so shard here
+            sampler = DistributedSampler(
+                dataset,
+                num_replicas=self.trainer.world_size,
+                rank=self.trainer.global_rank,
+                shuffle=False,
+            )
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=self.batch_size, sampler=sampler, num_workers=self.num_workers
+        )
+
+    def val_dataloader(self):
+        return self._eval_dataloader(self.val_data)
+
+    def test_dataloader(self):
+        return self._eval_dataloader(self.test_data)
+
+
+class ActivationStoreDataModule(pl.LightningDataModule):
+    """
+    Train on the activations of an activation store instead of running ESM on every
+    batch. Validation and testing still run ESM, on the sequences the store held out.
+    """
+
+    def __init__(
+        self, store_dir, batch_tokens, batch_size, num_workers=None, layer=None, d_model=None
+    ):
+        super().__init__()
+        self.store_dir = store_dir
+        self.batch_tokens = batch_tokens
+        self.batch_size = batch_size
+        self.num_workers = (
+            num_workers if num_workers is not None else multiprocessing.cpu_count() - 1
+        )
+
+        with open(os.path.join(store_dir, "index.json")) as f:
+            index = json.load(f)
+        if layer is not None and index["layer"] != layer:
+            raise ValueError(f"The activation store is of layer {index['layer']}, not {layer}")
+        if d_model is not None and index["d_model"] != d_model:
+            raise ValueError(f"The activation store has d_model {index['d_model']}, not {d_model}")
+
+    def setup(self, stage=None):
+        # Lightning calls setup again for testing, so only build the datasets once
+        if getattr(self, "train_data", None) is not None:
+            return
+        self.train_data = ActivationStoreDataset(self.store_dir, self.batch_tokens)
+        self.val_data, self.test_data = [
+            PolarsDataset(pr.read_parquet(os.path.join(self.store_dir, f"{split}.parquet")))
+            for split in ["val", "test"]
+        ]
+
+    def train_dataloader(self):
+        return torch.utils.data.DataLoader(
+            self.train_data,
+            batch_size=None,
             shuffle=True,
-            num_workers=self.num_workers
+            num_workers=self.num_workers,
+            pin_memory=True,
         )
 
     def val_dataloader(self):
         return torch.utils.data.DataLoader(
-            PolarsDataset(self.val_data),
-            batch_size=self.batch_size,
-            num_workers=self.num_workers
+            self.val_data, batch_size=self.batch_size, num_workers=self.num_workers
         )
 
     def test_dataloader(self):
         return torch.utils.data.DataLoader(
-            PolarsDataset(self.test_data),
-            batch_size=self.batch_size,
-            num_workers=self.num_workers
+            self.test_data, batch_size=self.batch_size, num_workers=self.num_workers
         )
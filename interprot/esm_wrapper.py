@@ -1,11 +1,131 @@
+from dataclasses import dataclass
+from typing import Optional
+
 import pytorch_lightning as pl
 import torch
 import torch.nn as nn
-from esm.modules import ESM1bLayerNorm, RobertaLMHead, TransformerLayer
+import torch.nn.functional as F
+from esm.modules import ESM1bLayerNorm, RobertaLMHead, TransformerLayer, gelu
+
+
+class SDPATransformerLayer(TransformerLayer):
+    """
+    ESM TransformerLayer that computes attention with F.scaled_dot_product_attention,
+    which doesn't materialize the (heads, L, L) attention scores when a fused kernel is
+    available. It has the same parameters as TransformerLayer, so ESM weights load into it
+    unchanged. Falls back to TransformerLayer when attention weights or an attention
+    mask are requested.
+    """
+
+    def forward(self, x, self_attn_mask=None, self_attn_padding_mask=None, need_head_weights=False):
+        if need_head_weights or self_attn_mask is not None:
+            return super().forward(
+                x,
+                self_attn_mask=self_attn_mask,
+                self_attn_padding_mask=self_attn_padding_mask,
+                need_head_weights=need_head_weights,
+            )
+
+        residual = x
+        x = self.self_attn_layer_norm(x)
+        x = self._attention(x, self_attn_padding_mask)
+        x = residual + x
+
+        residual = x
+        x = self.final_layer_norm(x)
+        x = gelu(self.fc1(x))
+        x = self.fc2(x)
+        x = residual + x
+        return x, None
+
+    def _attention(self, x, padding_mask):
+        attn = self.self_attn
+        tgt_len, bsz, embed_dim = x.shape
+
+        def to_heads(t):
+            # (T, B, E) => (B * H, T, D), the layout the rotary embeddings expect
+            return t.reshape(tgt_len, bsz * attn.num_heads, attn.head_dim).transpose(0, 1)
+
+        q = to_heads(attn.q_proj(x))
+        k = to_heads(attn.k_proj(x))
+        v = to_heads(attn.v_proj(x))
+        if attn.rot_emb is not None:
+            q, k = attn.rot_emb(q, k)
+        q, k, v = (t.reshape(bsz, attn.num_heads, tgt_len, attn.head_dim) for t in (q, k, v))
+
+        mask = None
+        if padding_mask is not None:
+            # True where attention is allowed, broadcast over heads and queries
+            mask = ~padding_mask[:, None, None, :]
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        out = out.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)  # => (T, B, E)
+        return attn.out_proj(out)
+
+
+@dataclass
+class PrefixCache:
+    """
+    The layer layer_idx activations of a sequence, from ESM2Model.get_prefix_cache, so the
+    layers after it can be rerun on modified activations without recomputing the ones
+    before it. If an SAE was given, also holds what is needed to decode modified latents
+    back into activations.
+    """
+
+    tokens: torch.Tensor  # (1, T)
+    layer_idx: int
+    acts: torch.Tensor  # (1, T, E)
+    latents: Optional[torch.Tensor] = None  # (1, T, D_HIDDEN), the SAE's pre-activations
+    mu: Optional[torch.Tensor] = None  # (1, T, 1)
+    std: Optional[torch.Tensor] = None  # (1, T, 1)
+    error: Optional[torch.Tensor] = None  # (1, T, E), acts minus the SAE reconstruction
+
+    def decode(self, sae_model, latents, add_error=True):
+        """
+        Decode a batch of modified SAE latents, e.g. self.latents with some dims steered,
+        into activations, with the normalization of the original activations.
+
+        Args:
+            sae_model: The SAE the cache was made with.
+            latents: (N, T, D_HIDDEN) pre-activation latents, as in self.latents.
+            add_error: Whether to add the SAE's reconstruction error back, so that
+                unmodified latents give back exactly the original activations.
+
+        Returns:
+            (N, T, E) activations, to pass to ESM2Model.run_suffix.
+        """
+        if self.latents is None:
+            raise ValueError("The cache was made without an SAE")
+        acts = sae_model.decode(latents, self.mu, self.std)
+        if add_error:
+            acts = acts + self.error
+        return acts
 
 
 class ESM2Model(pl.LightningModule):
-    def __init__(self, num_layers, embed_dim, attention_heads, alphabet, token_dropout):
+    def __init__(
+        self,
+        num_layers,
+        embed_dim,
+        attention_heads,
+        alphabet,
+        token_dropout,
+        prefix_layers=None,
+        attn_implementation="esm",
+    ):
+        """
+        If prefix_layers is given, only the embeddings and the first prefix_layers layers
+        are built and loaded, which is all get_layer_activations needs up to that layer.
+        The remaining layers and the LM head are loaded the first time get_sequence is
+        called.
+
+        attn_implementation is "esm" for the esm package's attention, or "sdpa" for
+        SDPATransformerLayer, which uses much less memory on long sequences.
+
+        If token_dropout is True, the embeddings are rescaled for the fraction of masked
+        tokens as in ESM-2 pretraining. This is what esm.pretrained models and HuggingFace's
+        EsmModel do, and it scales every embedding by 0.88 when no tokens are masked. The
+        SAEs are trained with token_dropout=False.
+        """
         super().__init__()
         self.num_layers = num_layers
         self.embed_dim = embed_dim
@@ -20,6 +140,11 @@ class ESM2Model(pl.LightningModule):
         self.prepend_bos = alphabet.prepend_bos
         self.append_eos = alphabet.append_eos
         self.token_dropout = token_dropout
+        self.prefix_layers = prefix_layers
+        if attn_implementation not in ("esm", "sdpa"):
+            raise ValueError(f"Unknown attn_implementation {attn_implementation}")
+        self.attn_implementation = attn_implementation
+        self.esm_pretrained = None
         self._init_submodules()
 
     def _init_submodules(self):
@@ -30,20 +155,23 @@ class ESM2Model(pl.LightningModule):
             padding_idx=self.padding_idx,
         )
 
-        self.layers = nn.ModuleList(
-            [
-                TransformerLayer(
-                    self.embed_dim,
-                    4 * self.embed_dim,
-                    self.attention_heads,
-                    add_bias_kv=False,
-                    use_esm1b_layer_norm=True,
-                    use_rotary_embeddings=True,
-                )
-                for _ in range(self.num_layers)
-            ]
+        num_layers = self.num_layers if self.prefix_layers is None else self.prefix_layers
+        self.layers = nn.ModuleList([self._make_layer() for _ in range(num_layers)])
+        if self.prefix_layers is None:
+            self._init_head()
+
+    def _make_layer(self):
+        layer_cls = SDPATransformerLayer if self.attn_implementation == "sdpa" else TransformerLayer
+        return layer_cls(
+            self.embed_dim,
+            4 * self.embed_dim,
+            self.attention_heads,
+            add_bias_kv=False,
+            use_esm1b_layer_norm=True,
+            use_rotary_embeddings=True,
         )
 
+    def _init_head(self):
         self.emb_layer_norm_after = ESM1bLayerNorm(self.embed_dim)
 
         self.lm_head = RobertaLMHead(
@@ -52,22 +180,98 @@ class ESM2Model(pl.LightningModule):
             weight=self.embed_tokens.weight,
         )
 
-    def load_esm_ckpt(self, esm_pretrained):
+    def _read_esm_ckpt(self, esm_pretrained):
+        try:
+            # Memory-map the checkpoint, so only the tensors that are loaded get read
+            model_data = torch.load(
+                esm_pretrained, map_location="cpu", mmap=True, weights_only=False
+            )["model"]
+        except RuntimeError:
+            # Checkpoints in the legacy (non-zip) format can't be memory-mapped
+            model_data = torch.load(esm_pretrained, map_location="cpu", weights_only=False)["model"]
         ckpt = {}
-        model_data = torch.load(esm_pretrained)["model"]
         for k in model_data:
             if "lm_head" in k:
                 ckpt[k.replace("encoder.", "")] = model_data[k]
             else:
                 ckpt[k.replace("encoder.sentence_encoder.", "")] = model_data[k]
+        return ckpt
+
+    def load_esm_ckpt(self, esm_pretrained):
+        self.esm_pretrained = esm_pretrained
+        ckpt = self._read_esm_ckpt(esm_pretrained)
+        if self.prefix_layers is not None:
+            own_keys = self.state_dict().keys()
+            ckpt = {k: v for k, v in ckpt.items() if k in own_keys}
         self.load_state_dict(ckpt)
 
+    def _load_suffix(self):
+        """
+        Build and load the layers after the prefix and the LM head of a prefix-only model,
+        on the device and in the mode of the prefix.
+        """
+        if self.esm_pretrained is None:
+            raise ValueError("load_esm_ckpt must be called before the suffix can be loaded")
+
+        ref = self.embed_tokens.weight
+        ckpt = self._read_esm_ckpt(self.esm_pretrained)
+
+        def submodule_state(prefix):
+            return {k[len(prefix) :]: v for k, v in ckpt.items() if k.startswith(prefix)}
+
+        suffix_modules = []
+        for i in range(self.prefix_layers, self.num_layers):
+            layer = self._make_layer()
+            layer.load_state_dict(submodule_state(f"layers.{i}."))
+            self.layers.append(layer)
+            suffix_modules.append(layer)
+        self._init_head()
+        self.emb_layer_norm_after.load_state_dict(submodule_state("emb_layer_norm_after."))
+        self.lm_head.load_state_dict(submodule_state("lm_head."))
+        suffix_modules += [self.emb_layer_norm_after, self.lm_head]
+
+        for module in suffix_modules:
+            module.to(device=ref.device, dtype=ref.dtype)
+            module.train(self.training)
+            for param in module.parameters():
+                param.requires_grad_(ref.requires_grad)
+        self.prefix_layers = None
+
     def compose_input(self, list_tuple_seq):
         _, _, batch_tokens = self.batch_converter(list_tuple_seq)
         batch_tokens = batch_tokens.to(self.device)
         return batch_tokens
 
-    def get_layer_activations(self, input, layer_idx):
+    def get_layer_activations(self, input, layer_idx, return_lengths=False):
+        """
+        Run the first layer_idx layers of ESM on a sequence, a list of sequences or a
+        batch of tokens. Padding is masked out of attention, so a batch of sequences of
+        different lengths gives the same activations as running them one at a time.
+
+        Returns (tokens, activations), plus the number of non-padding tokens of each
+        sequence if return_lengths is True.
+        """
+        tokens, layer_acts, *lengths = self.get_multi_layer_activations(
+            input, [layer_idx], return_lengths=return_lengths
+        )
+        return (tokens, layer_acts[layer_idx], *lengths)
+
+    def get_multi_layer_activations(self, input, layer_idxs, dtype=None, return_lengths=False):
+        """
+        Like get_layer_activations, for several layers in a single forward pass that stops
+        at the deepest of them.
+
+        Args:
+            input: A sequence, a list of sequences or a batch of tokens.
+            layer_idxs: The layers to capture the activations of. Layer i is the output of
+                the first i layers, and layer 0 the embeddings.
+            dtype: Optional dtype to cast each layer's activations to as it is captured,
+                e.g. torch.float16 to halve the memory of the captured layers.
+            return_lengths: Whether to also return the number of non-padding tokens of
+                each sequence.
+
+        Returns (tokens, activations by layer), plus the lengths if return_lengths is True.
+        """
         if isinstance(input, str):
             tokens = self.compose_input([("protein", input)])
         elif isinstance(input, list):
@@ -75,22 +279,101 @@ class ESM2Model(pl.LightningModule):
         else:
             tokens = input
 
+        layer_idxs = set(layer_idxs)
+        last_layer = max(layer_idxs)
+        if self.prefix_layers is not None and last_layer > self.prefix_layers:
+            raise ValueError(
+                f"Only the first {self.prefix_layers} layers are loaded, can't run {last_layer}"
+            )
+
+        layer_acts = {}
+
+        def capture(layer_idx, x):
+            if layer_idx in layer_idxs:
+                acts = x.transpose(0, 1)  # (T, B, E) => (B, T, E)
+                layer_acts[layer_idx] = acts.to(dtype) if dtype is not None else acts
+
+        padding_mask = tokens.eq(self.padding_idx)
         x = self.embed_scale * self.embed_tokens(tokens)
+        if self.token_dropout:
+            # Rescale the embeddings as in ESM-2 pretraining, like esm.model.esm2.ESM2 and
+            # HuggingFace's EsmModel do
+            x = x.masked_fill((tokens == self.mask_idx).unsqueeze(-1), 0.0)
+            mask_ratio_train = 0.15 * 0.8
+            src_lengths = (~padding_mask).sum(-1)
+            mask_ratio_observed = (tokens == self.mask_idx).sum(-1).to(x.dtype) / src_lengths
+            x = x * (1 - mask_ratio_train) / (1 - mask_ratio_observed)[:, None, None]
+        x = x * (1 - padding_mask.unsqueeze(-1).type_as(x))
         x = x.transpose(0, 1)  # (B, T, E) => (T, B, E)
-        for _, layer in enumerate(self.layers[:layer_idx]):
+        capture(0, x)
+        # Checked once up front, since .any() syncs with the device
+        attn_padding_mask = padding_mask if padding_mask.any() else None
+        for layer_idx, layer in enumerate(self.layers[:last_layer], start=1):
             x, attn = layer(
                 x,
-                self_attn_padding_mask=None,
+                self_attn_padding_mask=attn_padding_mask,
                 need_head_weights=False,
             )
-        return tokens, x.transpose(0, 1)
+            capture(layer_idx, x)
+        if return_lengths:
+            return tokens, layer_acts, (~padding_mask).sum(dim=1)
+        return tokens, layer_acts
+
+    def get_residue_mask(self, tokens):
+        """
+        Mask of the tokens that are residues, i.e. not padding, BOS or EOS.
+        """
+        return (tokens != self.padding_idx) & (tokens != self.cls_idx) & (tokens != self.eos_idx)
+
+    @torch.no_grad()
+    def get_prefix_cache(self, seq, layer_idx, sae_model=None):
+        """
+        Run the layers before layer_idx on a sequence once, for run_suffix to be called
+        on modified versions of its activations, e.g. for steering or ablations.
+
+        Args:
+            seq: The sequence.
+            layer_idx: The layer whose input is cached.
+            sae_model: Optional SAE to also cache the latents, LN statistics and
+                reconstruction error of the activations for, see PrefixCache.decode.
+        """
+        tokens, acts = self.get_layer_activations(seq, layer_idx)
+        cache = PrefixCache(tokens=tokens, layer_idx=layer_idx, acts=acts)
+        if sae_model is not None:
+            cache.latents, cache.mu, cache.std = sae_model.encode(acts)
+            cache.error = acts - sae_model.decode(cache.latents, cache.mu, cache.std)
+        return cache
+
+    @torch.no_grad()
+    def run_suffix(self, cache, acts):
+        """
+        Run the layers from cache.layer_idx onwards and the LM head on a batch of modified
+        activations of the cached sequence, in one pass.
+
+        Args:
+            cache: A PrefixCache from get_prefix_cache.
+            acts: (N, T, E) activations, e.g. from PrefixCache.decode.
+
+        Returns:
+            (N, T, ALPHABET_SIZE) logits.
+        """
+        return self.get_sequence(acts, cache.layer_idx)
 
-    def get_sequence(self, x, layer_idx):
+    def get_sequence(self, x, layer_idx, padding_mask=None):
+        """
+        Run layer layer_idx onwards of ESM on activations, e.g. from get_layer_activations,
+        and return the logits. padding_mask is a (B, T) boolean tensor that is True at
+        padding tokens, e.g. tokens == self.padding_idx.
+        """
+        if self.prefix_layers is not None:
+            self._load_suffix()
+        if padding_mask is not None and not padding_mask.any():
+            padding_mask = None
         x = x.transpose(0, 1)  # (B, T, E) => (T, B, E)
         for _, layer in enumerate(self.layers[layer_idx:]):
             x, attn = layer(
                 x,
-                self_attn_padding_mask=None,
+                self_attn_padding_mask=padding_mask,
                 need_head_weights=False,
             )
         x = self.emb_layer_norm_after(x)
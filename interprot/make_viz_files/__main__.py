@@ -2,6 +2,7 @@ import heapq
 import json
 import os
 import re
+import tempfile
 from pathlib import Path
 from typing import Any
 
@@ -13,17 +14,12 @@ from scipy import sparse
 from tqdm import tqdm
 from transformers import AutoTokenizer, EsmModel
 
-from interprot.sae_model import SparseAutoencoder
-from interprot.utils import get_layer_activations
+from interprot.sae_model import MultiSAE, SparseAutoencoder
+from interprot.utils import iter_multi_layer_activations, optimize_plm_for_cpu
 
 NUM_SEQS_PER_DIM = 12
-
-
-def get_esm_layer_acts(
-    seq: str, tokenizer: AutoTokenizer, plm_model: EsmModel, plm_layer: int
-) -> torch.Tensor:
-    acts = get_layer_activations(tokenizer=tokenizer, plm=plm_model, seqs=[seq], layer=plm_layer)[0]
-    return acts
+# How many sequences' activations to hold per checkpoint before writing them to disk
+SPILL_EVERY_N_SEQS = 1000
 
 
 @click.command()
@@ -32,7 +28,9 @@ def get_esm_layer_acts(
     type=click.Path(exists=True, file_okay=True, dir_okay=False),
     required=True,
     multiple=True,
-    help="Paths to the SAE checkpoint files",
+    help=(
+        "Paths to the SAE checkpoint files, in any format SparseAutoencoder.from_checkpoint reads"
+    ),
 )
 @click.option(
     "--sequences-file",
@@ -46,118 +44,205 @@ def get_esm_layer_acts(
     required=True,
     help="Path to the output directory in which the JSON files will be written",
 )
-def make_viz_files(checkpoint_files: list[str], sequences_file: str, output_dir: Path):
+@click.option(
+    "--sae-thresholds",
+    type=click.Path(exists=True),
+    multiple=True,
+    help=(
+        "Paths to calibrated SAE thresholds, one per checkpoint file. If given, use them "
+        "instead of top-k"
+    ),
+)
+@click.option(
+    "--plm-layer",
+    type=int,
+    default=None,
+    help="Layer of the protein language model, for checkpoints that don't record it",
+)
+@click.option(
+    "--cpu-profile",
+    is_flag=True,
+    help="Run on CPU with the pLM quantized to int8, see utils.optimize_plm_for_cpu",
+)
+@click.option("--num-threads", type=int, default=None, help="Number of CPU threads to use")
+def make_viz_files(
+    checkpoint_files: list[str],
+    sequences_file: str,
+    output_dir: Path,
+    sae_thresholds: list[str],
+    plm_layer: int,
+    cpu_profile: bool,
+    num_threads: int,
+):
     """
-    Generate visualization files for SAE latents for multiple checkpoint files.
+    Generate visualization files for SAE latents for multiple checkpoint files, each in a
+    subdirectory of the output directory named after the checkpoint file. The pLM is run
+    once per sequence for all checkpoints.
     """
     output_dir = Path(output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    for checkpoint_file in checkpoint_files:
-        click.echo(f"Generating visualization files for {checkpoint_file}")
-
-        pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
-        matches = re.search(pattern, checkpoint_file)
-
-        if matches:
-            plm_dim, plm_layer, sae_dim = map(int, matches.groups())
-        else:
-            raise ValueError("Checkpoint file must be named in the format plm<n>_l<n>_sae<n>")
-
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
-        plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
-        sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
-
-        try:
-            sae_model.load_state_dict(torch.load(checkpoint_file, map_location=device))
-        except Exception:
-            sae_model.load_state_dict(
-                {
-                    k.replace("sae_model.", ""): v
-                    for k, v in torch.load(checkpoint_file, map_location=device)[
-                        "state_dict"
-                    ].items()
-                }
-            )
-
-        df = pl.read_parquet(sequences_file)
-        has_pfam = "Pfam" in df.columns
-
-        # Pre-allocate numpy array for storing max activations
-        all_seqs_max_act = np.zeros((sae_dim, len(df)))
-        all_acts = [0 for _ in range(len(df))]
-
-        for seq_idx, row in tqdm(
-            enumerate(df.iter_rows(named=True)),
+    if sae_thresholds and len(sae_thresholds) != len(checkpoint_files):
+        raise ValueError("Pass one --sae-thresholds file per --checkpoint-files")
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not cpu_profile else "cpu")
+    tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
+    plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
+    if cpu_profile:
+        plm_model = optimize_plm_for_cpu(plm_model, num_threads=num_threads)
+
+    # Each checkpoint's files go in a directory named after it
+    checkpoint_dirs = [
+        output_dir / Path(checkpoint_file).stem for checkpoint_file in checkpoint_files
+    ]
+    if len(set(checkpoint_dirs)) != len(checkpoint_dirs):
+        raise ValueError("--checkpoint-files must have distinct file names")
+
+    saes, sae_layers = {}, {}
+    for i, checkpoint_file in enumerate(checkpoint_files):
+        sae_model = SparseAutoencoder.from_checkpoint(checkpoint_file, map_location=device)
+        sae_layer = sae_model.layer if sae_model.layer is not None else plm_layer
+        if sae_layer is None:
+            # Older checkpoints were named in the format plm<n>_l<n>_sae<n>
+            matches = re.search(r"plm\d+.*?l(\d+).*?sae\d+", checkpoint_file)
+            if not matches:
+                raise ValueError(
+                    f"{checkpoint_file} does not record its pLM layer, pass --plm-layer"
+                )
+            sae_layer = int(matches.group(1))
+        if sae_thresholds:
+            sae_model.load_thresholds(sae_thresholds[i])
+        saes[f"sae{i}"] = sae_model
+        sae_layers[f"sae{i}"] = sae_layer
+    # Encode all checkpoints together so the pLM runs once per sequence
+    multi_sae = MultiSAE(saes, sae_layers)
+    sae_dims = {name: sae.d_hidden_full for name, sae in saes.items()}
+    del saes
+
+    df = pl.read_parquet(sequences_file)
+    has_pfam = "Pfam" in df.columns
+    # The rows of each sequence's residues in the stacked activations of a checkpoint
+    offsets = np.concatenate([[0], np.cumsum(df["Sequence"].str.len_chars().to_numpy())])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The sparse activations are spilled to disk as the pLM runs, so that only one
+        # checkpoint's are in memory at a time once its files are written
+        chunks: dict[str, list] = {name: [] for name in sae_dims}
+        chunk_paths: dict[str, list[str]] = {name: [] for name in sae_dims}
+        seq_max_acts: dict[str, list] = {name: [] for name in sae_dims}
+
+        def flush(name: str):
+            path = os.path.join(tmp_dir, f"{name}_{len(chunk_paths[name]):05d}.npz")
+            sparse.save_npz(path, sparse.vstack(chunks[name], format="csr"))
+            chunk_paths[name].append(path)
+            chunks[name].clear()
+
+        all_esm_layer_acts = iter_multi_layer_activations(
+            tokenizer=tokenizer,
+            plm=plm_model,
+            seqs=df["Sequence"],
+            layers=sorted(set(sae_layers.values())),
+            device=device,
+        )
+        for seq_idx, esm_layer_acts in tqdm(
+            enumerate(all_esm_layer_acts),
             total=len(df),
             desc="Running inference over all seqs (Step 1/3)",
         ):
-            seq = row["Sequence"]
-            # Get ESM activations and immediately detach from computation graph
-            esm_layer_acts = get_esm_layer_acts(seq, tokenizer, plm_model, plm_layer)
-
-            # Process activations in chunks if sequence is too long
-            sae_acts = sae_model.get_acts(esm_layer_acts)[1:-1]
-
-            # Move to CPU and convert to numpy immediately
-            sae_acts_cpu = sae_acts.cpu().numpy()
-            all_seqs_max_act[:, seq_idx] = np.max(sae_acts_cpu, axis=0)
-            sae_acts_int = (sae_acts_cpu).astype(np.float32)
-            # Convert to sparse matrix. This significantly reduces memory usage
-            sparse_acts = sparse.csr_matrix(sae_acts_int)
-            all_acts[seq_idx] = sparse_acts
+            for name, sae_acts in multi_sae.get_acts(esm_layer_acts).items():
+                # Convert to sparse matrix. This significantly reduces memory usage
+                sparse_acts = sparse.csr_matrix(sae_acts[1:-1].float().cpu().numpy())
+                chunks[name].append(sparse_acts)
+                seq_max_acts[name].append(sparse_acts.max(axis=0))
+                if len(chunks[name]) == SPILL_EVERY_N_SEQS:
+                    flush(name)
             # Clear CUDA cache periodically
             if seq_idx % 100 == 0:
                 torch.cuda.empty_cache()
+        for name in sae_dims:
+            if chunks[name]:
+                flush(name)
+
+        for i, checkpoint_file in enumerate(checkpoint_files):
+            click.echo(f"Generating visualization files for {checkpoint_file}")
+            name = f"sae{i}"
+            write_checkpoint_viz_files(
+                sae_dim=sae_dims[name],
+                acts=sparse.vstack(
+                    [sparse.load_npz(path) for path in chunk_paths[name]], format="csr"
+                ),
+                offsets=offsets,
+                all_seqs_max_act=sparse.vstack(seq_max_acts.pop(name)).T.toarray(),
+                df=df,
+                has_pfam=has_pfam,
+                output_dir=checkpoint_dirs[i],
+            )
 
-        # Save intermediate results
-        with open(output_dir / "max_acts.npz", "wb") as f:
-            np.savez(f, all_seqs_max_act=all_seqs_max_act)
 
-        hidden_dim_to_seqs: dict[int, dict] = {dim: {} for dim in range(sae_dim)}
+def write_checkpoint_viz_files(
+    sae_dim: int,
+    acts: sparse.csr_matrix,
+    offsets: np.ndarray,
+    all_seqs_max_act: np.ndarray,
+    df: pl.DataFrame,
+    has_pfam: bool,
+    output_dir: Path,
+):
+    """
+    Write max_acts.npz and the visualization file of each latent of one checkpoint, from
+    the (num_residues, sae_dim) activations of all sequences stacked, the row offset of
+    each sequence in them, and the (sae_dim, num_seqs) max activation of each latent in
+    each sequence.
+    """
+    os.makedirs(output_dir, exist_ok=True)
 
-        act_ranges = [[0, 0.25], [0.25, 0.5], [0.5, 0.75], [0.75, 1]]
-        range_names = [f"{start}-{end}" for start, end in act_ranges]
+    # Save intermediate results
+    with open(output_dir / "max_acts.npz", "wb") as f:
+        np.savez(f, all_seqs_max_act=all_seqs_max_act)
 
-        for dim in tqdm(range(sae_dim), desc="Finding highest activating seqs (Step 2/3)"):
-            dim_maxes = all_seqs_max_act[dim]
-            non_zero_maxes = dim_maxes[dim_maxes > 0]
+    hidden_dim_to_seqs: dict[int, dict] = {dim: {} for dim in range(sae_dim)}
 
-            if len(non_zero_maxes) == 0:
-                print(f"Skipping dimension {dim} as it has no activations")
-                continue
+    act_ranges = [[0, 0.25], [0.25, 0.5], [0.5, 0.75], [0.75, 1]]
+    range_names = [f"{start}-{end}" for start, end in act_ranges]
 
-            # Get top Pfam families for sequences with activations greater than 0.75
-            if has_pfam:
-                top_families = get_top_pfam(
-                    df, dim_maxes, act_gt=0.75, n_classes=3, frac_above_threshold=0.8
-                )
-                hidden_dim_to_seqs[dim]["top_pfam"] = top_families
-
-            non_zero_maxes = dim_maxes[dim_maxes > 0]
-            hidden_dim_to_seqs[dim]["freq_active"] = len(non_zero_maxes) / len(dim_maxes)
-            hidden_dim_to_seqs[dim]["n_seqs"] = len(non_zero_maxes)
-            hidden_dim_to_seqs[dim]["max_act"] = float(dim_maxes.max())
-
-            normalized_acts = dim_maxes / dim_maxes.max()
-            for i, (start, end) in enumerate(act_ranges):
-                mask = (normalized_acts > start) & (normalized_acts <= end)
-                top_indices = heapq.nlargest(
-                    NUM_SEQS_PER_DIM, np.where(mask)[0], key=lambda i: dim_maxes[i]
-                )
-                range_name = range_names[i]
-                hidden_dim_to_seqs[dim][range_name] = {}
-                hidden_dim_to_seqs[dim][range_name]["indices"] = top_indices
+    for dim in tqdm(range(sae_dim), desc="Finding highest activating seqs (Step 2/3)"):
+        dim_maxes = all_seqs_max_act[dim]
+        non_zero_maxes = dim_maxes[dim_maxes > 0]
 
-        for dim in tqdm(range(sae_dim), desc="Writing visualization files (Step 3/3)"):
-            if not hidden_dim_to_seqs[dim]:
-                print(f"Skipping dimension {dim} as it has no sequences")
-                continue
-            write_viz_file(hidden_dim_to_seqs[dim], dim, all_acts, df, range_names, output_dir)
+        if len(non_zero_maxes) == 0:
+            print(f"Skipping dimension {dim} as it has no activations")
+            continue
+
+        # Get top Pfam families for sequences with activations greater than 0.75
+        if has_pfam:
+            top_families = get_top_pfam(
+                df, dim_maxes, act_gt=0.75, n_classes=3, frac_above_threshold=0.8
+            )
+            hidden_dim_to_seqs[dim]["top_pfam"] = top_families
+
+        non_zero_maxes = dim_maxes[dim_maxes > 0]
+        hidden_dim_to_seqs[dim]["freq_active"] = len(non_zero_maxes) / len(dim_maxes)
+        hidden_dim_to_seqs[dim]["n_seqs"] = len(non_zero_maxes)
+        hidden_dim_to_seqs[dim]["max_act"] = float(dim_maxes.max())
+
+        normalized_acts = dim_maxes / dim_maxes.max()
+        for i, (start, end) in enumerate(act_ranges):
+            mask = (normalized_acts > start) & (normalized_acts <= end)
+            top_indices = heapq.nlargest(
+                NUM_SEQS_PER_DIM, np.where(mask)[0], key=lambda i: dim_maxes[i]
+            )
+            range_name = range_names[i]
+            hidden_dim_to_seqs[dim][range_name] = {}
+            hidden_dim_to_seqs[dim][range_name]["indices"] = top_indices
+
+    for dim in tqdm(range(sae_dim), desc="Writing visualization files (Step 3/3)"):
+        if not hidden_dim_to_seqs[dim]:
+            print(f"Skipping dimension {dim} as it has no sequences")
+            continue
+        write_viz_file(hidden_dim_to_seqs[dim], dim, acts, offsets, df, range_names, output_dir)
 
 
-def write_viz_file(dim_info, dim, all_acts, df, range_names, output_dir: Path):
+def write_viz_file(dim_info, dim, acts, offsets, df, range_names, output_dir: Path):
     viz_file: dict[str, Any] = {"ranges": {}}
     # Write how common the dimension is
     if "freq_active" in dim_info:
@@ -179,8 +264,7 @@ def write_viz_file(dim_info, dim, all_acts, df, range_names, output_dir: Path):
 
         for seq_idx in top_indices:
             seq_idx = int(seq_idx)
-            sae_acts = all_acts[seq_idx].toarray()
-            dim_acts = sae_acts[:, dim]
+            dim_acts = acts[offsets[seq_idx] : offsets[seq_idx + 1], dim].toarray().ravel()
             uniprot_id = df[seq_idx]["Entry"].item()
             alphafolddb_id = df[seq_idx]["AlphaFoldDB"].item().split(";")[0]
             protein_name = df[seq_idx]["Protein names"].item()
@@ -23,6 +23,7 @@ from interprot.oned_probe.utils import (
     prepare_arrays_for_logistic_regression,
 )
 from interprot.sae_model import SparseAutoencoder
+from interprot.utils import optimize_plm_for_cpu
 
 
 def augment_df_with_aa_identity(df: pd.DataFrame) -> pd.DataFrame:
@@ -71,15 +72,19 @@ def run_logistic_regression_on_latent(
     "--sae-checkpoint",
     type=click.Path(exists=True),
     required=True,
-    help="Path to the SAE checkpoint file",
+    help="Path to the SAE checkpoint file, in any format SparseAutoencoder.from_checkpoint reads",
+)
+@click.option(
+    "--sae-dim",
+    type=int,
+    default=None,
+    help="Dimension of the sparse autoencoder. Defaults to the checkpoint's",
 )
-@click.option("--sae-dim", type=int, required=True, help="Dimension of the sparse autoencoder")
-@click.option("--plm-dim", type=int, required=True, help="Dimension of the protein language model")
 @click.option(
     "--plm-layer",
     type=int,
-    required=True,
-    help="Layer of the protein language model to use",
+    default=None,
+    help="Layer of the protein language model to use. Defaults to the checkpoint's",
 )
 @click.option(
     "--swissprot-tsv",
@@ -111,16 +116,30 @@ def run_logistic_regression_on_latent(
     default=1000,
     help="Maximum number of sequences to use for a given logistic regression task",
 )
+@click.option(
+    "--sae-thresholds",
+    type=click.Path(exists=True),
+    default=None,
+    help="Path to calibrated SAE thresholds. If given, use them instead of top-k",
+)
+@click.option(
+    "--cpu-profile",
+    is_flag=True,
+    help="Run on CPU with the pLM quantized to int8, see utils.optimize_plm_for_cpu",
+)
+@click.option("--num-threads", type=int, default=None, help="Number of CPU threads to use")
 def single_latent(
     sae_checkpoint: str,
     sae_dim: int,
-    plm_dim: int,
     plm_layer: int,
     swissprot_tsv: str,
     output_dir: str,
     annotation_names: list[str],
     pool_over_annotation: bool,
     max_seqs_per_task: int,
+    sae_thresholds: str,
+    cpu_profile: bool,
+    num_threads: int,
 ):
     """
     Run 1D logistic regression probing for each latent dimension for SAE evaluation.
@@ -130,14 +149,26 @@ def single_latent(
             raise ValueError(f"Invalid annotation name: {name}")
 
     os.makedirs(output_dir, exist_ok=True)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda" if torch.cuda.is_available() and not cpu_profile else "cpu")
     logger.debug(f"Using device: {device}")
 
     # Load pLM and SAE
     tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
     plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
-    sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
-    sae_model.load_state_dict(torch.load(sae_checkpoint, map_location=device))
+    if cpu_profile:
+        plm_model = optimize_plm_for_cpu(plm_model, num_threads=num_threads)
+    sae_model = SparseAutoencoder.from_checkpoint(sae_checkpoint, map_location=device)
+    if sae_thresholds:
+        sae_model.load_thresholds(sae_thresholds)
+    if sae_dim is not None and sae_dim != sae_model.d_hidden_full:
+        raise click.BadParameter(
+            f"the checkpoint has {sae_model.d_hidden_full} hidden dims, not {sae_dim}",
+            param_hint="--sae-dim",
+        )
+    sae_dim = sae_model.d_hidden_full
+    plm_layer = plm_layer if plm_layer is not None else sae_model.layer
+    if plm_layer is None:
+        raise ValueError("The checkpoint does not record its pLM layer, pass --plm-layer")
 
     df = pd.read_csv(swissprot_tsv, sep="\t")
 
@@ -5,6 +5,7 @@ import subprocess
 import tempfile
 from collections import defaultdict
 from dataclasses import dataclass
+from typing import Iterator
 
 import numpy as np
 import pandas as pd
@@ -14,9 +15,11 @@ from transformers import AutoTokenizer, EsmModel
 from interprot.oned_probe.annotations import ResidueAnnotation
 from interprot.oned_probe.logging import logger
 from interprot.sae_model import SparseAutoencoder
-from interprot.utils import get_layer_activations, parse_swissprot_annotation
-
-MAX_SEQ_LEN = 1000
+from interprot.utils import (
+    get_windowed_layer_activations,
+    iter_layer_activations,
+    parse_swissprot_annotation,
+)
 
 
 @dataclass
@@ -131,15 +134,34 @@ def get_sae_acts(
     plm_layer: int,
 ) -> np.ndarray[np.float32, np.float32]:
     """
-    Returns a (len(seq), sae_dim) array of SAE activations.
+    Returns a (len(seq), sae_dim) array of SAE activations. Sequences longer than ESM's
+    context are run in overlapping windows.
     """
-    esm_layer_acts = get_layer_activations(
-        tokenizer=tokenizer, plm=plm_model, seqs=[seq], layer=plm_layer
-    )[0]
+    esm_layer_acts = get_windowed_layer_activations(
+        tokenizer=tokenizer, plm=plm_model, seq=seq, layer=plm_layer
+    )
     sae_acts = sae_model.get_acts(esm_layer_acts)[1:-1]  # Trim BOS and EOS tokens
     return sae_acts.cpu().numpy()
 
 
+def iter_sae_acts(
+    seqs: list[str],
+    tokenizer: AutoTokenizer,
+    plm_model: EsmModel,
+    sae_model: SparseAutoencoder,
+    plm_layer: int,
+) -> Iterator[np.ndarray[np.float32, np.float32]]:
+    """
+    Like get_sae_acts for each sequence in seqs, in order, running the pLM on batches
+    of sequences of similar length.
+    """
+    for esm_layer_acts in iter_layer_activations(
+        tokenizer=tokenizer, plm=plm_model, seqs=seqs, layer=plm_layer
+    ):
+        sae_acts = sae_model.get_acts(esm_layer_acts)[1:-1]  # Trim BOS and EOS tokens
+        yield sae_acts.cpu().numpy()
+
+
 def get_annotation_entries_for_class(
     swissprot_df: pd.DataFrame,
     annotation: ResidueAnnotation,
@@ -167,7 +189,7 @@ def get_annotation_entries_for_class(
             # The note field is sometimes like "Homeobox", "Homeobox 1", etc.,
             # so use string `in` to check.
             entries = [e for e in entries if class_name in e.get("note", "")]
-        if len(entries) > 0 and len(seq) < MAX_SEQ_LEN:
+        if len(entries) > 0:
             seq_to_annotation_entries[seq] = entries
             seq_lengths.append(len(seq))
 
@@ -214,18 +236,18 @@ def make_examples_from_annotation_entries(
     ```
     """
     examples = []
-    for seq, entries in tqdm(
-        seq_to_annotation_entries.items(),
+    all_sae_acts = iter_sae_acts(
+        seqs=list(seq_to_annotation_entries.keys()),
+        tokenizer=tokenizer,
+        plm_model=plm_model,
+        sae_model=sae_model,
+        plm_layer=plm_layer,
+    )
+    for (seq, entries), sae_acts in tqdm(
+        zip(seq_to_annotation_entries.items(), all_sae_acts),
+        total=len(seq_to_annotation_entries),
         desc="Running ESM -> SAE inference",
     ):
-        sae_acts = get_sae_acts(
-            seq=seq,
-            tokenizer=tokenizer,
-            plm_model=plm_model,
-            sae_model=sae_model,
-            plm_layer=plm_layer,
-        )
-
         if pool_over_annotation:
             for e in entries:
                 start = e["start"] - 1
@@ -0,0 +1,222 @@
+"""
+One interface to get pLM layer activations from either of the two ESM-2 implementations
+used in this repo:
+
+- HFBackend: HuggingFace's EsmModel, used by the CLIs and notebooks.
+- FairESMBackend: esm_wrapper.ESM2Model, built on the esm package, used for training.
+
+Both take sequences and return (N, L, D_MODEL) activations with BOS and EOS, padded to
+the longest sequence, where layer 0 is the embeddings and layer i the output of the
+first i layers. The last layer is taken after the final layer norm, as in HuggingFace's
+hidden_states.
+
+Given the same weights, the two backends agree to floating point error if the
+ESM2Model is built with token_dropout=True. The SAEs are trained on ESM2Model
+activations with token_dropout=False, which differ from HuggingFace's by the 0.88
+embedding scale of token dropout. See scripts/plm_backend_benchmark.py to compare their
+throughput, memory and activations.
+"""
+
+import re
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import esm
+import torch
+from transformers import AutoTokenizer, EsmModel, PreTrainedModel, PreTrainedTokenizer
+
+from interprot.esm_wrapper import ESM2Model
+from interprot.utils import get_multi_layer_activations
+
+PLM_BACKENDS = ("hf", "esm")
+
+# HuggingFace EsmModel parameter names => esm_wrapper.ESM2Model parameter names
+_HF_TO_ESM_KEYS = [
+    (r"^embeddings\.word_embeddings\.", "embed_tokens."),
+    (r"^encoder\.layer\.(\d+)\.attention\.self\.query\.", r"layers.\1.self_attn.q_proj."),
+    (r"^encoder\.layer\.(\d+)\.attention\.self\.key\.", r"layers.\1.self_attn.k_proj."),
+    (r"^encoder\.layer\.(\d+)\.attention\.self\.value\.", r"layers.\1.self_attn.v_proj."),
+    (
+        r"^encoder\.layer\.(\d+)\.attention\.self\.rotary_embeddings\.",
+        r"layers.\1.self_attn.rot_emb.",
+    ),
+    (r"^encoder\.layer\.(\d+)\.attention\.output\.dense\.", r"layers.\1.self_attn.out_proj."),
+    (r"^encoder\.layer\.(\d+)\.attention\.LayerNorm\.", r"layers.\1.self_attn_layer_norm."),
+    (r"^encoder\.layer\.(\d+)\.intermediate\.dense\.", r"layers.\1.fc1."),
+    (r"^encoder\.layer\.(\d+)\.output\.dense\.", r"layers.\1.fc2."),
+    (r"^encoder\.layer\.(\d+)\.LayerNorm\.", r"layers.\1.final_layer_norm."),
+    (r"^encoder\.emb_layer_norm_after\.", "emb_layer_norm_after."),
+    (r"^lm_head\.dense\.", "lm_head.dense."),
+    (r"^lm_head\.layer_norm\.", "lm_head.layer_norm."),
+    (r"^lm_head\.bias$", "lm_head.bias"),
+]
+
+
+def hf_to_esm_state_dict(plm: PreTrainedModel) -> dict[str, torch.Tensor]:
+    """
+    Map the weights of a HuggingFace ESM-2 model to the parameter names of
+    esm_wrapper.ESM2Model. The LM head is only included if plm has one, e.g. for an
+    EsmForMaskedLM. Weights ESM2Model has no counterpart for, like the contact head, are
+    dropped.
+    """
+    state_dict = {}
+    base_prefix = plm.base_model_prefix + "."
+    for key, value in plm.state_dict().items():
+        if key.startswith(base_prefix):
+            key = key[len(base_prefix) :]
+        for pattern, replacement in _HF_TO_ESM_KEYS:
+            new_key, n = re.subn(pattern, replacement, key)
+            if n:
+                state_dict[new_key] = value
+                break
+    return state_dict
+
+
+class PLMBackend(ABC):
+    """
+    Base class of the pLM backends. Subclasses implement device and
+    get_multi_layer_activations.
+    """
+
+    num_layers: int
+
+    @property
+    @abstractmethod
+    def device(self) -> torch.device: ...
+
+    @abstractmethod
+    def get_multi_layer_activations(
+        self, seqs: list[str], layers: list[int]
+    ) -> dict[int, torch.Tensor]:
+        """
+        The (N, L, D_MODEL) activations of each requested layer, by layer, from a single
+        forward pass that stops at the deepest of them.
+        """
+
+    def get_layer_activations(self, seqs: list[str], layer: int) -> torch.Tensor:
+        """
+        The (N, L, D_MODEL) activations of a layer.
+        """
+        return self.get_multi_layer_activations(seqs, [layer])[layer]
+
+
+class HFBackend(PLMBackend):
+    def __init__(self, tokenizer: PreTrainedTokenizer, plm: PreTrainedModel):
+        self.tokenizer = tokenizer
+        self.plm = plm
+        self.num_layers = plm.config.num_hidden_layers
+
+    @classmethod
+    def from_pretrained(
+        cls, plm_name: str = "facebook/esm2_t33_650M_UR50D", device: str = "cpu"
+    ) -> "HFBackend":
+        tokenizer = AutoTokenizer.from_pretrained(plm_name)
+        plm = EsmModel.from_pretrained(plm_name).to(device).eval()
+        return cls(tokenizer, plm)
+
+    @property
+    def device(self) -> torch.device:
+        return self.plm.device
+
+    def get_multi_layer_activations(
+        self, seqs: list[str], layers: list[int]
+    ) -> dict[int, torch.Tensor]:
+        return get_multi_layer_activations(self.tokenizer, self.plm, seqs, layers)
+
+
+class FairESMBackend(PLMBackend):
+    def __init__(self, model: ESM2Model):
+        self.model = model
+        self.num_layers = model.num_layers
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        esm2_weight: str,
+        num_layers: int = 33,
+        embed_dim: int = 1280,
+        attention_heads: int = 20,
+        max_layer: Optional[int] = None,
+        attn_implementation: str = "esm",
+        token_dropout: bool = False,
+        device: str = "cpu",
+    ) -> "FairESMBackend":
+        """
+        Load an esm package checkpoint, e.g. esm2_t33_650M_UR50D.pt. If max_layer is given,
+        only the layers up to it are loaded.
+
+        attn_implementation and token_dropout default to the settings of training. Pass
+        token_dropout=True to match HFBackend.
+        """
+        alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+        model = ESM2Model(
+            num_layers=num_layers,
+            embed_dim=embed_dim,
+            attention_heads=attention_heads,
+            alphabet=alphabet,
+            token_dropout=token_dropout,
+            prefix_layers=max_layer,
+            attn_implementation=attn_implementation,
+        )
+        model.load_esm_ckpt(esm2_weight)
+        return cls(model.to(device).eval())
+
+    @classmethod
+    def from_hf_model(
+        cls,
+        plm: PreTrainedModel,
+        attn_implementation: str = "esm",
+        token_dropout: Optional[bool] = None,
+    ) -> "FairESMBackend":
+        """
+        Build the backend from the weights of a HuggingFace ESM-2 model, so both backends
+        can be compared without the esm package checkpoint. token_dropout defaults to the
+        HuggingFace model's.
+        """
+        config = plm.config
+        if token_dropout is None:
+            token_dropout = config.token_dropout
+        model = ESM2Model(
+            num_layers=config.num_hidden_layers,
+            embed_dim=config.hidden_size,
+            attention_heads=config.num_attention_heads,
+            alphabet=esm.data.Alphabet.from_architecture("ESM-1b"),
+            token_dropout=token_dropout,
+            attn_implementation=attn_implementation,
+        )
+        missing, _ = model.load_state_dict(hf_to_esm_state_dict(plm), strict=False)
+        # The rotary frequencies are recomputed identically by both implementations
+        missing = [k for k in missing if not (k.startswith("lm_head.") or k.endswith(".inv_freq"))]
+        if missing:
+            raise ValueError(f"Weights missing from the HuggingFace model: {missing}")
+        return cls(model.to(device=plm.device, dtype=plm.dtype).eval())
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    @torch.no_grad()
+    def get_multi_layer_activations(
+        self, seqs: list[str], layers: list[int]
+    ) -> dict[int, torch.Tensor]:
+        layers = set(layers)
+        if self.num_layers in layers and self.model.prefix_layers is not None:
+            self.model._load_suffix()
+        _, layer_acts = self.model.get_multi_layer_activations(seqs, layers)
+        if self.num_layers in layers:
+            layer_acts[self.num_layers] = self.model.emb_layer_norm_after(
+                layer_acts[self.num_layers]
+            )
+        return layer_acts
+
+
+def load_plm_backend(backend: str, **kwargs) -> PLMBackend:
+    """
+    Load a pLM backend by name, one of PLM_BACKENDS, passing kwargs to its
+    from_pretrained.
+    """
+    if backend == "hf":
+        return HFBackend.from_pretrained(**kwargs)
+    if backend == "esm":
+        return FairESMBackend.from_pretrained(**kwargs)
+    raise ValueError(f"Unknown pLM backend {backend}, expected one of {PLM_BACKENDS}")
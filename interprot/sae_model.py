@@ -1,10 +1,70 @@
 import math
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Union
 
 import torch
 import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 from torch.nn import functional as F
 
+# Upper bound on the number of elements materialized at once when gathering rows of
+# w_dec in the backward pass of SparseDecode.
+SPARSE_DECODE_CHUNK_SIZE = 2**25
+
+# Upper bound on the number of (token, hidden dim) pre-activations binned at once when
+# calibrating activation thresholds.
+THRESHOLD_CALIBRATION_CHUNK_SIZE = 2**24
+
+
+class SparseDecode(torch.autograd.Function):
+    """
+    Decode top-k latents given as (indices, values) without materializing the dense
+    (..., D_HIDDEN) latent tensor. Equivalent to `dense_latents @ w_dec`, but only the k
+    selected rows of w_dec are touched for each token, in both the forward and backward pass.
+    """
+
+    @staticmethod
+    def forward(
+        ctx, indices: torch.Tensor, values: torch.Tensor, w_dec: torch.Tensor
+    ) -> torch.Tensor:
+        k = indices.shape[-1]
+        flat_indices = indices.reshape(-1, k)
+        flat_values = values.reshape(-1, k)
+        ctx.save_for_backward(flat_indices, flat_values, w_dec)
+        out = F.embedding_bag(flat_indices, w_dec, per_sample_weights=flat_values, mode="sum")
+        return out.view(*indices.shape[:-1], w_dec.shape[-1])
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        flat_indices, flat_values, w_dec = ctx.saved_tensors
+        n_tokens, k = flat_indices.shape
+        flat_grad = grad_output.reshape(n_tokens, -1)
+
+        grad_values = grad_w_dec = None
+        if ctx.needs_input_grad[1]:
+            # d(recons)/d(values[i, j]) is the w_dec row that value j of token i selected.
+            # Gather those rows in chunks so the (N_TOKENS, K, D_MODEL) tensor never exists.
+            grad_values = torch.empty_like(flat_values)
+            chunk_size = max(1, SPARSE_DECODE_CHUNK_SIZE // (k * w_dec.shape[-1]))
+            for start in range(0, n_tokens, chunk_size):
+                end = start + chunk_size
+                rows = w_dec[flat_indices[start:end]]
+                grad_values[start:end] = torch.bmm(
+                    rows, flat_grad[start:end].unsqueeze(-1)
+                ).squeeze(-1)
+            grad_values = grad_values.view(*grad_output.shape[:-1], k)
+        if ctx.needs_input_grad[2]:
+            # grad_w_dec = latents.T @ grad_output with latents as a sparse
+            # (D_HIDDEN, N_TOKENS) matrix holding k nonzeros per column.
+            token_ids = torch.arange(n_tokens, device=flat_indices.device).repeat_interleave(k)
+            latents_t = torch.sparse_coo_tensor(
+                torch.stack([flat_indices.flatten(), token_ids]),
+                flat_values.flatten(),
+                (w_dec.shape[0], n_tokens),
+            )
+            grad_w_dec = torch.sparse.mm(latents_t, flat_grad)
+        return None, grad_values, grad_w_dec
+
 
 class SparseAutoencoder(nn.Module):
     def __init__(
@@ -13,8 +73,9 @@ class SparseAutoencoder(nn.Module):
         d_hidden: int,
         k: int = 128,
         auxk: int = 256,
-        batch_size: int = 256,
-        dead_steps_threshold: int = 2000,
+        dead_tokens_threshold: int = 10_000_000,
+        firing_ema_decay: float = 0.99,
+        dead_check_interval: int = 100,
     ):
         """
         Initialize the Sparse Autoencoder.
@@ -24,8 +85,13 @@ class SparseAutoencoder(nn.Module):
             d_hidden: Dimension of the SAE hidden layer.
             k: Number of top-k activations to keep.
             auxk: Number of auxiliary activations.
-            dead_steps_threshold: How many examples of inactivation before we consider
+            dead_tokens_threshold: How many tokens of inactivation before we consider
                 a hidden dim dead.
+            firing_ema_decay: Decay of the per-step exponential moving average of each
+                hidden dim's firing frequency.
+            dead_check_interval: How many training steps apart to check whether any hidden
+                dim is dead, which syncs with the device. The auxiliary reconstruction is
+                skipped until the next check when none is.
 
         Adapted from https://github.com/tylercosgrove/sparse-autoencoder-mistral7b/blob/main/sae.py
         based on 'Scaling and evaluating sparse autoencoders' (Gao et al. 2024) https://arxiv.org/pdf/2406.04093
@@ -42,9 +108,17 @@ class SparseAutoencoder(nn.Module):
         self.d_hidden = d_hidden
         self.k = k
         self.auxk = auxk
-        self.batch_size = batch_size
 
-        self.dead_steps_threshold = dead_steps_threshold / batch_size
+        self.dead_tokens_threshold = dead_tokens_threshold
+        self.firing_ema_decay = firing_ema_decay
+        # Tokens trained on, saved with the model so that auxk resumes with training. forward
+        # reads a host copy, so it can tell without a device sync that no hidden dim can be
+        # dead yet.
+        self.register_buffer("tokens_seen", torch.zeros((), dtype=torch.long))
+        self._tokens_seen_host = 0
+        self.dead_check_interval = dead_check_interval
+        self._steps_until_dead_check = 0
+        self._has_dead = False
 
         # TODO: Revisit to see if this is the best way to initialize
         nn.init.kaiming_uniform_(self.w_enc, a=math.sqrt(5))
@@ -52,8 +126,31 @@ class SparseAutoencoder(nn.Module):
         self.w_dec.data /= self.w_dec.data.norm(dim=0)
 
         # Initialize dead neuron tracking. For each hidden dimension, save the
-        # index of the example at which it was last activated.
+        # number of tokens since it was last activated.
         self.register_buffer("stats_last_nonzero", torch.zeros(d_hidden, dtype=torch.long))
+        # Exponential moving average of the fraction of tokens each hidden dim fires on.
+        self.register_buffer("firing_freq_ema", torch.zeros(d_hidden))
+
+        # Per hidden dim activation thresholds for top-k-free inference. These are
+        # calibrated after training (see calibrate_thresholds), so they are kept out of the
+        # state dict and existing checkpoints keep loading.
+        self.register_buffer("thresholds", None, persistent=False)
+        self.use_thresholds = False
+
+        # Low-rank factors of w_enc for approximate top-k (see build_approx_topk). Derived
+        # from the weights, so also kept out of the state dict.
+        self.register_buffer("approx_proj", None, persistent=False)
+        self.register_buffer("approx_basis", None, persistent=False)
+        self.approx_n_candidates = None
+
+        # For SAEs with dead hidden dims stripped (see compact), the original hidden dim of
+        # each remaining one, and the original D_HIDDEN.
+        self.register_buffer("latent_ids", None)
+        self.d_hidden_full = d_hidden
+
+        # The pLM and layer the SAE reads, if known from its checkpoint.
+        self.plm_name: Optional[str] = None
+        self.layer: Optional[int] = None
 
     def topK_activation(self, x: torch.Tensor, k: int) -> torch.Tensor:
         """
@@ -73,12 +170,99 @@ class SparseAutoencoder(nn.Module):
         3. Create a new tensor of zeros with the same shape as the input.
         4. Scatter the activated top k values back into their original positions.
         """
-        topk = torch.topk(x, k=k, dim=-1, sorted=False)
-        values = F.relu(topk.values)
+        indices, values = self.topK_activation_sparse(x, k)
         result = torch.zeros_like(x)
-        result.scatter_(-1, topk.indices, values)
+        result.scatter_(-1, indices, values)
         return result
 
+    def topK_activation_sparse(self, x: torch.Tensor, k: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Apply top-k activation to the input tensor, keeping the result in sparse form.
+
+        Args:
+            x: (..., D_HIDDEN) input tensor to apply top-k activation on.
+            k: Number of top activations to keep.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: A tuple containing:
+                - (..., k) indices of the top k hidden dims (in no particular order).
+                - (..., k) ReLU-activated values of those hidden dims.
+        """
+        topk = torch.topk(x, k=k, dim=-1, sorted=False)
+        return topk.indices, F.relu(topk.values)
+
+    @torch.no_grad()
+    def build_approx_topk(self, rank: int = 128, n_candidates: Optional[int] = None) -> None:
+        """
+        Prepare approximate top-k by factorizing w_enc with a truncated SVD. Must be rebuilt
+        if the weights change.
+
+        Args:
+            rank: Rank of the projection used to score candidate hidden dims.
+            n_candidates: Number of candidate hidden dims per token that get exact
+                pre-activations. Defaults to 4 * k.
+        """
+        U, S, Vh = torch.linalg.svd(self.w_enc.float(), full_matrices=False)
+        self.approx_proj = (U[:, :rank] * S[:rank]).to(self.w_enc.dtype)
+        self.approx_basis = Vh[:rank].to(self.w_enc.dtype)
+        self.approx_n_candidates = n_candidates if n_candidates is not None else 4 * self.k
+
+    def approx_topK_activation_sparse(
+        self, x: torch.Tensor, k: int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Approximate top-k activation in two stages:
+        1. Score all hidden dims with the rank-r factorization of w_enc, which costs
+            O(r * D_HIDDEN) per token instead of O(D_MODEL * D_HIDDEN), and keep the best
+            n_candidates.
+        2. Compute exact pre-activations for the candidates only and take the top k.
+
+        Args:
+            x: (..., D_MODEL) normalized input with b_pre subtracted.
+            k: Number of top activations to keep.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Same as topK_activation_sparse.
+        """
+        if self.approx_proj is None:
+            raise ValueError("Approximate top-k is not set up, run build_approx_topk first")
+        approx_pre_acts = (x @ self.approx_proj) @ self.approx_basis + self.b_enc
+        candidates = torch.topk(
+            approx_pre_acts, k=self.approx_n_candidates, dim=-1, sorted=False
+        ).indices
+
+        flat_x = x.reshape(-1, self.d_model)
+        flat_candidates = candidates.reshape(-1, self.approx_n_candidates)
+        pre_acts = torch.empty(flat_candidates.shape, dtype=x.dtype, device=x.device)
+        # Gather the candidates' columns of w_enc through a transposed view, without a copy
+        w_enc_t = self.w_enc.t()
+        chunk_size = max(1, SPARSE_DECODE_CHUNK_SIZE // (self.approx_n_candidates * self.d_model))
+        for start in range(0, len(flat_x), chunk_size):
+            end = start + chunk_size
+            rows = w_enc_t[flat_candidates[start:end]]
+            pre_acts[start:end] = torch.bmm(rows, flat_x[start:end].unsqueeze(-1)).squeeze(-1)
+        pre_acts = pre_acts.view(candidates.shape) + self.b_enc[candidates]
+
+        topk = torch.topk(pre_acts, k=k, dim=-1, sorted=False)
+        return candidates.gather(-1, topk.indices), F.relu(topk.values)
+
+    def threshold_activation(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Apply per hidden dim thresholds to the input tensor (JumpReLU). This is elementwise,
+        so unlike top-k it needs no sort over D_HIDDEN, but the number of active hidden dims
+        per token is no longer fixed at k.
+
+        Args:
+            x: (..., D_HIDDEN) input tensor to apply the thresholds on.
+
+        Returns:
+            torch.Tensor: Tensor with values at or below their hidden dim's threshold set
+            to zero.
+        """
+        if self.thresholds is None:
+            raise ValueError("Thresholds are not set, run calibrate_thresholds first")
+        return x.masked_fill(x <= self.thresholds, 0)
+
     def LN(
         self, x: torch.Tensor, eps: float = 1e-5
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -111,84 +295,156 @@ class SparseAutoencoder(nn.Module):
             torch.Tensor: A boolean tensor of shape (D_HIDDEN,) where True indicates
                 a dead neuron.
         """
-        dead_mask = self.stats_last_nonzero > self.dead_steps_threshold
+        dead_mask = self.stats_last_nonzero > self.dead_tokens_threshold
         return dead_mask
 
-    def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before firing frequency tracking have no firing_freq_ema, and
+        # checkpoints from before tokens_seen was saved start counting again
+        state_dict.setdefault(prefix + "firing_freq_ema", self.firing_freq_ema)
+        if prefix + "tokens_seen" not in state_dict:
+            device = state_dict.get(prefix + "w_enc", self.w_enc).device
+            state_dict[prefix + "tokens_seen"] = torch.zeros((), dtype=torch.long, device=device)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._tokens_seen_host = int(state_dict[prefix + "tokens_seen"])
+
+    def forward(
+        self, x: torch.Tensor, mask: Optional[torch.Tensor] = None
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Forward pass of the Sparse Autoencoder. If there are dead neurons, compute the
         reconstruction using the AUXK auxiliary hidden dims as well.
 
         Args:
             x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+            mask: Optional (BATCH_SIZE, D_EMBED) boolean tensor, True for the tokens to
+                encode, e.g. to skip padding, BOS and EOS. Masked out tokens are not
+                computed, do not count towards the dead neuron statistics and are zero in
+                the outputs.
 
         Returns:
             tuple[torch.Tensor, torch.Tensor, torch.Tensor]: A tuple containing:
                 - The reconstructed activations via top K hidden dims.
-                - If there are dead neurons, the auxiliary activations via top AUXK
-                    hidden dims; otherwise, None.
-                - The number of dead neurons.
+                - Once enough tokens have been seen for neurons to be dead, and some were
+                    at the last check, the auxiliary activations via top AUXK hidden dims;
+                    otherwise, None.
+                - The number of dead neurons, as a 0-dim tensor.
         """
+        if mask is not None:
+            recons, auxk, num_dead = self(x[mask])
+            if auxk is not None:
+                auxk = unmask_tokens(auxk, mask)
+            return unmask_tokens(recons, mask), auxk, num_dead
+
+        x_in = x
         x, mu, std = self.LN(x)
         x = x - self.b_pre
 
         pre_acts = x @ self.w_enc + self.b_enc
 
-        # latents: (BATCH_SIZE, D_EMBED, D_HIDDEN)
-        latents = self.topK_activation(pre_acts, k=self.k)
-
-        # `(latents == 0)` creates a boolean tensor element-wise from `latents`.
-        # `.all(dim=(0, 1))` preserves D_HIDDEN and does the boolean `all`
-        # operation across BATCH_SIZE and D_EMBED. Finally, `.long()` turns
-        # it into a vector of 0s and 1s of length D_HIDDEN.
-        #
-        # self.stats_last_nonzero is a vector of length D_HIDDEN. Doing
-        # `*=` with `M = (latents == 0).all(dim=(0, 1)).long()` has the effect
-        # of: if M[i] = 0, self.stats_last_nonzero[i] is cleared to 0, and then
-        # immediately incremented; if M[i] = 1, self.stats_last_nonzero[i] is
-        # unchanged. self.stats_last_nonzero[i] means "for how many consecutive
-        # iterations has hidden dim i been zero".
-        self.stats_last_nonzero *= (latents == 0).all(dim=(0, 1)).long()
-        self.stats_last_nonzero += 1
+        indices, values = self.topK_activation_sparse(pre_acts, k=self.k)
+
+        # Count how many tokens each hidden dim fired on (was among the top k with a
+        # nonzero value) by scattering from the k indices per token, which avoids a pass
+        # over the dense (BATCH_SIZE, D_EMBED, D_HIDDEN) latents.
+        n_tokens = indices[..., 0].numel()
+        fire_counts = torch.zeros(self.d_hidden, dtype=values.dtype, device=values.device)
+        fire_counts.scatter_add_(0, indices.flatten(), (values > 0).flatten().to(values.dtype))
+
+        # self.stats_last_nonzero[i] means "for how many tokens has hidden dim i been zero".
+        # It is cleared if hidden dim i fired in this batch.
+        self.stats_last_nonzero += n_tokens
+        self.stats_last_nonzero.masked_fill_(fire_counts > 0, 0)
+        self.firing_freq_ema.mul_(self.firing_ema_decay).add_(
+            fire_counts / n_tokens, alpha=1 - self.firing_ema_decay
+        )
+        self.tokens_seen += n_tokens
+        self._tokens_seen_host += n_tokens
 
         dead_mask = self.auxk_mask_fn()
-        num_dead = dead_mask.sum().item()
+        # Left on the device, so it is only synced when read, e.g. by the logger.
+        num_dead = dead_mask.sum()
 
-        recons = latents @ self.w_dec + self.b_pre
-        recons = recons * std + mu
+        recons = self.decode_sparse(indices, values, mu, std)
 
-        if num_dead > 0:
-            k_aux = min(x.shape[-1] // 2, num_dead)
+        # No hidden dim can be dead before dead_tokens_threshold tokens have been seen.
+        # After that, whether any is dead is read back from the device every
+        # dead_check_interval steps, rather than every step, which would stall on the sync.
+        # Selected hidden dims that are not dead have -inf pre-activations, so ReLU zeroes
+        # them out.
+        if self._tokens_seen_host > self.dead_tokens_threshold:
+            if self._steps_until_dead_check == 0:
+                self._has_dead = bool(num_dead > 0)
+                self._steps_until_dead_check = self.dead_check_interval
+            self._steps_until_dead_check -= 1
 
-            auxk_latents = torch.where(dead_mask[None], pre_acts, -torch.inf)
-            auxk_acts = self.topK_activation(auxk_latents, k=k_aux)
+        if self._tokens_seen_host > self.dead_tokens_threshold and self._has_dead:
+            k_aux = min(x.shape[-1] // 2, self.d_hidden)
 
-            auxk = auxk_acts @ self.w_dec + self.b_pre
-            auxk = auxk * std + mu
+            auxk_latents = torch.where(dead_mask, pre_acts, -torch.inf)
+            auxk_indices, auxk_values = self.topK_activation_sparse(auxk_latents, k=k_aux)
+            auxk = self.decode_sparse(auxk_indices, auxk_values, mu, std)
+            # If nothing is dead since the last check, make the auxiliary loss exactly zero.
+            auxk = torch.where(num_dead > 0, auxk, (x_in - recons).detach())
         else:
             auxk = None
 
         return recons, auxk, num_dead
 
     @torch.no_grad()
-    def forward_val(self, x: torch.Tensor) -> torch.Tensor:
+    def forward_val(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Forward pass of the Sparse Autoencoder for validation.
 
         Args:
             x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+            mask: Optional (BATCH_SIZE, D_EMBED) boolean tensor of the tokens to encode,
+                as in forward.
 
         Returns:
             torch.Tensor: The reconstructed activations via top K hidden dims.
         """
-        x, mu, std = self.LN(x)
-        x = x - self.b_pre
-        pre_acts = x @ self.w_enc + self.b_enc
-        latents = self.topK_activation(pre_acts, self.k)
+        if mask is not None:
+            return unmask_tokens(self.forward_val(x[mask]), mask)
+        indices, values, mu, std = self.encode_sparse(x)
+        return self.decode_sparse(indices, values, mu, std)
 
-        recons = latents @ self.w_dec + self.b_pre
-        recons = recons * std + mu
-        return recons
+    @torch.no_grad()
+    def forward_multi_k(
+        self, x: torch.Tensor, ks: Iterable[int]
+    ) -> dict[int, tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Reconstruct the input keeping only the top k hidden dims, for several values of k,
+        from a single sorted top-k call at the largest k. Each reconstruction adds the next
+        slice of sorted latents to the previous one, so the total decoding work is that of
+        the largest k.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+            ks: Values of k to reconstruct with, e.g. [8, 16, 32, 64, 128].
+
+        Returns:
+            dict[int, tuple[torch.Tensor, torch.Tensor]]: For each k, a tuple containing:
+                - The reconstructed activations via top k hidden dims.
+                - The MSE of the reconstruction.
+        """
+        ks = sorted(set(ks))
+        x_norm, mu, std = self.LN(x)
+        pre_acts = (x_norm - self.b_pre) @ self.w_enc + self.b_enc
+        topk = torch.topk(pre_acts, k=ks[-1], dim=-1, sorted=True)
+        values = F.relu(topk.values)
+
+        results = {}
+        decoded = torch.zeros_like(x)
+        prev_k = 0
+        for k in ks:
+            decoded = decoded + SparseDecode.apply(
+                topk.indices[..., prev_k:k], values[..., prev_k:k], self.w_dec
+            )
+            prev_k = k
+            recons = (decoded + self.b_pre) * std + mu
+            results[k] = (recons, F.mse_loss(recons, x))
+        return results
 
     @torch.no_grad()
     def norm_weights(self) -> None:
@@ -206,21 +462,64 @@ class SparseAutoencoder(nn.Module):
         self.w_dec.grad.sub_(self.w_dec.data * dot_products.unsqueeze(0))
 
     @torch.no_grad()
-    def get_acts(self, x: torch.Tensor) -> torch.Tensor:
+    def get_acts(
+        self,
+        x: torch.Tensor,
+        use_thresholds: Optional[bool] = None,
+        approx: bool = False,
+        mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         """
         Get the activations of the Sparse Autoencoder.
 
         Args:
             x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+            use_thresholds: Whether to use the calibrated thresholds instead of top-k.
+                Defaults to self.use_thresholds.
+            approx: Whether to use approximate top-k, see build_approx_topk.
+            mask: Optional (BATCH_SIZE, D_EMBED) boolean tensor of the tokens to encode,
+                as in forward.
 
         Returns:
             torch.Tensor: The activations of the Sparse Autoencoder.
         """
+        if mask is not None:
+            return unmask_tokens(self.get_acts(x[mask], use_thresholds, approx), mask)
         x, _, _ = self.LN(x)
         x = x - self.b_pre
+        if approx:
+            indices, values = self.approx_topK_activation_sparse(x, self.k)
+            latents = torch.zeros(*x.shape[:-1], self.d_hidden, dtype=x.dtype, device=x.device)
+            return self.expand_latents(latents.scatter_(-1, indices, values))
         pre_acts = x @ self.w_enc + self.b_enc
-        latents = self.topK_activation(pre_acts, self.k)
-        return latents
+        return self._activate(pre_acts, use_thresholds)
+
+    def _activate(self, pre_acts: torch.Tensor, use_thresholds: Optional[bool]) -> torch.Tensor:
+        if use_thresholds is None:
+            use_thresholds = self.use_thresholds
+        if use_thresholds:
+            return self.expand_latents(self.threshold_activation(pre_acts))
+        return self.expand_latents(self.topK_activation(pre_acts, self.k))
+
+    def expand_latents(self, latents: torch.Tensor) -> torch.Tensor:
+        """
+        For an SAE with dead hidden dims stripped, scatter (..., D_HIDDEN) latents back to
+        (..., D_HIDDEN_FULL) so they are keyed by the original hidden dims. Otherwise, return
+        the latents unchanged.
+        """
+        if self.latent_ids is None:
+            return latents
+        full_latents = latents.new_zeros(*latents.shape[:-1], self.d_hidden_full)
+        return full_latents.index_copy_(latents.dim() - 1, self.latent_ids, latents)
+
+    def original_latent_ids(self, indices: torch.Tensor) -> torch.Tensor:
+        """
+        Map hidden dim indices, e.g. from encode_sparse, to the original hidden dims of an
+        SAE with dead hidden dims stripped.
+        """
+        if self.latent_ids is None:
+            return indices
+        return self.latent_ids[indices]
 
     @torch.no_grad()
     def encode(self, x: torch.Tensor) -> torch.Tensor:
@@ -230,16 +529,725 @@ class SparseAutoencoder(nn.Module):
         return acts, mu, std
 
     @torch.no_grad()
-    def decode(self, acts: torch.Tensor, mu: torch.Tensor, std: torch.Tensor) -> torch.Tensor:
-        latents = self.topK_activation(acts, self.k)
+    def decode(
+        self,
+        acts: torch.Tensor,
+        mu: torch.Tensor,
+        std: torch.Tensor,
+        use_thresholds: Optional[bool] = None,
+    ) -> torch.Tensor:
+        if use_thresholds is None:
+            use_thresholds = self.use_thresholds
+        if use_thresholds:
+            latents = self.threshold_activation(acts)
+            recons = latents @ self.w_dec + self.b_pre
+            return recons * std + mu
+
+        indices, values = self.topK_activation_sparse(acts, self.k)
+        return self.decode_sparse(indices, values, mu, std)
+
+    def encode_sparse(
+        self, x: torch.Tensor, approx: bool = False
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Encode the input into top-k latents without materializing the dense
+        (BATCH_SIZE, D_EMBED, D_HIDDEN) latent tensor.
 
-        recons = latents @ self.w_dec + self.b_pre
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+            approx: Whether to use approximate top-k, see build_approx_topk.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: A tuple containing:
+                - (BATCH_SIZE, D_EMBED, K) indices of the active hidden dims.
+                - (BATCH_SIZE, D_EMBED, K) activations of those hidden dims.
+                - The mean of the input tensor, for decode_sparse.
+                - The standard deviation of the input tensor, for decode_sparse.
+        """
+        x, mu, std = self.LN(x)
+        x = x - self.b_pre
+        if approx:
+            indices, values = self.approx_topK_activation_sparse(x, self.k)
+        else:
+            pre_acts = x @ self.w_enc + self.b_enc
+            indices, values = self.topK_activation_sparse(pre_acts, self.k)
+        return indices, values, mu, std
+
+    def decode_sparse(
+        self,
+        indices: torch.Tensor,
+        values: torch.Tensor,
+        mu: torch.Tensor,
+        std: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Reconstruct the input from sparse latents, gathering only the selected rows of
+        w_dec. Supports autograd, so it can be used for training as well as inference.
+
+        Args:
+            indices: (BATCH_SIZE, D_EMBED, K) indices of the active hidden dims.
+            values: (BATCH_SIZE, D_EMBED, K) activations of those hidden dims.
+            mu: The mean returned by encode_sparse.
+            std: The standard deviation returned by encode_sparse.
+
+        Returns:
+            torch.Tensor: (BATCH_SIZE, D_EMBED, D_MODEL) reconstructed activations.
+        """
+        recons = SparseDecode.apply(indices, values, self.w_dec) + self.b_pre
         recons = recons * std + mu
         return recons
 
+    @torch.no_grad()
+    def compact(self, alive: torch.Tensor) -> "SparseAutoencoder":
+        """
+        Make a copy of the SAE that keeps only the given hidden dims. Its get_acts output
+        is still keyed by the original hidden dims, and matches this SAE's as long as the
+        stripped hidden dims never fire.
+
+        Args:
+            alive: (D_HIDDEN,) boolean mask of the hidden dims to keep.
+
+        Returns:
+            SparseAutoencoder: The compacted SAE.
+        """
+        ids = alive.nonzero().squeeze(-1)
+        if len(ids) < self.k:
+            raise ValueError(f"Need at least k={self.k} hidden dims to keep, got {len(ids)}")
+
+        sae = SparseAutoencoder(
+            self.d_model,
+            len(ids),
+            k=self.k,
+            auxk=self.auxk,
+            dead_tokens_threshold=self.dead_tokens_threshold,
+            firing_ema_decay=self.firing_ema_decay,
+            dead_check_interval=self.dead_check_interval,
+        ).to(self.w_enc.device)
+        sae.w_enc.copy_(self.w_enc[:, ids])
+        sae.w_dec.copy_(self.w_dec[ids])
+        sae.b_enc.copy_(self.b_enc[ids])
+        sae.b_pre.copy_(self.b_pre)
+        sae.stats_last_nonzero.copy_(self.stats_last_nonzero[ids])
+        sae.firing_freq_ema.copy_(self.firing_freq_ema[ids])
+        sae.tokens_seen.copy_(self.tokens_seen)
+        sae._tokens_seen_host = self._tokens_seen_host
+        sae.latent_ids = self.original_latent_ids(ids)
+        sae.d_hidden_full = self.d_hidden_full
+        sae.plm_name, sae.layer = self.plm_name, self.layer
+        return sae
+
+    def save_compact(self, path: str) -> None:
+        """
+        Save an SAE made by compact, along with what from_compact needs to rebuild it.
+        """
+        config = {
+            "d_model": self.d_model,
+            "d_hidden": self.d_hidden,
+            "d_hidden_full": self.d_hidden_full,
+            "k": self.k,
+        }
+        torch.save({"config": config, "state_dict": self.state_dict()}, path)
+
+    @classmethod
+    def from_compact(cls, path: str, map_location=None) -> "SparseAutoencoder":
+        """
+        Load an SAE saved with save_compact.
+        """
+        return cls._from_compact_checkpoint(torch.load(path, map_location=map_location))
+
+    @classmethod
+    def _from_compact_checkpoint(cls, checkpoint: dict) -> "SparseAutoencoder":
+        config = checkpoint["config"]
+        sae = cls(config["d_model"], config["d_hidden"], k=config["k"])
+        # latent_ids must be set before load_state_dict for it to be loaded
+        sae.latent_ids = checkpoint["state_dict"]["latent_ids"]
+        sae.d_hidden_full = config["d_hidden_full"]
+        sae.load_state_dict(checkpoint["state_dict"])
+        return sae.to(sae.latent_ids.device)
+
+    def save_pretrained(
+        self, path: str, layer: Optional[int] = None, plm_name: Optional[str] = None
+    ) -> None:
+        """
+        Save the SAE as a self-describing safetensors checkpoint that from_pretrained can
+        load with no other information.
+
+        Args:
+            path: Path to save the checkpoint to, ending in .safetensors.
+            layer: The pLM layer the SAE reads. Defaults to self.layer.
+            plm_name: The HuggingFace name of the pLM the SAE reads. Defaults to
+                self.plm_name.
+        """
+        layer = layer if layer is not None else self.layer
+        plm_name = plm_name if plm_name is not None else self.plm_name
+        if layer is None or plm_name is None:
+            raise ValueError("The layer and pLM name must be known to save a checkpoint")
+
+        metadata = {
+            "d_model": str(self.d_model),
+            "d_hidden": str(self.d_hidden),
+            "d_hidden_full": str(self.d_hidden_full),
+            "k": str(self.k),
+            "layer": str(layer),
+            "plm_name": plm_name,
+        }
+        tensors = {name: t.contiguous() for name, t in self.state_dict().items()}
+        save_file(tensors, path, metadata=metadata)
+
+    @classmethod
+    def from_pretrained(
+        cls, path: str, device: Union[str, torch.device] = "cpu"
+    ) -> "SparseAutoencoder":
+        """
+        Load an SAE saved with save_pretrained. The weights are read straight onto device,
+        without first initializing a model that is then overwritten.
+        """
+        with safe_open(path, framework="pt") as f:
+            metadata = f.metadata()
+
+        # Build on the meta device so no memory is allocated for weights that are about to
+        # be replaced by the ones in the file.
+        with torch.device("meta"):
+            sae = cls(int(metadata["d_model"]), int(metadata["d_hidden"]), k=int(metadata["k"]))
+        state_dict = load_file(path, device=str(device))
+        if "latent_ids" in state_dict:
+            sae.latent_ids = state_dict["latent_ids"]
+        sae.load_state_dict(state_dict, assign=True)
+
+        sae.d_hidden_full = int(metadata["d_hidden_full"])
+        sae.layer = int(metadata["layer"])
+        sae.plm_name = metadata["plm_name"]
+        return sae
+
+    @classmethod
+    def from_checkpoint(cls, path: str, map_location=None) -> "SparseAutoencoder":
+        """
+        Load an SAE from any checkpoint format:
+        - a .safetensors checkpoint from save_pretrained
+        - a compact checkpoint from save_compact
+        - a Lightning checkpoint from training.py
+        - a plain state dict
+
+        For the formats without metadata, the dims are read from the weights, and k and the
+        layer from the training hyperparameters if the checkpoint has them.
+        """
+        if str(path).endswith(".safetensors"):
+            return cls.from_pretrained(path, device=map_location or "cpu")
+
+        checkpoint = torch.load(path, map_location=map_location, mmap=True, weights_only=False)
+        if "config" in checkpoint:
+            return cls._from_compact_checkpoint(checkpoint)
+
+        args = None
+        if "state_dict" in checkpoint:
+            args = checkpoint.get("hyper_parameters", {}).get("args")
+            state_dict = {
+                k.removeprefix("sae_model."): v
+                for k, v in checkpoint["state_dict"].items()
+                if k.startswith("sae_model.")
+            }
+        else:
+            state_dict = checkpoint
+
+        d_model, d_hidden = state_dict["w_enc"].shape
+        sae = cls(d_model, d_hidden, k=args.k if args is not None else 128)
+        sae.load_state_dict(state_dict)
+        if args is not None:
+            sae.layer = args.layer_to_use
+        return sae.to(state_dict["w_enc"].device)
+
+    @torch.no_grad()
+    def calibrate_thresholds(
+        self,
+        batches: Iterable[torch.Tensor],
+        n_bins: int = 256,
+        max_act: Optional[float] = None,
+    ) -> torch.Tensor:
+        """
+        Calibrate per hidden dim thresholds that reproduce top-k on a reference corpus, and
+        store them in self.thresholds.
+
+        For each hidden dim, histograms of its positive pre-activations are accumulated
+        separately for tokens where top-k keeps it and for all tokens. The threshold is the
+        bin edge that minimizes the number of tokens on which thresholding and top-k disagree
+        about whether the hidden dim is active. Ties go to the higher threshold, so hidden
+        dims that never fire in the corpus do not fire at inference either.
+
+        Each hidden dim's histogram spans 0 to the largest pre-activation seen so far. When
+        a batch exceeds it, the range is doubled as many times as needed and pairs of bins
+        are merged, so the batches are only read once and can come one protein at a time.
+
+        Args:
+            batches: Iterable of (..., D_MODEL) pLM activations from the reference corpus.
+            n_bins: Number of histogram bins of each hidden dim.
+            max_act: Initial upper edge of the histograms. Defaults to each hidden dim's
+                largest pre-activation in the first batch it is positive in.
+
+        Returns:
+            torch.Tensor: (D_HIDDEN,) calibrated thresholds.
+        """
+        device = self.w_enc.device
+        all_hist = torch.zeros(self.d_hidden, n_bins, dtype=torch.long, device=device)
+        selected_hist = torch.zeros_like(all_hist)
+        # Upper edge of each hidden dim's histogram, 0 until it has a positive pre-activation
+        ranges = torch.full((self.d_hidden,), float(max_act or 0), device=device)
+        bin_ids = torch.arange(n_bins, device=device)
+        dim_offsets = torch.arange(self.d_hidden, device=device) * n_bins
+        seen_batches = False
+
+        for x in batches:
+            seen_batches = True
+            x, _, _ = self.LN(x.to(device))
+            x = x - self.b_pre
+            pre_acts = (x @ self.w_enc + self.b_enc).reshape(-1, self.d_hidden)
+
+            batch_max = pre_acts.max(dim=0).values
+            grow = (ranges > 0) & (batch_max > ranges)
+            if grow.any():
+                n_doublings = torch.zeros(self.d_hidden, dtype=torch.long, device=device)
+                n_doublings[grow] = torch.log2(batch_max[grow] / ranges[grow]).ceil().long()
+                factor = 2**n_doublings
+                new_bins = (bin_ids[None, :] // factor[:, None]).expand_as(all_hist)
+                all_hist = torch.zeros_like(all_hist).scatter_add_(1, new_bins, all_hist)
+                selected_hist = torch.zeros_like(selected_hist).scatter_add_(
+                    1, new_bins, selected_hist
+                )
+                ranges = ranges * factor
+            ranges = torch.where((ranges == 0) & (batch_max > 0), batch_max, ranges)
+            scale = n_bins / ranges.clamp(min=1e-12)
+
+            indices, values = self.topK_activation_sparse(pre_acts, self.k)
+            selected = values > 0
+            selected_bins = (values * scale[indices]).long().clamp_(0, n_bins - 1)
+            selected_hist.view(-1).add_(
+                torch.bincount(
+                    (selected_bins + indices * n_bins)[selected],
+                    minlength=selected_hist.numel(),
+                )
+            )
+
+            chunk_size = max(1, THRESHOLD_CALIBRATION_CHUNK_SIZE // self.d_hidden)
+            for chunk in pre_acts.split(chunk_size):
+                positive = chunk > 0
+                bins = (chunk * scale).long().clamp_(0, n_bins - 1)
+                all_hist.view(-1).add_(
+                    torch.bincount((bins + dim_offsets)[positive], minlength=all_hist.numel())
+                )
+
+        if not seen_batches:
+            raise ValueError("No batches to calibrate thresholds on")
+
+        unselected_hist = all_hist - selected_hist
+
+        # For a threshold at the lower edge of bin b, top-k activations in bins < b are
+        # missed and non-top-k activations in bins >= b are false positives.
+        zeros = torch.zeros(self.d_hidden, 1, dtype=torch.long, device=device)
+        missed = torch.cat([zeros, selected_hist.cumsum(dim=1)], dim=1)
+        unselected_cumsum = torch.cat([zeros, unselected_hist.cumsum(dim=1)], dim=1)
+        false_positives = unselected_cumsum[:, -1:] - unselected_cumsum
+        errors = missed + false_positives
+
+        # argmin returns the first minimum, so flip to break ties towards higher thresholds.
+        best_bin = n_bins - errors.flip(dims=[1]).argmin(dim=1)
+        thresholds = ranges * best_bin / n_bins
+        # Hidden dims that were never positive don't fire below the largest range
+        self.thresholds = torch.where(ranges > 0, thresholds, ranges.max())
+        return self.thresholds
+
+    def load_thresholds(self, path: str) -> None:
+        """
+        Load thresholds saved from calibrate_thresholds and switch get_acts and decode to
+        threshold-based inference.
+        """
+        thresholds = torch.load(path, map_location=self.w_enc.device)
+        if thresholds.shape != (self.d_hidden,):
+            raise ValueError(
+                f"Expected thresholds of shape ({self.d_hidden},), got {tuple(thresholds.shape)}"
+            )
+        self.thresholds = thresholds
+        self.use_thresholds = True
+
+    @torch.no_grad()
+    def approx_topk_recall(self, x: torch.Tensor) -> float:
+        """
+        Fraction of the exact top-k activations that approximate top-k also finds.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+        """
+        exact_indices, exact_values, _, _ = self.encode_sparse(x)
+        approx_indices, approx_values, _, _ = self.encode_sparse(x, approx=True)
+        matches = exact_indices.unsqueeze(-1) == approx_indices.unsqueeze(-2)
+        found = (matches & (approx_values > 0).unsqueeze(-2)).any(dim=-1)
+        exact_active = exact_values > 0
+        return ((found & exact_active).sum() / exact_active.sum().clamp(min=1)).item()
+
+    @torch.no_grad()
+    def latent_overlap(self, x: torch.Tensor, x_other: torch.Tensor) -> float:
+        """
+        Fraction of the top-k activations of x whose hidden dims are also active for
+        x_other, e.g. to check that pLM activations from an optimized pLM encode to the
+        same latents as those of the original.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) reference input tensor to the SAE.
+            x_other: Input tensor of the same shape to compare against x.
+        """
+        indices, values, _, _ = self.encode_sparse(x)
+        other_indices, other_values, _, _ = self.encode_sparse(x_other)
+        matches = indices.unsqueeze(-1) == other_indices.unsqueeze(-2)
+        found = (matches & (other_values > 0).unsqueeze(-2)).any(dim=-1)
+        active = values > 0
+        return ((found & active).sum() / active.sum().clamp(min=1)).item()
+
+    @torch.no_grad()
+    def threshold_parity(self, x: torch.Tensor) -> dict[str, float]:
+        """
+        Compare threshold-based activations against exact top-k activations.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+
+        Returns:
+            dict[str, float]: A dictionary containing:
+                - precision: Fraction of threshold activations that top-k also keeps.
+                - recall: Fraction of top-k activations that thresholding also keeps.
+                - l0_topk, l0_threshold: Mean number of active hidden dims per token.
+                - rel_act_error: Squared error of the activations relative to top-k.
+                - mse_topk, mse_threshold: Reconstruction MSE of each mode.
+        """
+        x_norm, mu, std = self.LN(x)
+        pre_acts = (x_norm - self.b_pre) @ self.w_enc + self.b_enc
+        topk_latents = self.topK_activation(pre_acts, self.k)
+        threshold_latents = self.threshold_activation(pre_acts)
+
+        topk_active = topk_latents > 0
+        threshold_active = threshold_latents > 0
+        n_both = (topk_active & threshold_active).sum().item()
+        n_tokens = topk_active[..., 0].numel()
+
+        def mse(latents: torch.Tensor) -> float:
+            recons = (latents @ self.w_dec + self.b_pre) * std + mu
+            return F.mse_loss(recons, x).item()
+
+        return {
+            "precision": n_both / max(threshold_active.sum().item(), 1),
+            "recall": n_both / max(topk_active.sum().item(), 1),
+            "l0_topk": topk_active.sum().item() / n_tokens,
+            "l0_threshold": threshold_active.sum().item() / n_tokens,
+            "rel_act_error": (
+                (threshold_latents - topk_latents).pow(2).sum()
+                / topk_latents.pow(2).sum().clamp(min=1e-12)
+            ).item(),
+            "mse_topk": mse(topk_latents),
+            "mse_threshold": mse(threshold_latents),
+        }
+
+
+class MultiSAE(nn.Module):
+    LN = SparseAutoencoder.LN
+    topK_activation_sparse = SparseAutoencoder.topK_activation_sparse
+
+    def __init__(self, saes: dict[str, SparseAutoencoder], layers: dict[str, int]):
+        """
+        Several Sparse Autoencoders over the same pLM, encoded together so one pLM pass can
+        serve all of them. Only the encoders are kept, so the SAEs can be freed afterwards.
+
+        SAEs reading the same layer share a single LN and a single encoder matmul against
+        their concatenated w_enc. This works because b_pre can be folded into the encoder
+        bias: (x - b_pre) @ w_enc + b_enc = x @ w_enc + (b_enc - b_pre @ w_enc).
+
+        Args:
+            saes: SAEs by name. Names must be valid module names.
+            layers: The pLM layer each SAE reads, by name.
+        """
+        super().__init__()
+        self.layers = layers
+        self.k = {name: sae.k for name, sae in saes.items()}
+        self.d_hidden_full = {name: sae.d_hidden_full for name, sae in saes.items()}
+        self.use_thresholds = {name: sae.use_thresholds for name, sae in saes.items()}
+        for name, sae in saes.items():
+            self.register_buffer(f"latent_ids_{name}", sae.latent_ids)
+            self.register_buffer(f"thresholds_{name}", sae.thresholds)
+
+        # For each layer, the (name, start, end) slice of the fused hidden dims of each SAE
+        self.groups: dict[int, list[tuple[str, int, int]]] = {}
+        for layer in sorted(set(layers[name] for name in saes)):
+            names = [name for name in saes if layers[name] == layer]
+            if len(set(saes[name].d_model for name in names)) > 1:
+                raise ValueError(f"SAEs at layer {layer} have different d_model")
+
+            members = []
+            offset = 0
+            for name in names:
+                members.append((name, offset, offset + saes[name].d_hidden))
+                offset += saes[name].d_hidden
+            self.groups[layer] = members
+
+            with torch.no_grad():
+                # A lone SAE's w_enc is shared rather than copied
+                if len(names) == 1:
+                    w_enc = saes[names[0]].w_enc.detach()
+                else:
+                    w_enc = torch.cat([saes[name].w_enc for name in names], dim=1)
+                b_enc = torch.cat(
+                    [saes[name].b_enc - saes[name].b_pre @ saes[name].w_enc for name in names]
+                )
+            self.register_buffer(f"w_enc_l{layer}", w_enc)
+            self.register_buffer(f"b_enc_l{layer}", b_enc)
+
+    def _pre_acts(self, layer_acts: dict[int, torch.Tensor]) -> Iterator[tuple[str, torch.Tensor]]:
+        """
+        The pre-activations of each SAE, by name, one fused matmul per layer.
+        """
+        for layer, members in self.groups.items():
+            x, _, _ = self.LN(layer_acts[layer])
+            pre_acts = x @ getattr(self, f"w_enc_l{layer}") + getattr(self, f"b_enc_l{layer}")
+            for name, start, end in members:
+                yield name, pre_acts[..., start:end]
+
+    @torch.no_grad()
+    def encode_sparse(
+        self, layer_acts: dict[int, torch.Tensor]
+    ) -> dict[str, tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Encode pLM activations through all SAEs.
+
+        Args:
+            layer_acts: (BATCH_SIZE, D_EMBED, D_MODEL) pLM activations by layer, covering
+                every layer in self.groups.
+
+        Returns:
+            dict[str, tuple[torch.Tensor, torch.Tensor]]: For each SAE, the indices and
+                values of its top-k activations, as returned by
+                SparseAutoencoder.topK_activation_sparse. For a compacted SAE, the indices
+                are its original hidden dims, see SparseAutoencoder.original_latent_ids.
+        """
+        results = {}
+        for name, pre_acts in self._pre_acts(layer_acts):
+            indices, values = self.topK_activation_sparse(pre_acts, self.k[name])
+            latent_ids = getattr(self, f"latent_ids_{name}")
+            if latent_ids is not None:
+                indices = latent_ids[indices]
+            results[name] = (indices, values)
+        return results
+
+    @torch.no_grad()
+    def get_acts(self, layer_acts: dict[int, torch.Tensor]) -> dict[str, torch.Tensor]:
+        """
+        Like encode_sparse, but returns the (BATCH_SIZE, D_EMBED, D_HIDDEN_FULL) dense
+        activations of each SAE, as SparseAutoencoder.get_acts does. SAEs with calibrated
+        thresholds in use at construction use them instead of top-k.
+        """
+        results = {}
+        for name, pre_acts in self._pre_acts(layer_acts):
+            if self.use_thresholds[name]:
+                latents = pre_acts.masked_fill(pre_acts <= getattr(self, f"thresholds_{name}"), 0)
+            else:
+                indices, values = self.topK_activation_sparse(pre_acts, self.k[name])
+                latents = torch.zeros_like(pre_acts).scatter_(-1, indices, values)
+            latent_ids = getattr(self, f"latent_ids_{name}")
+            if latent_ids is not None:
+                full_latents = latents.new_zeros(*latents.shape[:-1], self.d_hidden_full[name])
+                latents = full_latents.index_copy_(latents.dim() - 1, latent_ids, latents)
+            results[name] = latents
+        return results
+
+
+class QuantizedSAE(nn.Module):
+    QUANTIZED_DTYPES = {
+        "int8": torch.int8,
+        "float16": torch.float16,
+        "bfloat16": torch.bfloat16,
+    }
+
+    LN = SparseAutoencoder.LN
+    expand_latents = SparseAutoencoder.expand_latents
+    original_latent_ids = SparseAutoencoder.original_latent_ids
+
+    def __init__(self, sae: SparseAutoencoder, dtype: str = "int8"):
+        """
+        Inference-only copy of a Sparse Autoencoder with its weights stored in a smaller
+        dtype, to cut the memory traffic of get_acts. Only top-k activation is supported.
+
+        b_pre is folded into the encoder bias as in MultiSAE, so the encoder is a single
+        linear layer on the normalized input. With int8, the encoder is a dynamically
+        quantized linear layer with one scale per hidden dim (column of w_enc), and w_dec
+        is stored as int8 rows with one scale per row, so decoding only dequantizes the
+        k rows each token selects. int8 runs on CPU only; float16 and bfloat16 simply
+        cast the weights and run on any device.
+
+        Args:
+            sae: The SAE to quantize.
+            dtype: One of "int8", "float16" or "bfloat16".
+        """
+        super().__init__()
+        if dtype not in self.QUANTIZED_DTYPES:
+            raise ValueError(f"dtype must be one of {list(self.QUANTIZED_DTYPES)}, got {dtype}")
+        self.dtype = dtype
+        self.d_model = sae.d_model
+        self.d_hidden = sae.d_hidden
+        self.d_hidden_full = sae.d_hidden_full
+        self.k = sae.k
+        self.register_buffer(
+            "latent_ids", sae.latent_ids.clone() if sae.latent_ids is not None else None
+        )
+
+        with torch.no_grad():
+            w_enc = sae.w_enc.float()
+            b_enc = sae.b_enc.float() - sae.b_pre.float() @ w_enc
+            w_dec = sae.w_dec.float()
+            if dtype == "int8":
+                enc_scale = (w_enc.abs().amax(dim=0) / 127).clamp(min=1e-12)
+                q_w_enc = torch.quantize_per_channel(
+                    w_enc.T.contiguous().cpu(),
+                    enc_scale.double().cpu(),
+                    torch.zeros(self.d_hidden, dtype=torch.long),
+                    axis=0,
+                    dtype=torch.qint8,
+                )
+                self.encoder = torch.ao.nn.quantized.dynamic.Linear(
+                    self.d_model, self.d_hidden, dtype=torch.qint8
+                )
+                self.encoder.set_weight_bias(q_w_enc, b_enc.cpu())
+
+                dec_scale = (w_dec.abs().amax(dim=1) / 127).clamp(min=1e-12)
+                w_dec = torch.round(w_dec / dec_scale.unsqueeze(1)).to(torch.int8)
+            else:
+                self.register_buffer("w_enc_t", w_enc.T.contiguous().to(self.torch_dtype))
+                self.register_buffer("b_enc", b_enc.to(self.torch_dtype))
+                dec_scale = None
+            self.register_buffer("w_dec", w_dec.to(self.torch_dtype))
+            self.register_buffer("dec_scale", dec_scale)
+            self.register_buffer("b_pre", sae.b_pre.detach().float().clone())
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        return self.QUANTIZED_DTYPES[self.dtype]
+
+    @torch.no_grad()
+    def encode_sparse(
+        self, x: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Like SparseAutoencoder.encode_sparse, with the quantized encoder.
+        """
+        x, mu, std = self.LN(x.float())
+        if self.dtype == "int8":
+            pre_acts = self.encoder(x)
+        else:
+            pre_acts = F.linear(x.to(self.torch_dtype), self.w_enc_t, self.b_enc).float()
+        values, indices = torch.topk(pre_acts, self.k, dim=-1)
+        return indices, F.relu(values), mu, std
+
+    @torch.no_grad()
+    def decode_sparse(
+        self,
+        indices: torch.Tensor,
+        values: torch.Tensor,
+        mu: torch.Tensor,
+        std: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Like SparseAutoencoder.decode_sparse, dequantizing only the selected rows of w_dec.
+        """
+        k = indices.shape[-1]
+        flat_indices = indices.reshape(-1, k)
+        flat_values = values.reshape(-1, k).float()
+        if self.dec_scale is not None:
+            flat_values = flat_values * self.dec_scale[flat_indices]
+
+        recons = flat_values.new_empty(flat_indices.shape[0], self.d_model)
+        chunk_size = max(1, SPARSE_DECODE_CHUNK_SIZE // (k * self.d_model))
+        for start in range(0, flat_indices.shape[0], chunk_size):
+            end = start + chunk_size
+            rows = self.w_dec[flat_indices[start:end]].float()
+            recons[start:end] = torch.bmm(flat_values[start:end].unsqueeze(1), rows).squeeze(1)
+        recons = recons.view(*indices.shape[:-1], self.d_model) + self.b_pre
+        return recons * std + mu
+
+    @torch.no_grad()
+    def forward_val(self, x: torch.Tensor) -> torch.Tensor:
+        return self.decode_sparse(*self.encode_sparse(x))
+
+    @torch.no_grad()
+    def get_acts(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Like SparseAutoencoder.get_acts, with top-k activation.
+        """
+        indices, values, _, _ = self.encode_sparse(x)
+        latents = values.new_zeros(*values.shape[:-1], self.d_hidden)
+        return self.expand_latents(latents.scatter_(-1, indices, values))
+
+    def weight_nbytes(self) -> int:
+        """
+        Number of bytes taken by the encoder and decoder weights.
+        """
+        if self.dtype == "int8":
+            weight = self.encoder.weight()
+            n_enc = weight.int_repr().nbytes + weight.q_per_channel_scales().nbytes
+        else:
+            n_enc = self.w_enc_t.nbytes
+        n_dec = self.w_dec.nbytes + (self.dec_scale.nbytes if self.dec_scale is not None else 0)
+        return n_enc + n_dec
+
+    @torch.no_grad()
+    def parity(self, sae: SparseAutoencoder, x: torch.Tensor) -> dict[str, float]:
+        """
+        Compare the quantized SAE against the SAE it was made from. Both must be on the
+        same device as x.
+
+        Args:
+            sae: The original SAE.
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+
+        Returns:
+            dict[str, float]: A dictionary containing:
+                - index_overlap: Fraction of the original top-k activations whose hidden dim
+                    the quantized SAE also selects.
+                - rel_act_error: Squared error of the dense activations relative to the
+                    original's.
+                - mse, mse_quantized: Reconstruction MSE of each SAE.
+        """
+        x = x.float()
+        indices, values, mu, std = sae.encode_sparse(x)
+        q_indices, q_values, q_mu, q_std = self.encode_sparse(x)
+
+        matches = indices.unsqueeze(-1) == q_indices.unsqueeze(-2)
+        found = (matches & (q_values > 0).unsqueeze(-2)).any(dim=-1)
+        active = values > 0
+
+        latents = values.new_zeros(*values.shape[:-1], sae.d_hidden).scatter_(-1, indices, values)
+        q_latents = q_values.new_zeros(*q_values.shape[:-1], self.d_hidden).scatter_(
+            -1, q_indices, q_values
+        )
+        return {
+            "index_overlap": ((found & active).sum() / active.sum().clamp(min=1)).item(),
+            "rel_act_error": (
+                (q_latents - latents).pow(2).sum() / latents.pow(2).sum().clamp(min=1e-12)
+            ).item(),
+            "mse": F.mse_loss(sae.decode_sparse(indices, values, mu, std), x).item(),
+            "mse_quantized": F.mse_loss(
+                self.decode_sparse(q_indices, q_values, q_mu, q_std), x
+            ).item(),
+        }
+
+
+def unmask_tokens(values: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """
+    Scatter (N_TOKENS, D) values computed on x[mask] back to (*mask.shape, D), with zeros
+    at the masked out tokens.
+    """
+    out = values.new_zeros(*mask.shape, values.shape[-1])
+    out[mask] = values
+    return out
+
 
 def loss_fn(
-    x: torch.Tensor, recons: torch.Tensor, auxk: Optional[torch.Tensor] = None
+    x: torch.Tensor,
+    recons: torch.Tensor,
+    auxk: Optional[torch.Tensor] = None,
+    mask: Optional[torch.Tensor] = None,
 ) -> tuple[torch.Tensor, torch.Tensor]:
     """
     Compute the loss function for the Sparse Autoencoder.
@@ -250,12 +1258,18 @@ def loss_fn(
             hidden dims.
         auxk: (BATCH_SIZE, D_EMBED, D_MODEL) auxiliary activations via top AUXK
             hidden dims. See A.2. in https://arxiv.org/pdf/2406.04093.
+        mask: Optional (BATCH_SIZE, D_EMBED) boolean tensor, True for the tokens to
+            average the losses over.
 
     Returns:
         tuple[torch.Tensor, torch.Tensor]: A tuple containing:
             - The MSE loss.
             - The auxiliary loss.
     """
+    if mask is not None:
+        x, recons = x[mask], recons[mask]
+        auxk = auxk[mask] if auxk is not None else None
+
     mse_scale = 1
     auxk_coeff = 1.0 / 32.0  # TODO: Is this the best coefficient?
 
@@ -3,19 +3,25 @@ from functools import cache
 import esm
 import pytorch_lightning as pl
 import torch
+from data_module import TokenShuffleBuffer
 from esm_wrapper import ESM2Model
 from sae_model import SparseAutoencoder, loss_fn
+from utils import bucket_by_length
 from validation_metrics import diff_cross_entropy
 
 
 @cache
-def get_esm_model(d_model, alphabet, esm2_weight):
+def get_esm_model(d_model, alphabet, esm2_weight, layer_to_use, attn_implementation="esm"):
+    # Only the layers up to layer_to_use are loaded up front. The rest are loaded the
+    # first time logits are needed, i.e. at the first validation step.
     esm2_model = ESM2Model(
             num_layers=33,
             embed_dim=d_model,
             attention_heads=20,
             alphabet=alphabet,
             token_dropout=False,
+            prefix_layers=layer_to_use,
+            attn_implementation=attn_implementation,
         )
     esm2_model.load_esm_ckpt(esm2_weight)
     esm2_model.eval()
@@ -36,23 +42,87 @@ class SAELightningModule(pl.LightningModule):
             d_hidden=args.d_hidden,
             k=args.k,
             auxk=args.auxk,
-            batch_size=args.batch_size,
-            dead_steps_threshold=args.dead_steps_threshold,
+            dead_tokens_threshold=args.dead_tokens_threshold,
         )
         self.alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
         self.validation_step_outputs = []
 
-    def forward(self, x):
-        return self.sae_model(x)
+        # With a shuffle buffer, each training batch yields a varying number of token
+        # batches, each of which is an optimizer step. The buffer is not drained at the end
+        # of an epoch: its tokens are drawn in the next epoch, so that every step runs
+        # inside training_step, through the DDP-wrapped module.
+        self.shuffle_buffer = None
+        if args.shuffle_buffer_tokens:
+            self.shuffle_buffer = TokenShuffleBuffer(
+                args.shuffle_buffer_tokens, args.token_batch_size
+            )
+            self.automatic_optimization = False
+
+    def forward(self, x, mask=None):
+        return self.sae_model(x, mask)
 
     def training_step(self, batch, batch_idx):
-        seqs = batch["Sequence"]
-        batch_size = len(seqs)
-        with torch.no_grad():
-            esm2_model = get_esm_model(self.args.d_model, self.alphabet, self.args.esm2_weight)
-            tokens, esm_layer_acts = esm2_model.get_layer_activations(seqs, self.layer_to_use)
-        recons, auxk, num_dead = self(esm_layer_acts)
-        mse_loss, auxk_loss = loss_fn(esm_layer_acts, recons, auxk)
+        if isinstance(batch, torch.Tensor):
+            # A batch of residue activations from an activation store
+            esm_layer_acts = batch
+            batch_size = len(esm_layer_acts)
+            mask = None
+        else:
+            seqs = batch["Sequence"]
+            batch_size = len(seqs)
+            with torch.no_grad():
+                esm2_model = get_esm_model(
+                    self.args.d_model,
+                    self.alphabet,
+                    self.args.esm2_weight,
+                    self.layer_to_use,
+                    self.args.attn_implementation,
+                )
+                tokens, esm_layer_acts = esm2_model.get_layer_activations(
+                    seqs, self.layer_to_use
+                )
+            mask = esm2_model.get_residue_mask(tokens)
+
+        if self.shuffle_buffer is not None:
+            residue_acts = esm_layer_acts if mask is None else esm_layer_acts[mask]
+            self.shuffle_buffer.add(residue_acts)
+            # Every DDP rank must take the same number of optimizer steps, or the gradient
+            # all-reduce deadlocks. Draw as many batches as the rank with the most ready, as
+            # long as every rank has the tokens for them, see TokenShuffleBuffer
+            counts = torch.tensor(
+                [self.shuffle_buffer.num_ready(), self.shuffle_buffer.num_available()],
+                device=self.device,
+            )
+            counts = self.all_gather(counts).view(-1, 2)
+            for _ in range(min(int(counts[:, 0].max()), int(counts[:, 1].min()))):
+                self._manual_step(self.shuffle_buffer.pop())
+            return None
+        return self._sae_step(esm_layer_acts.float(), mask, batch_size)
+
+    def on_train_epoch_start(self):
+        # Lightning only calls set_epoch on a DataLoader's sampler, so reshuffle the
+        # length-bucketing batch sampler and the streaming dataset here
+        train_dataloader = self.trainer.train_dataloader
+        for obj in [train_dataloader.batch_sampler, train_dataloader.dataset]:
+            if hasattr(obj, "set_epoch"):
+                obj.set_epoch(self.current_epoch)
+
+    def _manual_step(self, token_batch):
+        optimizer = self.optimizers()
+        loss = self._sae_step(token_batch.float(), None, len(token_batch))
+        optimizer.zero_grad()
+        # Runs on_after_backward, like automatic optimization does
+        self.manual_backward(loss)
+        self.clip_gradients(
+            optimizer,
+            gradient_clip_val=self.args.gradient_clip_val,
+            gradient_clip_algorithm="norm",
+        )
+        optimizer.step()
+
+    def _sae_step(self, esm_layer_acts, mask, batch_size):
+        recons, auxk, num_dead = self(esm_layer_acts, mask)
+        mse_loss, auxk_loss = loss_fn(esm_layer_acts, recons, auxk, mask)
         loss = mse_loss + auxk_loss
         self.log(
             "train_loss",
@@ -81,7 +151,7 @@ class SAELightningModule(pl.LightningModule):
         )
         self.log(
             "num_dead_neurons",
-            num_dead,
+            num_dead.float(),
             on_step=True,
             on_epoch=True,
             logger=True,
@@ -94,28 +164,41 @@ class SAELightningModule(pl.LightningModule):
         batch_size = len(val_seqs)
         with torch.no_grad():
             esm2_model = get_esm_model(
-                self.args.d_model, self.alphabet, self.args.esm2_weight
+                self.args.d_model,
+                self.alphabet,
+                self.args.esm2_weight,
+                self.layer_to_use,
+                self.args.attn_implementation,
             )
 
         diff_CE_all = torch.zeros(batch_size, device=self.device)
         mse_loss_all = torch.zeros(batch_size, device=self.device)
 
-        # Running inference one sequence at a time
-        for i, seq in enumerate(val_seqs):
-            tokens, esm_layer_acts = esm2_model.get_layer_activations(
-                seq, self.layer_to_use
+        # Running inference on batches of sequences of similar length
+        for batch_ids in bucket_by_length(
+            [len(seq) + 2 for seq in val_seqs], self.args.val_max_tokens
+        ):
+            tokens, esm_layer_acts, lengths = esm2_model.get_layer_activations(
+                [val_seqs[i] for i in batch_ids], self.layer_to_use, return_lengths=True
             )
-
-            # Calculate MSE
-            recons = self.sae_model.forward_val(esm_layer_acts)
-            mse_loss, auxk_loss = loss_fn(esm_layer_acts, recons, None)
-            mse_loss_all[i] = mse_loss
-
-            # Calculate difference in cross-entropy
-            orig_logits = esm2_model.get_sequence(esm_layer_acts, self.layer_to_use)
-            spliced_logits = esm2_model.get_sequence(recons, self.layer_to_use)
-            diff_CE = diff_cross_entropy(orig_logits, spliced_logits, tokens)
-            diff_CE_all[i] = diff_CE
+            padding_mask = tokens == esm2_model.padding_idx
+            mask = esm2_model.get_residue_mask(tokens)
+
+            # Calculate MSE of each sequence over its residues
+            recons = self.sae_model.forward_val(esm_layer_acts, mask)
+            token_mse = (recons - esm_layer_acts).pow(2).mean(dim=-1)
+            seq_mse = (token_mse * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            mse_loss_all[batch_ids] = seq_mse
+
+            # Calculate difference in cross-entropy, keeping the original BOS and EOS
+            # activations since the SAE skipped them
+            spliced = torch.where(mask.unsqueeze(-1), recons, esm_layer_acts)
+            orig_logits = esm2_model.get_sequence(esm_layer_acts, self.layer_to_use, padding_mask)
+            spliced_logits = esm2_model.get_sequence(spliced, self.layer_to_use, padding_mask)
+            for j, (i, length) in enumerate(zip(batch_ids, lengths.tolist())):
+                diff_CE_all[i] = diff_cross_entropy(
+                    orig_logits[j, :length], spliced_logits[j, :length], tokens[j, :length]
+                )
 
         val_metrics = {
             "mse_loss": mse_loss_all.mean(),
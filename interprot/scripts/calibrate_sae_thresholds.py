@@ -0,0 +1,83 @@
+import click
+import polars as pl
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, EsmModel
+
+from interprot.sae_model import SparseAutoencoder
+from interprot.utils import iter_layer_activations
+
+
+@click.command()
+@click.option(
+    "--sae-checkpoint",
+    type=click.Path(exists=True),
+    required=True,
+    help="Path to the SAE checkpoint file, in any format SparseAutoencoder.from_checkpoint reads",
+)
+@click.option(
+    "--plm-layer",
+    type=int,
+    default=None,
+    help="Layer of the protein language model to use. Defaults to the checkpoint's",
+)
+@click.option(
+    "--sequences-file",
+    type=click.Path(exists=True),
+    required=True,
+    help="Parquet file with a Sequence column to calibrate on",
+)
+@click.option(
+    "--output-path",
+    type=click.Path(),
+    required=True,
+    help="Path to save the calibrated thresholds to",
+)
+@click.option(
+    "--num-holdout-seqs",
+    type=int,
+    default=100,
+    help="Number of sequences held out from calibration to report parity with top-k on",
+)
+def main(
+    sae_checkpoint: str,
+    plm_layer: int,
+    sequences_file: str,
+    output_path: str,
+    num_holdout_seqs: int,
+):
+    """
+    Calibrate per-latent SAE activation thresholds that reproduce top-k on a reference
+    corpus. Pass the output to the --sae-thresholds option of the CLIs.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
+    plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
+    sae_model = SparseAutoencoder.from_checkpoint(sae_checkpoint, map_location=device)
+    plm_layer = plm_layer if plm_layer is not None else sae_model.layer
+    if plm_layer is None:
+        raise ValueError("The checkpoint does not record its pLM layer, pass --plm-layer")
+
+    seqs = pl.read_parquet(sequences_file)["Sequence"].to_list()
+    calibration_seqs, holdout_seqs = seqs[num_holdout_seqs:], seqs[:num_holdout_seqs]
+
+    def esm_acts(seqs: list[str]):
+        # Batched by length, and yielded in order, one sequence at a time
+        for acts in tqdm(
+            iter_layer_activations(tokenizer, plm_model, seqs, plm_layer, device=device),
+            total=len(seqs),
+        ):
+            yield acts[1:-1]
+
+    thresholds = sae_model.calibrate_thresholds(esm_acts(calibration_seqs))
+    torch.save(thresholds.cpu(), output_path)
+    click.echo(f"Saved thresholds to {output_path}")
+
+    if holdout_seqs:
+        parity = sae_model.threshold_parity(torch.cat(list(esm_acts(holdout_seqs))))
+        for name, value in parity.items():
+            click.echo(f"{name}: {value:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import click
+
+from interprot.sae_model import SparseAutoencoder
+
+
+@click.command()
+@click.option(
+    "--checkpoint",
+    type=click.Path(exists=True),
+    required=True,
+    help="Lightning checkpoint from training.py, SAE state dict or compact SAE checkpoint",
+)
+@click.option(
+    "--output-path",
+    type=click.Path(),
+    required=True,
+    help="Path to save the .safetensors checkpoint to",
+)
+@click.option(
+    "--plm-layer",
+    type=int,
+    default=None,
+    help="Layer of the protein language model. Required if the checkpoint doesn't record it",
+)
+@click.option(
+    "--plm-name",
+    type=str,
+    default="facebook/esm2_t33_650M_UR50D",
+    help="HuggingFace name of the protein language model the SAE was trained on",
+)
+@click.option("--k", type=int, default=None, help="Override the top-k of the checkpoint")
+def main(checkpoint: str, output_path: str, plm_layer: int, plm_name: str, k: int):
+    """
+    Convert an SAE checkpoint to the self-describing safetensors format, which
+    SparseAutoencoder.from_pretrained loads without knowing the SAE's dims or layer.
+    """
+    if not output_path.endswith(".safetensors"):
+        raise click.BadParameter("Must end in .safetensors", param_hint="--output-path")
+
+    sae_model = SparseAutoencoder.from_checkpoint(checkpoint, map_location="cpu")
+    if k is not None:
+        sae_model.k = k
+    sae_model.save_pretrained(
+        output_path,
+        layer=plm_layer if plm_layer is not None else sae_model.layer,
+        plm_name=plm_name,
+    )
+    click.echo(
+        f"Saved SAE with d_model={sae_model.d_model}, d_hidden={sae_model.d_hidden}, "
+        f"k={sae_model.k} to {output_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
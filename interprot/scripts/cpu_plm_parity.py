@@ -0,0 +1,89 @@
+import time
+
+import click
+import polars as pl
+import torch
+from transformers import AutoTokenizer, EsmModel
+
+from interprot.sae_model import SparseAutoencoder
+from interprot.utils import iter_layer_activations, optimize_plm_for_cpu
+
+
+@click.command()
+@click.option(
+    "--sae-checkpoint",
+    type=click.Path(exists=True),
+    required=True,
+    help="Path to the SAE checkpoint file, in any format SparseAutoencoder.from_checkpoint reads",
+)
+@click.option(
+    "--plm-layer",
+    type=int,
+    default=None,
+    help="Layer of the protein language model to use. Defaults to the checkpoint's",
+)
+@click.option(
+    "--sequences-file",
+    type=click.Path(exists=True),
+    required=True,
+    help="Parquet file with a Sequence column to compare on",
+)
+@click.option("--max-seqs", type=int, default=100, help="Maximum number of sequences to use")
+@click.option("--num-threads", type=int, default=None, help="Number of CPU threads to use")
+@click.option("--compile", is_flag=True, help="Also compile the pLM layers with torch.compile")
+def main(
+    sae_checkpoint: str,
+    plm_layer: int,
+    sequences_file: str,
+    max_seqs: int,
+    num_threads: int,
+    compile: bool,
+):
+    """
+    Compare the CPU inference profile of the pLM (see optimize_plm_for_cpu) against the
+    fp32 pLM: throughput, and overlap of the SAE latents of their activations.
+    """
+    device = torch.device("cpu")
+    tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
+    plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").eval()
+    fast_plm_model = optimize_plm_for_cpu(plm_model, num_threads=num_threads, compile=compile)
+    sae_model = SparseAutoencoder.from_checkpoint(sae_checkpoint, map_location=device)
+    plm_layer = plm_layer if plm_layer is not None else sae_model.layer
+    if plm_layer is None:
+        raise ValueError("The checkpoint does not record its pLM layer, pass --plm-layer")
+
+    seqs = pl.read_parquet(sequences_file)["Sequence"].to_list()[:max_seqs]
+    n_residues = sum(len(seq) for seq in seqs)
+
+    def run(plm: EsmModel) -> tuple[list[torch.Tensor], float]:
+        start = time.perf_counter()
+        acts = [
+            acts.clone()
+            for acts in iter_layer_activations(tokenizer, plm, seqs, plm_layer, device=device)
+        ]
+        return acts, time.perf_counter() - start
+
+    if compile:
+        # Warm up, so compilation isn't timed
+        run(fast_plm_model)
+    ref_acts, ref_time = run(plm_model)
+    fast_acts, fast_time = run(fast_plm_model)
+
+    overlaps = [
+        sae_model.latent_overlap(ref[1:-1], fast[1:-1]) for ref, fast in zip(ref_acts, fast_acts)
+    ]
+    rel_errors = [
+        ((fast - ref).norm() / ref.norm()).item() for ref, fast in zip(ref_acts, fast_acts)
+    ]
+    click.echo(f"fp32: {n_residues / ref_time:.1f} residues/s")
+    click.echo(
+        f"CPU profile: {n_residues / fast_time:.1f} residues/s "
+        f"({ref_time / fast_time:.2f}x speedup)"
+    )
+    click.echo(f"Mean SAE latent overlap: {sum(overlaps) / len(overlaps):.4f}")
+    click.echo(f"Min SAE latent overlap: {min(overlaps):.4f}")
+    click.echo(f"Mean relative error of pLM activations: {sum(rel_errors) / len(rel_errors):.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import json
+import os
+
+import click
+import esm
+import numpy as np
+import polars as pl
+import torch
+from tqdm import tqdm
+
+from interprot.esm_wrapper import ESM2Model
+from interprot.utils import bucket_by_length, train_val_test_split
+
+STORE_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+@click.command()
+@click.option(
+    "--sequences-file",
+    type=click.Path(exists=True),
+    required=True,
+    help="Parquet file with a sequence column, e.g. the --data-dir of training.py",
+)
+@click.option(
+    "--esm2-weight",
+    type=click.Path(exists=True),
+    required=True,
+    help="esm package checkpoint, e.g. weights/esm2_t33_650M_UR50D.pt",
+)
+@click.option("-l", "--layer-to-use", type=int, default=24, help="Layer of ESM to dump")
+@click.option("--d-model", type=int, default=1280, help="Embedding dimension of ESM")
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    required=True,
+    help="Directory to write the activation store to",
+)
+@click.option(
+    "--dtype",
+    type=click.Choice(list(STORE_DTYPES)),
+    default="float16",
+    help="dtype to store the activations in",
+)
+@click.option(
+    "--shard-tokens",
+    type=int,
+    default=500_000,
+    help="Approximate number of tokens per shard",
+)
+@click.option("--max-tokens", type=int, default=16384, help="Maximum padded tokens per ESM batch")
+@click.option(
+    "--seed", type=int, default=0, help="Seed of the train/val/test split and of the shuffle"
+)
+@click.option(
+    "--attn-implementation",
+    type=click.Choice(["esm", "sdpa"]),
+    default="esm",
+    help="Attention implementation of ESM. sdpa uses less memory on long sequences, but its "
+    "activations differ from those the SAEs were trained on by floating point error",
+)
+def main(
+    sequences_file: str,
+    esm2_weight: str,
+    layer_to_use: int,
+    d_model: int,
+    output_dir: str,
+    dtype: str,
+    shard_tokens: int,
+    max_tokens: int,
+    seed: int,
+    attn_implementation: str,
+):
+    """
+    Dump the ESM layer activations of the training split of a parquet of sequences, so
+    SAEs can be trained on them with training.py --activation-store without running ESM.
+
+    The output directory holds:
+
+    - shard_XXXXX.npy: (num_tokens, d_model) activations of the residues of sequences,
+      without BOS, EOS and padding. The ESM batches are run in a random order and the
+      tokens of each shard are shuffled, so that a run of tokens from a shard mixes
+      residues of many sequences of different lengths. bfloat16 is stored as int16 bit
+      patterns, since numpy has no bfloat16.
+    - index.json: the layer, dtype and dimension of the activations, and the number of
+      tokens and sequences in each shard.
+    - val.parquet and test.parquet: the sequences held out of the store, for validation.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Same model as sae_module.get_esm_model
+    esm2_model = ESM2Model(
+        num_layers=33,
+        embed_dim=d_model,
+        attention_heads=20,
+        alphabet=esm.data.Alphabet.from_architecture("ESM-1b"),
+        token_dropout=False,
+        prefix_layers=layer_to_use,
+        attn_implementation=attn_implementation,
+    )
+    esm2_model.load_esm_ckpt(esm2_weight)
+    esm2_model = esm2_model.to(device).eval()
+
+    np.random.seed(seed)
+    train_data, val_data, test_data = train_val_test_split(pl.read_parquet(sequences_file))
+    val_data.write_parquet(os.path.join(output_dir, "val.parquet"))
+    test_data.write_parquet(os.path.join(output_dir, "test.parquet"))
+    seqs = train_data["sequence"].to_list()
+
+    shards = []
+    buffer: list[torch.Tensor] = []
+    buffer_seqs = 0
+    generator = torch.Generator().manual_seed(seed)
+
+    def flush():
+        acts = torch.cat(buffer)
+        # bucket_by_length groups sequences of similar length, so shuffle the tokens to
+        # keep a shard's consecutive tokens from coming from a few similar proteins
+        acts = acts[torch.randperm(len(acts), generator=generator)]
+        if dtype == "bfloat16":
+            acts = acts.view(torch.int16)
+        path = f"shard_{len(shards):05d}.npy"
+        np.save(os.path.join(output_dir, path), acts.numpy())
+        shards.append({"path": path, "num_tokens": len(acts), "num_sequences": buffer_seqs})
+        buffer.clear()
+
+    batches = bucket_by_length([len(seq) + 2 for seq in seqs], max_tokens)
+    for batch_idx in tqdm(np.random.permutation(len(batches))):
+        batch_ids = batches[batch_idx]
+        with torch.no_grad():
+            tokens, esm_layer_acts = esm2_model.get_layer_activations(
+                [seqs[i] for i in batch_ids], layer_to_use
+            )
+        mask = esm2_model.get_residue_mask(tokens)
+        buffer.append(esm_layer_acts[mask].to(STORE_DTYPES[dtype]).cpu())
+        buffer_seqs += len(batch_ids)
+        if sum(len(acts) for acts in buffer) >= shard_tokens:
+            flush()
+            buffer_seqs = 0
+    if buffer:
+        flush()
+
+    index = {
+        "layer": layer_to_use,
+        "d_model": d_model,
+        "dtype": dtype,
+        "esm2_weight": os.path.basename(esm2_weight),
+        "num_tokens": sum(shard["num_tokens"] for shard in shards),
+        "shards": shards,
+    }
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    click.echo(f"Wrote {index['num_tokens']} tokens in {len(shards)} shards to {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
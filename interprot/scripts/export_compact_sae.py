@@ -0,0 +1,64 @@
+import click
+import numpy as np
+import polars as pl
+import torch
+
+from interprot.sae_model import SparseAutoencoder
+
+
+@click.command()
+@click.option(
+    "--sae-checkpoint",
+    type=click.Path(exists=True),
+    required=True,
+    help="Path to the SAE checkpoint file, in any format SparseAutoencoder.from_checkpoint reads",
+)
+@click.option(
+    "--feature-stats",
+    type=click.Path(exists=True),
+    default=None,
+    help="feature_stats.parquet from run_viz_file_analysis.py, with a dead_latent column",
+)
+@click.option(
+    "--max-acts",
+    type=click.Path(exists=True),
+    default=None,
+    help="max_acts.npz from make_viz_files. Latents with no activations are dropped",
+)
+@click.option(
+    "--output-path",
+    type=click.Path(),
+    required=True,
+    help="Path to save the compact checkpoint to",
+)
+def main(
+    sae_checkpoint: str,
+    feature_stats: str,
+    max_acts: str,
+    output_path: str,
+):
+    """
+    Export an SAE checkpoint with its dead latents stripped. Load it with
+    SparseAutoencoder.from_compact; activations stay keyed by the original latent dims.
+    """
+    if (feature_stats is None) == (max_acts is None):
+        raise click.UsageError("Pass exactly one of --feature-stats and --max-acts")
+
+    sae_model = SparseAutoencoder.from_checkpoint(sae_checkpoint, map_location="cpu")
+    sae_dim = sae_model.d_hidden
+
+    if feature_stats is not None:
+        df = pl.read_parquet(feature_stats)
+        dead_dims = df.filter(pl.col("dead_latent"))["dim"].cast(pl.Int64).to_list()
+        alive = torch.ones(sae_dim, dtype=torch.bool)
+        alive[dead_dims] = False
+    else:
+        with np.load(max_acts) as data:
+            alive = torch.from_numpy(data["all_seqs_max_act"].max(axis=1) > 0)
+
+    sae_model.compact(alive).save_compact(output_path)
+    click.echo(f"Kept {alive.sum().item()} of {sae_dim} latents, saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
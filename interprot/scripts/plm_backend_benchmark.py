@@ -0,0 +1,167 @@
+import multiprocessing
+import resource
+import time
+from typing import Optional
+
+import click
+import polars as pl
+import torch
+
+from interprot.plm_backends import PLM_BACKENDS, FairESMBackend, HFBackend
+from interprot.utils import bucket_by_length
+
+
+def _benchmark(
+    backend: str,
+    plm_name: str,
+    esm2_weight: Optional[str],
+    esm_token_dropout: bool,
+    attn_implementation: str,
+    layer: int,
+    seqs: list[str],
+    max_tokens: int,
+    num_parity_seqs: int,
+    num_threads: Optional[int],
+) -> dict:
+    """
+    Load one backend and time it on seqs, in a fresh process so its peak memory isn't
+    mixed up with the other backend's.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    start = time.perf_counter()
+    if backend == "hf":
+        plm_backend = HFBackend.from_pretrained(plm_name)
+    elif esm2_weight is not None:
+        plm_backend = FairESMBackend.from_pretrained(
+            esm2_weight,
+            max_layer=layer,
+            attn_implementation=attn_implementation,
+            token_dropout=esm_token_dropout,
+        )
+    else:
+        plm_backend = FairESMBackend.from_hf_model(
+            HFBackend.from_pretrained(plm_name).plm,
+            attn_implementation=attn_implementation,
+            token_dropout=esm_token_dropout,
+        )
+    load_time = time.perf_counter() - start
+
+    batches = bucket_by_length([len(seq) + 2 for seq in seqs], max_tokens)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch in batches:
+            plm_backend.get_layer_activations([seqs[i] for i in batch], layer)
+    run_time = time.perf_counter() - start
+
+    with torch.no_grad():
+        parity_acts = [
+            plm_backend.get_layer_activations([seq], layer)[0] for seq in seqs[:num_parity_seqs]
+        ]
+    return {
+        "load_time": load_time,
+        "tokens_per_sec": sum(len(seq) + 2 for seq in seqs) / run_time,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "parity_acts": parity_acts,
+    }
+
+
+@click.command()
+@click.option(
+    "--sequences-file",
+    type=click.Path(exists=True),
+    required=True,
+    help="Parquet file with a Sequence column to benchmark on",
+)
+@click.option("--plm-layer", type=int, default=24, help="Layer of the pLM to get")
+@click.option(
+    "--plm-name",
+    type=str,
+    default="facebook/esm2_t33_650M_UR50D",
+    help="HuggingFace name of the pLM",
+)
+@click.option(
+    "--esm2-weight",
+    type=click.Path(exists=True),
+    default=None,
+    help="esm package checkpoint of the same pLM, e.g. esm2_t33_650M_UR50D.pt. "
+    "If not given, the esm backend is built from the HuggingFace weights",
+)
+@click.option(
+    "--esm-token-dropout/--no-esm-token-dropout",
+    default=True,
+    help="Whether the esm backend rescales the embeddings like HuggingFace does. "
+    "The SAEs are trained without it",
+)
+@click.option(
+    "--attn-implementation",
+    type=click.Choice(["esm", "sdpa"]),
+    default="esm",
+    help="Attention implementation of the esm backend",
+)
+@click.option("--max-seqs", type=int, default=200, help="Maximum number of sequences to use")
+@click.option("--max-tokens", type=int, default=16384, help="Maximum padded tokens per batch")
+@click.option(
+    "--num-parity-seqs",
+    type=int,
+    default=20,
+    help="Number of sequences to compare the backends' activations on",
+)
+@click.option("--num-threads", type=int, default=None, help="Number of CPU threads to use")
+def main(
+    sequences_file: str,
+    plm_layer: int,
+    plm_name: str,
+    esm2_weight: str,
+    esm_token_dropout: bool,
+    attn_implementation: str,
+    max_seqs: int,
+    max_tokens: int,
+    num_parity_seqs: int,
+    num_threads: int,
+):
+    """
+    Compare the pLM backends of plm_backends.py on CPU: load time, throughput, peak
+    memory, and agreement of their layer activations.
+    """
+    seqs = pl.read_parquet(sequences_file)["Sequence"].to_list()[:max_seqs]
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for backend in PLM_BACKENDS:
+        with ctx.Pool(1) as pool:
+            results[backend] = pool.apply(
+                _benchmark,
+                (
+                    backend,
+                    plm_name,
+                    esm2_weight,
+                    esm_token_dropout,
+                    attn_implementation,
+                    plm_layer,
+                    seqs,
+                    max_tokens,
+                    num_parity_seqs,
+                    num_threads,
+                ),
+            )
+        result = results[backend]
+        click.echo(
+            f"{backend}: {result['tokens_per_sec']:.1f} tokens/s, "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB, loaded in {result['load_time']:.1f}s"
+        )
+
+    rel_errors = [
+        ((esm - hf).norm() / hf.norm()).item()
+        for hf, esm in zip(results["hf"]["parity_acts"], results["esm"]["parity_acts"])
+    ]
+    if rel_errors:
+        mean_rel_error = sum(rel_errors) / len(rel_errors)
+        click.echo(f"Mean relative difference of activations: {mean_rel_error:.2e}")
+        click.echo(f"Max relative difference of activations: {max(rel_errors):.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import click
+import polars as pl
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, EsmModel
+
+from interprot.sae_model import QuantizedSAE, SparseAutoencoder
+from interprot.utils import iter_layer_activations
+
+
+@click.command()
+@click.option(
+    "--sae-checkpoint",
+    type=click.Path(exists=True),
+    required=True,
+    help="Path to the SAE checkpoint file, in any format SparseAutoencoder.from_checkpoint reads",
+)
+@click.option(
+    "--plm-layer",
+    type=int,
+    default=None,
+    help="Layer of the protein language model to use. Defaults to the checkpoint's",
+)
+@click.option(
+    "--sequences-file",
+    type=click.Path(exists=True),
+    required=True,
+    help="Parquet file with a Sequence column to compare on",
+)
+@click.option("--max-seqs", type=int, default=100, help="Maximum number of sequences to use")
+@click.option(
+    "--dtypes",
+    type=click.Choice(list(QuantizedSAE.QUANTIZED_DTYPES)),
+    multiple=True,
+    default=list(QuantizedSAE.QUANTIZED_DTYPES),
+    help="Quantized dtypes to compare",
+)
+def main(sae_checkpoint: str, plm_layer: int, sequences_file: str, max_seqs: int, dtypes):
+    """
+    Report latent index overlap and reconstruction MSE of quantized SAEs against fp32 on
+    CPU, along with the size of their weights.
+    """
+    tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
+    plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").eval()
+    sae_model = SparseAutoencoder.from_checkpoint(sae_checkpoint, map_location="cpu")
+    plm_layer = plm_layer if plm_layer is not None else sae_model.layer
+    if plm_layer is None:
+        raise ValueError("The checkpoint does not record its pLM layer, pass --plm-layer")
+
+    seqs = pl.read_parquet(sequences_file)["Sequence"].to_list()[:max_seqs]
+    esm_acts = torch.cat(
+        [
+            acts[1:-1]
+            for acts in tqdm(
+                iter_layer_activations(tokenizer, plm_model, seqs, plm_layer, device="cpu"),
+                total=len(seqs),
+            )
+        ]
+    )
+
+    fp32_nbytes = sae_model.w_enc.nbytes + sae_model.w_dec.nbytes
+    click.echo(f"float32: {fp32_nbytes / 2**20:.1f} MiB")
+    for dtype in dtypes:
+        quantized = QuantizedSAE(sae_model, dtype=dtype)
+        parity = quantized.parity(sae_model, esm_acts)
+        click.echo(
+            f"{dtype}: {quantized.weight_nbytes() / 2**20:.1f} MiB, "
+            + ", ".join(f"{name}={value:.4g}" for name, value in parity.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -41,7 +41,6 @@ mkdir -p "$output_dir"
 oned_probe single-latent \
     --sae-checkpoint $checkpoint_file \
     --sae-dim $sae_dim \
-    --plm-dim 1280 \
     --plm-layer $plm_layer \
     --swissprot-tsv swissprot_full_annotations.tsv \
     --output-dir $output_dir/single_latent_single_residue
@@ -49,7 +48,6 @@ oned_probe single-latent \
 oned_probe single-latent \
     --sae-checkpoint $checkpoint_file \
     --sae-dim $sae_dim \
-    --plm-dim 1280 \
     --plm-layer $plm_layer \
     --swissprot-tsv swissprot_full_annotations.tsv \
     --pool-over-annotation True \
@@ -58,7 +56,6 @@ oned_probe single-latent \
 oned_probe all-latents \
     --sae-checkpoint $checkpoint_file \
     --sae-dim $sae_dim \
-    --plm-dim 1280 \
     --plm-layer $plm_layer \
     --swissprot-tsv swissprot_full_annotations.tsv \
     --output-file $output_dir/all_latents.csv
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# data_module is imported as training.py imports it, from the interprot directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
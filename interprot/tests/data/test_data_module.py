@@ -0,0 +1,216 @@
+import json
+import os
+import pickle
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+import polars as pr
+import torch
+from data_module import (
+    ActivationStoreDataset,
+    LengthBucketBatchSampler,
+    PolarsDataset,
+    StreamingParquetDataset,
+    TokenShuffleBuffer,
+)
+
+
+class TestPolarsDataset(unittest.TestCase):
+    def test_getitems(self):
+        df = pr.concat(
+            [
+                pr.DataFrame({"sequence": ["MKT", "AYIAKQR"], "id": ["P1", "P2"]}),
+                pr.DataFrame({"sequence": ["", "MVLSÉ"], "id": ["P3", "P4"]}),
+            ],
+            rechunk=False,
+        )
+        dataset = PolarsDataset(df)
+        # DataLoader workers get a pickled copy, which maps the file again
+        for dataset in [dataset, pickle.loads(pickle.dumps(dataset))]:
+            self.assertEqual(len(dataset), 4)
+            self.assertEqual(
+                dataset.__getitems__([3, 0, 2]),
+                [
+                    {"Sequence": "MVLSÉ", "Entry": "P4"},
+                    {"Sequence": "MKT", "Entry": "P1"},
+                    {"Sequence": "", "Entry": "P3"},
+                ],
+            )
+            self.assertEqual(dataset[1], {"Sequence": "AYIAKQR", "Entry": "P2"})
+
+
+class TestActivationStoreDataset(unittest.TestCase):
+    def write_store(self, store_dir, shards, dtype):
+        # The layout written by scripts/dump_activations.py
+        index = {"layer": 24, "d_model": 4, "dtype": dtype, "shards": []}
+        for i, acts in enumerate(shards):
+            if dtype == "bfloat16":
+                acts = acts.view(torch.int16)
+            path = f"shard_{i:05d}.npy"
+            np.save(os.path.join(store_dir, path), acts.numpy())
+            index["shards"].append({"path": path, "num_tokens": len(acts), "num_sequences": 1})
+        index["num_tokens"] = sum(shard["num_tokens"] for shard in index["shards"])
+        with open(os.path.join(store_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+
+    def test_round_trip(self):
+        for dtype, torch_dtype in [("float16", torch.float16), ("bfloat16", torch.bfloat16)]:
+            shards = [torch.randn(10, 4).to(torch_dtype), torch.randn(7, 4).to(torch_dtype)]
+            with tempfile.TemporaryDirectory() as store_dir:
+                self.write_store(store_dir, shards, dtype)
+                dataset = ActivationStoreDataset(store_dir, batch_tokens=4)
+                batches = [dataset[i] for i in range(len(dataset))]
+                # DataLoader workers get a pickled copy, which maps the shards again
+                worker_dataset = pickle.loads(pickle.dumps(dataset))
+                worker_batches = [worker_dataset[i] for i in range(len(worker_dataset))]
+
+            # Batches don't cross shards, so the last batch of each shard may be smaller
+            self.assertEqual([len(batch) for batch in batches], [4, 4, 2, 4, 3])
+            for batch in batches:
+                self.assertEqual(batch.dtype, torch_dtype)
+            torch.testing.assert_close(torch.cat(batches), torch.cat(shards), atol=0, rtol=0)
+            torch.testing.assert_close(torch.cat(worker_batches), torch.cat(shards), atol=0, rtol=0)
+
+
+class TestStreamingParquetDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.tmp_dir.name, "data.parquet")
+        self.num_rows = 200
+        pr.DataFrame(
+            {
+                "sequence": ["M" * (i % 7 + 1) for i in range(self.num_rows)],
+                "id": [str(i) for i in range(self.num_rows)],
+            }
+        ).write_parquet(self.data_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def shard_ids(self, split, num_replicas, num_workers, epoch=0, shuffle=True):
+        shards = []
+        for rank in range(num_replicas):
+            dataset = StreamingParquetDataset(
+                self.data_path,
+                split,
+                slice_rows=30,
+                shuffle=shuffle,
+                num_replicas=num_replicas,
+                rank=rank,
+            )
+            dataset.set_epoch(epoch)
+            for worker_id in range(num_workers):
+                worker_info = SimpleNamespace(num_workers=num_workers, id=worker_id)
+                with patch("torch.utils.data.get_worker_info", return_value=worker_info):
+                    shards.append([int(row["Entry"]) for row in dataset])
+        return shards
+
+    def test_splits_partition_rows(self):
+        ids = [
+            i
+            for split in StreamingParquetDataset.SPLITS
+            for i in self.shard_ids(split, 1, 1, shuffle=False)[0]
+        ]
+        self.assertEqual(sorted(ids), list(range(self.num_rows)))
+
+    def test_shards_cover_split(self):
+        (split_ids,) = self.shard_ids("train", 1, 1)
+        # More shards than the 7 slices
+        for num_replicas, num_workers in [(1, 1), (2, 3), (3, 4)]:
+            shards = self.shard_ids("train", num_replicas, num_workers)
+            num_shards = num_replicas * num_workers
+            quota = len(split_ids) // num_shards
+            self.assertEqual([len(ids) for ids in shards], [quota] * num_shards)
+            ids = [i for shard in shards for i in shard]
+            self.assertEqual(len(set(ids)), len(ids))
+            self.assertTrue(set(ids) <= set(split_ids))
+            self.assertEqual(len(ids), len(split_ids) - len(split_ids) % num_shards)
+
+    def test_set_epoch_reshuffles(self):
+        self.assertEqual(self.shard_ids("train", 2, 1), self.shard_ids("train", 2, 1))
+        self.assertNotEqual(
+            self.shard_ids("train", 2, 1, epoch=0), self.shard_ids("train", 2, 1, epoch=1)
+        )
+
+
+class TestLengthBucketBatchSampler(unittest.TestCase):
+    def setUp(self):
+        self.lengths = np.random.default_rng(0).integers(10, 200, 101).tolist()
+
+    def rank_batches(self, num_replicas, epoch=0):
+        batches = []
+        for rank in range(num_replicas):
+            sampler = LengthBucketBatchSampler(
+                self.lengths, 600, seed=1, num_replicas=num_replicas, rank=rank
+            )
+            sampler.set_epoch(epoch)
+            batches.append(list(sampler))
+            self.assertEqual(len(batches[-1]), len(sampler))
+        return batches
+
+    def test_ranks_get_equal_batches(self):
+        for num_replicas in [1, 2, 3, 4]:
+            batches = self.rank_batches(num_replicas)
+            # Every rank runs the same number of steps, and together they cover every
+            # sequence
+            self.assertEqual(len(set(len(rank_batches) for rank_batches in batches)), 1)
+            seqs = [i for rank_batches in batches for batch in rank_batches for i in batch]
+            self.assertEqual(set(seqs), set(range(len(self.lengths))))
+            for rank_batches in batches:
+                for batch in rank_batches:
+                    self.assertLessEqual(len(batch) * max(self.lengths[i] for i in batch), 600)
+
+    def test_set_epoch_reshuffles(self):
+        self.assertEqual(self.rank_batches(2, epoch=0), self.rank_batches(2, epoch=0))
+        self.assertNotEqual(self.rank_batches(2, epoch=0), self.rank_batches(2, epoch=1))
+
+
+class TestTokenShuffleBuffer(unittest.TestCase):
+    def test_conserves_tokens(self):
+        torch.manual_seed(0)
+        buffer = TokenShuffleBuffer(capacity=64, batch_size=16)
+        # Number each token, so tokens can be followed through the buffer
+        lengths = torch.randint(1, 50, (30,)).tolist()
+        token_ids = torch.arange(sum(lengths), dtype=torch.float).unsqueeze(-1)
+        drawn = []
+        for acts in token_ids.split(lengths):
+            buffer.add(acts.expand(-1, 3))
+            for _ in range(buffer.num_ready()):
+                batch = buffer.pop()
+                self.assertEqual(batch.shape, (16, 3))
+                drawn.append(batch[:, 0])
+        self.assertGreater(len(drawn), 0)
+
+        remaining = buffer.storage[: buffer.size, 0]
+        self.assertEqual(
+            sorted(torch.cat(drawn + [remaining]).tolist()), token_ids.squeeze(-1).tolist()
+        )
+        for _ in range(buffer.num_ready()):
+            buffer.pop()
+        self.assertLess(buffer.size, 64)
+
+    def test_bounded_under_uneven_ranks(self):
+        torch.manual_seed(0)
+        buffers = [TokenShuffleBuffer(capacity=64, batch_size=16) for _ in range(2)]
+        for _ in range(500):
+            # One simulated DDP rank gets a few times more tokens per step than the other
+            buffers[0].add(torch.randn(torch.randint(1, 20, ()).item(), 3))
+            buffers[1].add(torch.randn(torch.randint(20, 60, ()).item(), 3))
+            # As in SAELightningModule.training_step
+            num_steps = min(
+                max(buffer.num_ready() for buffer in buffers),
+                min(buffer.num_available() for buffer in buffers),
+            )
+            for _ in range(num_steps):
+                for buffer in buffers:
+                    self.assertEqual(buffer.pop().shape, (16, 3))
+        for buffer in buffers:
+            self.assertLessEqual(len(buffer.storage), 64 + 60)
+            self.assertEqual(len(buffer.storage[: buffer.size].unique(dim=0)), buffer.size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+import esm
+import torch
+
+from interprot.esm_wrapper import ESM2Model
+from interprot.sae_model import SparseAutoencoder
+
+
+class TestSDPAAttention(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+        models = {}
+        for attn_implementation in ["esm", "sdpa"]:
+            models[attn_implementation] = ESM2Model(
+                num_layers=3,
+                embed_dim=32,
+                attention_heads=4,
+                alphabet=alphabet,
+                token_dropout=False,
+                attn_implementation=attn_implementation,
+            ).eval()
+        models["sdpa"].load_state_dict(models["esm"].state_dict())
+        self.models = models
+        self.seqs = ["MKTAYIAKQRQISFVKSHFSRQ", "MVLSEGEWQLV", "MKV"]
+
+    def test_matches_esm_attention(self):
+        with torch.no_grad():
+            tokens, esm_acts = self.models["esm"].get_layer_activations(self.seqs, 2)
+            _, sdpa_acts = self.models["sdpa"].get_layer_activations(self.seqs, 2)
+            padding_mask = tokens == self.models["esm"].padding_idx
+            esm_logits = self.models["esm"].get_sequence(esm_acts, 2, padding_mask)
+            sdpa_logits = self.models["sdpa"].get_sequence(esm_acts, 2, padding_mask)
+
+        residues = ~padding_mask
+        torch.testing.assert_close(sdpa_acts[residues], esm_acts[residues], atol=1e-5, rtol=1e-4)
+        torch.testing.assert_close(
+            sdpa_logits[residues], esm_logits[residues], atol=1e-5, rtol=1e-4
+        )
+
+    def test_batch_matches_single_sequences(self):
+        with torch.no_grad():
+            _, batch_acts = self.models["sdpa"].get_layer_activations(self.seqs, 3)
+            for i, seq in enumerate(self.seqs):
+                _, acts = self.models["sdpa"].get_layer_activations(seq, 3)
+                torch.testing.assert_close(
+                    batch_acts[i, : len(seq) + 2], acts[0], atol=1e-5, rtol=1e-4
+                )
+
+    def test_multi_layer_activations(self):
+        model = self.models["sdpa"]
+        with torch.no_grad():
+            _, layer_acts = model.get_multi_layer_activations(
+                self.seqs, [0, 1, 3], dtype=torch.float16
+            )
+            for layer_idx in [0, 1, 3]:
+                _, acts = model.get_layer_activations(self.seqs, layer_idx)
+                self.assertEqual(layer_acts[layer_idx].dtype, torch.float16)
+                torch.testing.assert_close(layer_acts[layer_idx], acts.half())
+
+
+class TestPrefixCache(unittest.TestCase):
+    def test_run_suffix_on_decoded_latents(self):
+        torch.manual_seed(0)
+        model = ESM2Model(
+            num_layers=3,
+            embed_dim=32,
+            attention_heads=4,
+            alphabet=esm.data.Alphabet.from_architecture("ESM-1b"),
+            token_dropout=False,
+        ).eval()
+        sae = SparseAutoencoder(d_model=32, d_hidden=64, k=4)
+        seq = "MKTAYIAKQRQISFVKSHFSRQ"
+
+        cache = model.get_prefix_cache(seq, 2, sae)
+        steered = cache.latents.repeat(3, 1, 1)
+        steered[1:, :, 7] += torch.tensor([1.0, 2.0])[:, None]
+        with torch.no_grad():
+            logits = model.run_suffix(cache, cache.decode(sae, steered))
+            expected = model.get_sequence(cache.acts, 2)
+
+        self.assertEqual(logits.shape[0], 3)
+        torch.testing.assert_close(logits[:1], expected, atol=1e-5, rtol=1e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,7 +11,6 @@ from interprot.oned_probe.single_latent import single_latent
 
 class TestSingleLatentProbe(unittest.TestCase):
     @patch("interprot.oned_probe.single_latent.prepare_arrays_for_logistic_regression")
-    @patch("interprot.oned_probe.single_latent.torch.load")
     @patch("interprot.oned_probe.single_latent.AutoTokenizer.from_pretrained")
     @patch("interprot.oned_probe.single_latent.EsmModel.from_pretrained")
     @patch("interprot.oned_probe.single_latent.SparseAutoencoder")
@@ -20,13 +19,11 @@ class TestSingleLatentProbe(unittest.TestCase):
         mock_sae,
         mock_esm,
         mock_tokenizer,
-        mock_torch_load,
         mock_prepare_arrays_for_logistic_regression,
     ):
-        mock_torch_load.return_value = {}
         mock_tokenizer.return_value = None
         mock_esm.return_value = Mock(to=Mock())
-        mock_sae.return_value = Mock(to=Mock())
+        mock_sae.from_checkpoint.return_value = Mock(d_hidden_full=10)
 
         # Mock SAE activations to make hidden dim 2 correlate perfectly with the
         # test annotations
@@ -60,8 +57,6 @@ class TestSingleLatentProbe(unittest.TestCase):
                     "dummy.pt",
                     "--sae-dim",
                     "10",
-                    "--plm-dim",
-                    "1280",
                     "--plm-layer",
                     "24",
                     "--swissprot-tsv",
@@ -14,8 +14,8 @@ from interprot.oned_probe.utils import (
 
 
 class TestUtils(unittest.TestCase):
-    @patch("interprot.oned_probe.utils.get_sae_acts")
-    def test_make_examples_from_annotation_entries(self, mock_get_sae_acts):
+    @patch("interprot.oned_probe.utils.iter_sae_acts")
+    def test_make_examples_from_annotation_entries(self, mock_iter_sae_acts):
         # Mock the necessary objects
         mock_tokenizer = Mock()
         mock_plm_model = Mock()
@@ -32,24 +32,26 @@ class TestUtils(unittest.TestCase):
             ],
         }
 
-        mock_get_sae_acts.side_effect = [
+        mock_iter_sae_acts.return_value = iter(
             [
-                [0.1, 0.2],
-                [0.3, 0.4],
-                [0.5, 0.6],
-                [0.7, 0.8],
-                [0.9, 1.0],
-                [1.1, 1.2],
-            ],  # For "ABCDEF"
-            [
-                [1.3, 1.4],
-                [1.5, 1.6],
-                [1.7, 1.8],
-                [1.9, 2.0],
-                [2.1, 2.2],
-                [2.3, 2.4],
-            ],  # For "GHIJKL"
-        ]
+                [
+                    [0.1, 0.2],
+                    [0.3, 0.4],
+                    [0.5, 0.6],
+                    [0.7, 0.8],
+                    [0.9, 1.0],
+                    [1.1, 1.2],
+                ],  # For "ABCDEF"
+                [
+                    [1.3, 1.4],
+                    [1.5, 1.6],
+                    [1.7, 1.8],
+                    [1.9, 2.0],
+                    [2.1, 2.2],
+                    [2.3, 2.4],
+                ],  # For "GHIJKL"
+            ]
+        )
 
         examples = make_examples_from_annotation_entries(
             seq_to_annotation_entries,
@@ -71,23 +73,16 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(examples[9], Example(sae_acts=np.array([1.9, 2.0]), target=False))
         self.assertEqual(examples[10], Example(sae_acts=np.array([2.1, 2.2]), target=True))
 
-        mock_get_sae_acts.assert_any_call(
-            seq="ABCDEF",
-            tokenizer=mock_tokenizer,
-            plm_model=mock_plm_model,
-            sae_model=mock_sae_model,
-            plm_layer=24,
-        )
-        mock_get_sae_acts.assert_any_call(
-            seq="GHIJKL",
+        mock_iter_sae_acts.assert_called_once_with(
+            seqs=["ABCDEF", "GHIJKL"],
             tokenizer=mock_tokenizer,
             plm_model=mock_plm_model,
             sae_model=mock_sae_model,
             plm_layer=24,
         )
 
-    @patch("interprot.oned_probe.utils.get_sae_acts")
-    def test_make_examples_from_annotation_entries_pool_over_annotation(self, mock_get_sae_acts):
+    @patch("interprot.oned_probe.utils.iter_sae_acts")
+    def test_make_examples_from_annotation_entries_pool_over_annotation(self, mock_iter_sae_acts):
         seq_to_annotation_entries = {
             "AAAAAAAAAA": [{"start": 4, "end": 6}],
             "CCCCCCCCCC": [{"start": 1, "end": 3}, {"start": 5, "end": 6}],
@@ -97,32 +92,34 @@ class TestUtils(unittest.TestCase):
         mock_plm_model = Mock()
         mock_sae_model = Mock()
 
-        mock_get_sae_acts.side_effect = [
+        mock_iter_sae_acts.return_value = iter(
             [
-                [0.1, 0.2],
-                [0.3, 0.4],
-                [0.5, 0.6],
-                [0.7, 0.8],
-                [0.9, 1.0],
-                [1.1, 1.2],
-                [1.3, 1.4],
-                [1.5, 1.6],
-                [1.7, 1.8],
-                [1.9, 2.0],
-            ],
-            [
-                [2.1, 2.2],
-                [2.3, 2.4],
-                [2.5, 2.6],
-                [2.7, 2.8],
-                [2.9, 3.0],
-                [3.1, 3.2],
-                [3.3, 3.4],
-                [3.5, 3.6],
-                [3.7, 3.8],
-                [3.9, 4.0],
-            ],
-        ]
+                [
+                    [0.1, 0.2],
+                    [0.3, 0.4],
+                    [0.5, 0.6],
+                    [0.7, 0.8],
+                    [0.9, 1.0],
+                    [1.1, 1.2],
+                    [1.3, 1.4],
+                    [1.5, 1.6],
+                    [1.7, 1.8],
+                    [1.9, 2.0],
+                ],
+                [
+                    [2.1, 2.2],
+                    [2.3, 2.4],
+                    [2.5, 2.6],
+                    [2.7, 2.8],
+                    [2.9, 3.0],
+                    [3.1, 3.2],
+                    [3.3, 3.4],
+                    [3.5, 3.6],
+                    [3.7, 3.8],
+                    [3.9, 4.0],
+                ],
+            ]
+        )
 
         examples = make_examples_from_annotation_entries(
             seq_to_annotation_entries,
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import pytest
+from transformers import EsmTokenizer
+
+# The vocabulary of esm.data.Alphabet.from_architecture("ESM-1b"), in the same order
+ESM_VOCAB = [
+    "<cls>", "<pad>", "<eos>", "<unk>",
+    *"LAGVSERTIDPKQNFYMHWCXBUZO.-",
+    "<null_1>", "<mask>",
+]  # fmt: skip
+
+
+@pytest.fixture(scope="class")
+def esm_tokenizer(request):
+    """
+    An EsmTokenizer with the ESM-2 vocabulary, so tests can build small random ESM models
+    without downloading one. Set as the tokenizer attribute of the test class.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vocab_file = os.path.join(tmp_dir, "vocab.txt")
+        with open(vocab_file, "w") as f:
+            f.write("\n".join(ESM_VOCAB))
+        tokenizer = EsmTokenizer(vocab_file)
+    if request.cls is not None:
+        request.cls.tokenizer = tokenizer
+    return tokenizer
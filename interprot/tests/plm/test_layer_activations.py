@@ -0,0 +1,105 @@
+import unittest
+
+import pytest
+import torch
+from transformers import EsmConfig, EsmModel
+
+from interprot.utils import (
+    get_layer_activations,
+    get_multi_layer_activations,
+    get_windowed_layer_activations,
+    stitch_windows,
+    window_starts,
+)
+
+
+@pytest.mark.usefixtures("esm_tokenizer")
+class TestLayerActivations(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        config = EsmConfig(
+            vocab_size=self.tokenizer.vocab_size,
+            hidden_size=16,
+            num_hidden_layers=4,
+            num_attention_heads=2,
+            intermediate_size=32,
+            max_position_embeddings=64,
+            pad_token_id=self.tokenizer.pad_token_id,
+            mask_token_id=self.tokenizer.mask_token_id,
+            position_embedding_type="rotary",
+            emb_layer_norm_before=False,
+            token_dropout=True,
+        )
+        self.plm = EsmModel(config).eval()
+        self.seqs = ["MKTAYIAK", "MVLSEGEWQLVLHVWAKVEAD"]
+
+    def test_matches_output_hidden_states(self):
+        inputs = self.tokenizer(self.seqs, padding=True, return_tensors="pt")
+        with torch.no_grad():
+            hidden_states = self.plm(**inputs, output_hidden_states=True).hidden_states
+
+        device = torch.device("cpu")
+        acts = get_multi_layer_activations(
+            self.tokenizer, self.plm, self.seqs, [0, 2, 4], device=device
+        )
+        for layer in [0, 2, 4]:
+            torch.testing.assert_close(acts[layer], hidden_states[layer])
+        torch.testing.assert_close(
+            get_layer_activations(self.tokenizer, self.plm, self.seqs, 3, device=device),
+            hidden_states[3],
+        )
+
+    def test_windowed_activations(self):
+        seq = "MVLSEGEWQLVLHVWAKVEADVAGHGQDILIRLFKSHPETLEKF"
+        device = torch.device("cpu")
+        full = get_layer_activations(self.tokenizer, self.plm, [seq], 2, device=device)[0]
+        # A sequence that fits in one window is run in one piece
+        torch.testing.assert_close(
+            get_windowed_layer_activations(
+                self.tokenizer, self.plm, seq, 2, window_size=len(seq), device=device
+            ),
+            full,
+        )
+
+        windowed = get_windowed_layer_activations(
+            self.tokenizer, self.plm, seq, 2, window_size=16, overlap=4, device=device
+        )
+        self.assertEqual(windowed.shape, full.shape)
+        starts = window_starts(len(seq), 16, 4)
+        self.assertEqual(starts, [0, 12, 24, 28])
+        window_acts = {
+            start: get_layer_activations(
+                self.tokenizer, self.plm, [seq[start : start + 16]], 2, device=device
+            )[0]
+            for start in starts
+        }
+        torch.testing.assert_close(windowed[0], window_acts[0][0])
+        torch.testing.assert_close(windowed[-1], window_acts[28][-1])
+        # Each residue comes from the window it is furthest from an inner edge in
+        expected_starts = [0] * 14 + [12] * 12 + [24] * 8 + [28] * 10
+        for pos, start in enumerate(expected_starts):
+            torch.testing.assert_close(windowed[pos + 1], window_acts[start][pos - start + 1])
+
+
+class TestStitchWindows(unittest.TestCase):
+    def test_window_starts(self):
+        self.assertEqual(window_starts(10, 16, 4), [0])
+        self.assertEqual(window_starts(30, 16, 4), [0, 12, 14])
+
+    def test_stitch_recovers_consistent_windows(self):
+        values = torch.randn(30, 3)
+        starts = window_starts(30, 16, 4)
+        windows = [values[start : start + 16] for start in starts]
+        for blend in ["center", "linear", "mean"]:
+            torch.testing.assert_close(stitch_windows(windows, starts, 30, 4, blend), values)
+
+    def test_center_takes_furthest_from_edge(self):
+        starts = [0, 8]
+        windows = [torch.zeros(12, 1), torch.ones(12, 1)]
+        stitched = stitch_windows(windows, starts, 20, 4, "center")
+        # Of the overlapping positions 8-11, 8 and 9 are further from an edge in the first window
+        self.assertEqual(stitched.squeeze(-1).tolist(), [0] * 10 + [1] * 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
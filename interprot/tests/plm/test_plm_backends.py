@@ -0,0 +1,51 @@
+import unittest
+
+import pytest
+import torch
+from transformers import EsmConfig, EsmModel
+
+from interprot.plm_backends import FairESMBackend, HFBackend
+
+
+@pytest.mark.usefixtures("esm_tokenizer")
+class TestPLMBackends(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        config = EsmConfig(
+            vocab_size=self.tokenizer.vocab_size,
+            hidden_size=32,
+            num_hidden_layers=3,
+            num_attention_heads=4,
+            intermediate_size=128,
+            max_position_embeddings=64,
+            pad_token_id=self.tokenizer.pad_token_id,
+            mask_token_id=self.tokenizer.mask_token_id,
+            position_embedding_type="rotary",
+            emb_layer_norm_before=False,
+            token_dropout=True,
+            layer_norm_eps=1e-5,
+        )
+        self.hf_backend = HFBackend(self.tokenizer, EsmModel(config).eval())
+        self.seqs = ["MKTAYIAKQRQISFVKSHFSRQ", "MVLSEGEWQLV"]
+
+    def test_layer_activations_match(self):
+        layers = [0, 2, 3]
+        hf_acts = self.hf_backend.get_multi_layer_activations(self.seqs, layers)
+        for attn_implementation in ["esm", "sdpa"]:
+            esm_backend = FairESMBackend.from_hf_model(
+                self.hf_backend.plm, attn_implementation=attn_implementation
+            )
+            esm_acts = esm_backend.get_multi_layer_activations(self.seqs, layers)
+            for layer in layers:
+                for i, seq in enumerate(self.seqs):
+                    n_tokens = len(seq) + 2
+                    torch.testing.assert_close(
+                        esm_acts[layer][i, :n_tokens],
+                        hf_acts[layer][i, :n_tokens],
+                        atol=1e-5,
+                        rtol=1e-4,
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+
+import torch
+
+from interprot.sae_model import (
+    MultiSAE,
+    QuantizedSAE,
+    SparseAutoencoder,
+    SparseDecode,
+    loss_fn,
+)
+
+
+class TestSparseAutoencoder(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.sae = SparseAutoencoder(d_model=16, d_hidden=64, k=4)
+        self.x = torch.randn(2, 5, 16)
+
+    def test_decode_sparse_matches_dense(self):
+        with torch.no_grad():
+            indices, values, mu, std = self.sae.encode_sparse(self.x)
+            latents = torch.zeros(2, 5, 64).scatter_(-1, indices, values)
+            expected = (latents @ self.sae.w_dec + self.sae.b_pre) * std + mu
+
+            torch.testing.assert_close(self.sae.decode_sparse(indices, values, mu, std), expected)
+            torch.testing.assert_close(self.sae.get_acts(self.x), latents)
+
+    def test_sparse_decode_gradcheck(self):
+        indices = torch.stack([torch.randperm(64)[:4] for _ in range(3)])
+        values = torch.rand(3, 4, dtype=torch.double, requires_grad=True)
+        w_dec = torch.randn(64, 16, dtype=torch.double, requires_grad=True)
+        self.assertTrue(torch.autograd.gradcheck(SparseDecode.apply, (indices, values, w_dec)))
+
+    def test_forward_matches_forward_val(self):
+        recons, _, _ = self.sae(self.x)
+        torch.testing.assert_close(recons.detach(), self.sae.forward_val(self.x))
+
+    def test_mask(self):
+        mask = torch.tensor([[True, True, True, False, False], [True] * 5])
+        recons, _, _ = self.sae(self.x, mask)
+        self.assertEqual(self.sae.tokens_seen, 8)
+        self.assertTrue((recons[~mask] == 0).all())
+        torch.testing.assert_close(recons[mask].detach(), self.sae.forward_val(self.x[mask]))
+        torch.testing.assert_close(
+            self.sae.get_acts(self.x, mask=mask)[mask], self.sae.get_acts(self.x[mask])
+        )
+
+        mse_loss, _ = loss_fn(self.x, recons, mask=mask)
+        torch.testing.assert_close(mse_loss, loss_fn(self.x[mask], recons[mask])[0])
+
+    def test_threshold_activation(self):
+        self.sae.thresholds = torch.zeros(64)
+        x, _, _ = self.sae.LN(self.x)
+        pre_acts = (x - self.sae.b_pre) @ self.sae.w_enc + self.sae.b_enc
+        torch.testing.assert_close(
+            self.sae.get_acts(self.x, use_thresholds=True), torch.relu(pre_acts).detach()
+        )
+
+    def test_calibrate_thresholds(self):
+        # Make the pre-activations equal the input, so that top-1 keeps the hot dim of each
+        # token and a threshold per dim separates it exactly from the other tokens
+        sae = SparseAutoencoder(d_model=16, d_hidden=16, k=1)
+        with torch.no_grad():
+            sae.w_enc.copy_(torch.eye(16))
+            sae.b_enc.zero_()
+            sae.b_pre.zero_()
+        sae.LN = lambda x: (x, torch.zeros_like(x[..., :1]), torch.ones_like(x[..., :1]))
+
+        def make_tokens(n):
+            x = torch.rand(n, 16) - 1
+            # Dim 15 is positive in every token, but only kept by top-k when it is hot
+            x[:, 15] = 4 + 8 * torch.rand(n)
+            x[torch.arange(n), torch.randint(16, (n,))] = 25.3
+            return x
+
+        # The first batch's pre-activations are all below the later ones
+        first = torch.rand(1, 16) - 1
+        first[0, 0], first[0, 15] = 5.0, 4.0
+        thresholds = sae.calibrate_thresholds([first] + [make_tokens(50) for _ in range(10)])
+        self.assertEqual(thresholds.shape, (16,))
+        self.assertTrue(12 <= thresholds[15] < 25.3)
+
+        parity = sae.threshold_parity(make_tokens(200))
+        self.assertEqual(parity["recall"], 1.0)
+        self.assertEqual(parity["precision"], 1.0)
+
+    def test_approx_topk_full_rank_is_exact(self):
+        self.sae.build_approx_topk(rank=16, n_candidates=8)
+        self.assertAlmostEqual(self.sae.approx_topk_recall(self.x), 1.0, places=5)
+
+    def test_dead_latent_tracking(self):
+        sae = SparseAutoencoder(d_model=16, d_hidden=64, k=4, dead_tokens_threshold=5)
+        _, auxk, num_dead = sae(self.x)
+
+        # 10 tokens were seen, so hidden dims that never fired have been zero for 10 tokens
+        self.assertTrue(((sae.stats_last_nonzero == 0) | (sae.stats_last_nonzero == 10)).all())
+        self.assertEqual(num_dead.item(), (sae.stats_last_nonzero == 10).sum().item())
+        self.assertIsNotNone(auxk)
+        self.assertLessEqual(sae.firing_freq_ema.sum().item(), 0.01 * 4 + 1e-6)
+
+    def test_auxk_skipped_without_dead_latents(self):
+        sae = SparseAutoencoder(
+            d_model=16, d_hidden=64, k=4, dead_tokens_threshold=5, dead_check_interval=2
+        )
+        sae._tokens_seen_host = 100
+        # Only 2 tokens seen since any hidden dim fired, so none is dead
+        _, auxk, num_dead = sae(self.x[:, :1])
+        self.assertIsNone(auxk)
+        self.assertEqual(num_dead.item(), 0)
+
+        # Dead hidden dims are only noticed at the next check
+        sae.stats_last_nonzero.fill_(100)
+        _, auxk, num_dead = sae(self.x[:, :1])
+        self.assertIsNone(auxk)
+        self.assertGreater(num_dead.item(), 0)
+        _, auxk, _ = sae(self.x[:, :1])
+        self.assertIsNotNone(auxk)
+
+    def test_tokens_seen_is_restored(self):
+        sae = SparseAutoencoder(d_model=16, d_hidden=64, k=4, dead_tokens_threshold=5)
+        sae(self.x)
+        resumed = SparseAutoencoder(d_model=16, d_hidden=64, k=4, dead_tokens_threshold=5)
+        resumed.load_state_dict(sae.state_dict())
+
+        self.assertEqual(resumed.tokens_seen.item(), 10)
+        # auxk is computed right away instead of after another dead_tokens_threshold tokens
+        _, auxk, _ = resumed(self.x[:, :2])
+        self.assertIsNotNone(auxk)
+
+    def test_load_state_dict_without_firing_freq_ema(self):
+        state_dict = self.sae.state_dict()
+        del state_dict["firing_freq_ema"]
+        SparseAutoencoder(d_model=16, d_hidden=64, k=4).load_state_dict(state_dict)
+
+    def test_forward_multi_k(self):
+        results = self.sae.forward_multi_k(self.x, [2, 4])
+        torch.testing.assert_close(results[4][0], self.sae.forward_val(self.x))
+
+        self.sae.k = 2
+        torch.testing.assert_close(results[2][0], self.sae.forward_val(self.x))
+
+    def test_compact(self):
+        alive = torch.arange(64) % 2 == 0
+        with torch.no_grad():
+            self.sae.b_enc[~alive] = -1e4
+        compact = self.sae.compact(alive)
+
+        self.assertEqual(compact.d_hidden, 32)
+        torch.testing.assert_close(compact.get_acts(self.x), self.sae.get_acts(self.x))
+
+        indices, _, _, _ = compact.encode_sparse(self.x)
+        self.assertTrue(alive[compact.original_latent_ids(indices)].all())
+
+    def test_save_pretrained_round_trip(self):
+        alive = torch.arange(64) % 2 == 0
+        for sae in [self.sae, self.sae.compact(alive)]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "sae.safetensors")
+                sae.save_pretrained(path, layer=24, plm_name="facebook/esm2_t33_650M_UR50D")
+                loaded = SparseAutoencoder.from_pretrained(path)
+
+                self.assertEqual(loaded.layer, 24)
+                self.assertEqual(loaded.d_hidden_full, 64)
+                torch.testing.assert_close(loaded.get_acts(self.x), sae.get_acts(self.x))
+
+    def test_from_lightning_checkpoint(self):
+        checkpoint = {
+            "state_dict": {f"sae_model.{k}": v for k, v in self.sae.state_dict().items()},
+            "hyper_parameters": {"args": Namespace(k=4, layer_to_use=24)},
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "sae.ckpt")
+            torch.save(checkpoint, path)
+            loaded = SparseAutoencoder.from_checkpoint(path)
+
+        self.assertEqual((loaded.d_model, loaded.d_hidden, loaded.k), (16, 64, 4))
+        self.assertEqual(loaded.layer, 24)
+        torch.testing.assert_close(loaded.get_acts(self.x), self.sae.get_acts(self.x))
+
+
+class TestQuantizedSAE(unittest.TestCase):
+    def test_parity(self):
+        torch.manual_seed(0)
+        sae = SparseAutoencoder(d_model=16, d_hidden=64, k=4)
+        x = torch.randn(2, 50, 16)
+        for dtype in ["int8", "bfloat16"]:
+            quantized = QuantizedSAE(sae, dtype=dtype)
+            parity = quantized.parity(sae, x)
+            self.assertGreater(parity["index_overlap"], 0.75)
+            self.assertLess(parity["rel_act_error"], 0.1)
+            self.assertEqual(quantized.get_acts(x).shape, (2, 50, 64))
+
+
+class TestMultiSAE(unittest.TestCase):
+    def test_matches_individual_saes(self):
+        torch.manual_seed(0)
+        saes = {
+            "a": SparseAutoencoder(d_model=16, d_hidden=64, k=4),
+            "b": SparseAutoencoder(d_model=16, d_hidden=32, k=8),
+            "c": SparseAutoencoder(d_model=16, d_hidden=64, k=4),
+        }
+        with torch.no_grad():
+            for sae in saes.values():
+                sae.b_pre.normal_()
+                sae.b_enc.normal_()
+        # Compacted and thresholded SAEs report their latents by original hidden dim
+        alive = torch.zeros(64, dtype=torch.bool)
+        alive[::3] = True
+        saes["a"] = saes["a"].compact(alive)
+        saes["c"].thresholds = torch.rand(64)
+        saes["c"].use_thresholds = True
+        layers = {"a": 24, "b": 24, "c": 12}
+        layer_acts = {24: torch.randn(2, 5, 16), 12: torch.randn(2, 5, 16)}
+
+        multi_sae = MultiSAE(saes, layers)
+        multi_acts = multi_sae.get_acts(layer_acts)
+        for name, sae in saes.items():
+            torch.testing.assert_close(
+                multi_acts[name], sae.get_acts(layer_acts[layers[name]]), atol=1e-5, rtol=1e-4
+            )
+
+        indices, values = multi_sae.encode_sparse(layer_acts)["a"]
+        self.assertTrue(alive[indices].all())
+        torch.testing.assert_close(
+            multi_acts["a"].gather(-1, indices), values, atol=1e-5, rtol=1e-4
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
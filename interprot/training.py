@@ -4,7 +4,7 @@ import os
 
 import pytorch_lightning as pl
 import wandb
-from data_module import SequenceDataModule
+from data_module import ActivationStoreDataModule, SequenceDataModule
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
 from sae_module import SAELightningModule
@@ -12,15 +12,52 @@ from sae_module import SAELightningModule
 parser = argparse.ArgumentParser()
 
 parser.add_argument("--data-dir", type=str, default="data/uniref50_1M_1022.parquet")
+parser.add_argument(
+    "--activation-store",
+    type=str,
+    default=None,
+    help="Directory written by scripts/dump_activations.py to train on instead of running ESM",
+)
+parser.add_argument("--token-batch-size", type=int, default=4096)
+parser.add_argument(
+    "--shuffle-buffer-tokens",
+    type=int,
+    default=0,
+    help="If set, train on batches of --token-batch-size tokens drawn from a shuffle buffer "
+    "of this many tokens, e.g. 262144, instead of on whole sequences",
+)
 parser.add_argument("--esm2-weight", type=str, default="weights/esm2_t33_650M_UR50D.pt")
+parser.add_argument(
+    "--attn-implementation",
+    type=str,
+    default="esm",
+    choices=["esm", "sdpa"],
+    help="sdpa uses much less memory on long sequences, but its activations differ from the "
+    "esm package's by floating point error",
+)
 parser.add_argument("-l", "--layer-to_use", type=int, default=24)
 parser.add_argument("--d-model", type=int, default=1280)
 parser.add_argument("--d-hidden", type=int, default=16384)
 parser.add_argument("-b", "--batch-size", type=int, default=48)
+parser.add_argument(
+    "--train-max-tokens",
+    type=int,
+    default=None,
+    help="If set, batch training sequences of similar length, up to this many padded tokens "
+    "per batch, instead of --batch-size random sequences",
+)
+parser.add_argument("--val-max-tokens", type=int, default=16384)
+parser.add_argument(
+    "--streaming",
+    action="store_true",
+    help="Stream --data-dir in slices instead of loading it into memory",
+)
+parser.add_argument("--stream-slice-rows", type=int, default=65536)
 parser.add_argument("--lr", type=float, default=2e-4)
+parser.add_argument("--gradient-clip-val", type=float, default=1.0)
 parser.add_argument("--k", type=int, default=128)
 parser.add_argument("--auxk", type=int, default=256)
-parser.add_argument("--dead-steps-threshold", type=int, default=2000)
+parser.add_argument("--dead-tokens-threshold", type=int, default=10_000_000)
 parser.add_argument("-e", "--max-epochs", type=int, default=1)
 parser.add_argument("-d", "--num-devices", type=int, default=1)
 parser.add_argument("--model-suffix", type=str, default="")
@@ -48,7 +85,24 @@ wandb_logger = WandbLogger(
 model = SAELightningModule(args)
 wandb_logger.watch(model, log="all")
 
-data_module = SequenceDataModule(args.data_dir, args.batch_size, args.num_workers)
+if args.activation_store is not None:
+    data_module = ActivationStoreDataModule(
+        args.activation_store,
+        args.token_batch_size,
+        args.batch_size,
+        args.num_workers,
+        layer=args.layer_to_use,
+        d_model=args.d_model,
+    )
+else:
+    data_module = SequenceDataModule(
+        args.data_dir,
+        args.batch_size,
+        args.num_workers,
+        max_tokens=args.train_max_tokens,
+        streaming=args.streaming,
+        slice_rows=args.stream_slice_rows,
+    )
 checkpoint_callback = ModelCheckpoint(
     dirpath=os.path.join(args.output_dir, "checkpoints"),
     filename=sae_name + "-{step}-{avg_mse_loss:.2f}",
@@ -69,7 +123,11 @@ trainer = pl.Trainer(
     val_check_interval=100,
     limit_val_batches=10,
     callbacks=[checkpoint_callback],
-    gradient_clip_val=1.0,
+    # With a shuffle buffer the module clips gradients itself, see SAELightningModule
+    gradient_clip_val=None if args.shuffle_buffer_tokens else args.gradient_clip_val,
+    # LengthBucketBatchSampler shards the batches across devices itself, and
+    # SequenceDataModule shards the validation set
+    use_distributed_sampler=args.train_max_tokens is None,
 )
 
 trainer.fit(model, data_module)
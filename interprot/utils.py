@@ -1,4 +1,6 @@
-from typing import Optional
+import copy
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
 import numpy as np
 import polars as pl
@@ -6,6 +8,88 @@ import torch
 from scipy.sparse import csr_matrix
 from transformers import PreTrainedModel, PreTrainedTokenizer
 
+# The longest sequence, in residues, that ESM-2 was trained on. Longer sequences are run in
+# overlapping windows of at most this many residues, see get_windowed_layer_activations.
+ESM_MAX_RESIDUES = 1022
+
+WINDOW_BLEND_POLICIES = ("center", "linear", "mean")
+
+
+class _StopForward(Exception):
+    """
+    Raised by a forward hook to stop a pLM forward pass once every layer needed has been
+    captured.
+    """
+
+
+def _hidden_state_module(plm: PreTrainedModel, layer: int) -> torch.nn.Module:
+    """
+    The module of a HuggingFace ESM model whose output is hidden_states[layer] of
+    `plm(..., output_hidden_states=True)`.
+    """
+    base = plm.base_model
+    num_layers = len(base.encoder.layer)
+    if layer == 0:
+        return base.embeddings
+    if layer == num_layers:
+        # The last hidden state is taken after the final layer norm
+        return base.encoder.emb_layer_norm_after
+    if 0 < layer < num_layers:
+        return base.encoder.layer[layer - 1]
+    raise ValueError(f"layer must be between 0 and {num_layers}, got {layer}")
+
+
+def get_multi_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seqs: list[str],
+    layers: list[int],
+    device: Optional[torch.device] = None,
+) -> dict[int, torch.Tensor]:
+    """
+    Like get_layer_activations, for several layers in one forward pass. The activations
+    are captured with forward hooks, and the forward pass stops as soon as the deepest
+    requested layer has run, so later layers are never computed and only the requested
+    hidden states are kept.
+
+    Args:
+        tokenizer: The tokenizer to use.
+        plm: The pLM model to get the activations from.
+        seqs: The sequences to get the activations for.
+        layers: The layers to get the activations from.
+        device: The device to use. Defaults to the device of plm.
+
+    Returns:
+        The (N, L, D_MODEL) activations of each requested layer, by layer.
+    """
+    if device is None:
+        device = plm.device
+
+    layers = set(layers)
+    captured: dict[int, torch.Tensor] = {}
+
+    def make_hook(layer: int):
+        def hook(module, args, output):
+            captured[layer] = output[0] if isinstance(output, tuple) else output
+            if len(captured) == len(layers):
+                raise _StopForward
+
+        return hook
+
+    handles = [
+        _hidden_state_module(plm, layer).register_forward_hook(make_hook(layer)) for layer in layers
+    ]
+    inputs = tokenizer(seqs, padding=True, return_tensors="pt").to(device)
+    try:
+        with torch.no_grad():
+            plm(**inputs)
+    except _StopForward:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
+    return captured
+
 
 def get_layer_activations(
     tokenizer: PreTrainedTokenizer,
@@ -24,27 +108,348 @@ def get_layer_activations(
         https://github.com/facebookresearch/esm/tree/main?tab=readme-ov-file#available-models
     ```
 
-    The output tensor is of shape (N, L, D_MODEL)
+    The output tensor is of shape (N, L, D_MODEL). The forward pass stops at the
+    requested layer, see get_multi_layer_activations.
 
     Args:
         tokenizer: The tokenizer to use.
         plm: The pLM model to get the activations from.
         seqs: The sequences to get the activations for.
         layer: The layer to get the activations from.
-        device: The device to use.
+        device: The device to use. Defaults to the device of plm.
 
     Returns:
         The (N, L, D_MODEL) activations of the specified layer.
     """
-    if device is None:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return get_multi_layer_activations(tokenizer, plm, seqs, [layer], device)[layer]
 
-    inputs = tokenizer(seqs, padding=True, return_tensors="pt").to(device)
-    with torch.no_grad():
-        outputs = plm(**inputs, output_hidden_states=True)
-    layer_acts = outputs.hidden_states[layer]
-    del outputs
-    return layer_acts
+
+def bucket_by_length(lengths: list[int], max_tokens: int) -> list[list[int]]:
+    """
+    Group sequences into batches of similar length, so that little compute is spent on
+    padding. Each batch is padded to its longest sequence, and its padded size (number of
+    sequences * longest length) stays within max_tokens, except for a sequence longer than
+    max_tokens, which gets a batch of its own.
+
+    Args:
+        lengths: The length of each sequence, in tokens.
+        max_tokens: The maximum padded size of a batch.
+
+    Returns:
+        The indices of the sequences in each batch, shortest sequences first.
+    """
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_max_len = 0
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        max_len = max(batch_max_len, lengths[i])
+        if batch and max_len * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch, max_len = [], lengths[i]
+        batch.append(i)
+        batch_max_len = max_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def window_starts(length: int, window_size: int, overlap: int) -> list[int]:
+    """
+    Start positions of overlapping windows of window_size that cover a sequence of the
+    given length. Consecutive windows overlap by at least overlap positions, and the last
+    window ends at the end of the sequence.
+    """
+    if not 0 <= overlap < window_size:
+        raise ValueError("overlap must be non-negative and smaller than window_size")
+    if length <= window_size:
+        return [0]
+    starts = list(range(0, length - window_size + 1, window_size - overlap))
+    if starts[-1] + window_size < length:
+        starts.append(length - window_size)
+    return starts
+
+
+def stitch_windows(
+    windows: list[torch.Tensor],
+    starts: list[int],
+    length: int,
+    overlap: int,
+    blend: str = "center",
+) -> torch.Tensor:
+    """
+    Stitch per-position values computed on overlapping windows of a sequence, e.g. pLM
+    or SAE activations of each residue, back into values for the whole sequence.
+
+    Positions near the edge of a window see less context than in the full sequence, so
+    where windows overlap, the blend policy favors the window in which a position is
+    furthest from an edge (edges at the ends of the sequence don't count):
+    - "center": take the values from that window.
+    - "linear": average the windows, weighted by distance from the edge, capped at overlap.
+    - "mean": average the windows equally.
+
+    Args:
+        windows: The (WINDOW_LEN, D) values of each window.
+        starts: The start position of each window in the sequence.
+        length: The length of the sequence.
+        overlap: The overlap between windows, see window_starts.
+        blend: The blend policy.
+
+    Returns:
+        The (length, D) values of the whole sequence.
+    """
+    if blend not in WINDOW_BLEND_POLICIES:
+        raise ValueError(f"blend must be one of {WINDOW_BLEND_POLICIES}, got {blend}")
+
+    out = windows[0].new_zeros(length, windows[0].shape[-1])
+    # For "center", the distance from an edge of the window each position was taken from;
+    # otherwise, the sum of the weights of each position.
+    totals = windows[0].new_zeros(length, 1)
+    for values, start in zip(windows, starts):
+        n = len(values)
+        pos = torch.arange(n, device=values.device, dtype=values.dtype).unsqueeze(-1)
+        left = pos + 1 if start > 0 else torch.full_like(pos, torch.inf)
+        right = n - pos if start + n < length else torch.full_like(pos, torch.inf)
+        dist = torch.minimum(left, right)
+
+        if blend == "center":
+            better = dist > totals[start : start + n]
+            out[start : start + n] = torch.where(better, values, out[start : start + n])
+            totals[start : start + n] = torch.where(better, dist, totals[start : start + n])
+            continue
+
+        weight = dist.clamp(max=max(overlap, 1)) if blend == "linear" else torch.ones_like(dist)
+        out[start : start + n] += weight * values
+        totals[start : start + n] += weight
+
+    if blend == "center":
+        return out
+    return out / totals
+
+
+def get_windowed_multi_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seq: str,
+    layers: list[int],
+    window_size: int = ESM_MAX_RESIDUES,
+    overlap: int = 256,
+    blend: str = "center",
+    max_tokens: int = 16384,
+    device: Optional[torch.device] = None,
+) -> dict[int, torch.Tensor]:
+    """
+    Like get_multi_layer_activations for a single sequence of any length. Sequences longer
+    than window_size residues are run in overlapping windows, each with its own BOS and
+    EOS tokens, and the activations of the residues are stitched with stitch_windows.
+    Windows are batched under max_tokens. The activations of all windows are kept until
+    they are stitched, which takes about window_size / (window_size - overlap) times the
+    memory of the (len(seq) + 2, D_MODEL) output per layer.
+
+    Args:
+        tokenizer: The tokenizer to use.
+        plm: The pLM model to get the activations from.
+        seq: The sequence to get the activations for.
+        layers: The layers to get the activations from.
+        window_size: The maximum number of residues the pLM is run on at once.
+        overlap: The minimum overlap between windows, in residues.
+        blend: How to stitch overlapping windows, see stitch_windows.
+        max_tokens: The maximum padded size of a batch of windows, in tokens.
+        device: The device to use. Defaults to the device of plm.
+
+    Returns:
+        The (len(seq) + 2, D_MODEL) activations of each requested layer, by layer. BOS
+        comes from the first window and EOS from the last.
+    """
+    if len(seq) <= window_size:
+        layer_acts = get_multi_layer_activations(tokenizer, plm, [seq], layers, device)
+        return {layer: acts[0] for layer, acts in layer_acts.items()}
+
+    starts = window_starts(len(seq), window_size, overlap)
+    batch_size = max(1, max_tokens // (window_size + 2))
+    windows: dict[int, list[torch.Tensor]] = {layer: [] for layer in layers}
+    bos, eos = {}, {}
+    for i in range(0, len(starts), batch_size):
+        batch_seqs = [seq[start : start + window_size] for start in starts[i : i + batch_size]]
+        layer_acts = get_multi_layer_activations(tokenizer, plm, batch_seqs, layers, device)
+        for layer, acts in layer_acts.items():
+            if i == 0:
+                bos[layer] = acts[0, :1]
+            eos[layer] = acts[-1, -1:]
+            windows[layer].extend(acts[:, 1:-1].clone())
+    return {
+        layer: torch.cat(
+            [
+                bos[layer],
+                stitch_windows(windows[layer], starts, len(seq), overlap, blend),
+                eos[layer],
+            ]
+        )
+        for layer in layers
+    }
+
+
+def get_windowed_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seq: str,
+    layer: int,
+    window_size: int = ESM_MAX_RESIDUES,
+    overlap: int = 256,
+    blend: str = "center",
+    max_tokens: int = 16384,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """
+    The (len(seq) + 2, D_MODEL) activations of a layer for a single sequence of any
+    length, see get_windowed_multi_layer_activations.
+    """
+    return get_windowed_multi_layer_activations(
+        tokenizer, plm, seq, [layer], window_size, overlap, blend, max_tokens, device
+    )[layer]
+
+
+def iter_multi_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seqs: Iterable[str],
+    layers: list[int],
+    max_tokens: int = 16384,
+    chunk_size: int = 256,
+    max_residues: Optional[int] = ESM_MAX_RESIDUES,
+    overlap: int = 256,
+    blend: str = "center",
+    device: Optional[torch.device] = None,
+) -> Iterator[dict[int, torch.Tensor]]:
+    """
+    Get the activations of several layers in a pLM model for many sequences, with one
+    forward pass per batch, batching sequences of similar length together. Sequences are
+    read chunk_size at a time, and each chunk is split into batches with
+    bucket_by_length. Sequences longer than max_residues are run in overlapping windows
+    with get_windowed_multi_layer_activations.
+
+    Args:
+        tokenizer: The tokenizer to use.
+        plm: The pLM model to get the activations from.
+        seqs: The sequences to get the activations for.
+        layers: The layers to get the activations from.
+        max_tokens: The maximum padded size of a batch, in tokens.
+        chunk_size: The number of sequences to bucket together. The activations of a
+            whole chunk may be held in memory at once.
+        max_residues: The longest sequence to run in one piece, or None for no limit.
+        overlap: See get_windowed_multi_layer_activations.
+        blend: See get_windowed_multi_layer_activations.
+        device: The device to use. Defaults to the device of plm.
+
+    Yields:
+        The (len(seq) + 2, D_MODEL) activations of each requested layer, by layer, for
+        each sequence, in the order of seqs. These are views into the activations of its
+        batch.
+    """
+    seqs = iter(seqs)
+    while chunk := list(islice(seqs, chunk_size)):
+        chunk_acts: dict[int, dict[int, torch.Tensor]] = {}
+        next_idx = 0
+        is_long = [max_residues is not None and len(seq) > max_residues for seq in chunk]
+        short_ids = [i for i in range(len(chunk)) if not is_long[i]]
+        for i in range(len(chunk)):
+            if is_long[i]:
+                chunk_acts[i] = get_windowed_multi_layer_activations(
+                    tokenizer,
+                    plm,
+                    chunk[i],
+                    layers,
+                    window_size=max_residues,
+                    overlap=overlap,
+                    blend=blend,
+                    max_tokens=max_tokens,
+                    device=device,
+                )
+        for bucket in bucket_by_length([len(chunk[i]) + 2 for i in short_ids], max_tokens):
+            batch_ids = [short_ids[j] for j in bucket]
+            layer_acts = get_multi_layer_activations(
+                tokenizer=tokenizer,
+                plm=plm,
+                seqs=[chunk[i] for i in batch_ids],
+                layers=layers,
+                device=device,
+            )
+            for j, i in enumerate(batch_ids):
+                chunk_acts[i] = {
+                    layer: acts[j, : len(chunk[i]) + 2] for layer, acts in layer_acts.items()
+                }
+            # Yield as soon as possible, so memory is freed in input order
+            while next_idx in chunk_acts:
+                yield chunk_acts.pop(next_idx)
+                next_idx += 1
+        while next_idx in chunk_acts:
+            yield chunk_acts.pop(next_idx)
+            next_idx += 1
+
+
+def iter_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seqs: Iterable[str],
+    layer: int,
+    max_tokens: int = 16384,
+    chunk_size: int = 256,
+    max_residues: Optional[int] = ESM_MAX_RESIDUES,
+    overlap: int = 256,
+    blend: str = "center",
+    device: Optional[torch.device] = None,
+) -> Iterator[torch.Tensor]:
+    """
+    Like iter_multi_layer_activations for a single layer, yielding the (len(seq) + 2,
+    D_MODEL) activations of each sequence.
+    """
+    for layer_acts in iter_multi_layer_activations(
+        tokenizer,
+        plm,
+        seqs,
+        [layer],
+        max_tokens=max_tokens,
+        chunk_size=chunk_size,
+        max_residues=max_residues,
+        overlap=overlap,
+        blend=blend,
+        device=device,
+    ):
+        yield layer_acts[layer]
+
+
+def optimize_plm_for_cpu(
+    plm: PreTrainedModel,
+    quantize: bool = True,
+    num_threads: Optional[int] = None,
+    compile: bool = False,
+) -> PreTrainedModel:
+    """
+    CPU inference profile for a HuggingFace pLM. Check the effect on SAE latents with
+    scripts/cpu_plm_parity.py before relying on it.
+
+    Args:
+        plm: The pLM model. It is not modified: the optimizations are applied to a copy.
+        quantize: Whether to dynamically quantize the weights of all linear layers to
+            int8, with activations quantized on the fly.
+        num_threads: The number of threads torch uses for intra-op parallelism. Defaults to
+            torch's default, usually the number of physical cores.
+        compile: Whether to compile each encoder layer with torch.compile. The layers are
+            compiled separately, so the forward hooks of get_layer_activations still work.
+
+    Returns:
+        The optimized pLM model, on CPU and in eval mode.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    plm = copy.deepcopy(plm).cpu().eval()
+    if quantize:
+        torch.ao.quantization.quantize_dynamic(
+            plm, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    if compile:
+        for layer in plm.base_model.encoder.layer:
+            layer.forward = torch.compile(layer.forward, dynamic=True)
+    return plm
 
 
 def tensor_to_sparse_matrix(T):
@@ -29,12 +29,12 @@ def calc_diff_cross_entropy(seq, layer, esm2_model, sae_model):
     Returns:
         float: The difference in cross-entropy.
     """
-    tokens, esm_layer_acts = esm2_model.get_layer_activations(seq, layer)
-    recons, auxk, num_dead = sae_model(esm_layer_acts)
-    logits_recon = esm2_model.get_sequence(recons, layer)
-    logits_orig = esm2_model.get_sequence(esm_layer_acts, layer)
+    cache = esm2_model.get_prefix_cache(seq, layer)
+    recons = sae_model.forward_val(cache.acts)
+    # Run the original and reconstructed activations through the suffix in one batch
+    logits_orig, logits_recon = esm2_model.run_suffix(cache, torch.cat([cache.acts, recons]))
 
-    return diff_cross_entropy(logits_orig, logits_recon, tokens)
+    return diff_cross_entropy(logits_orig, logits_recon, cache.tokens)
 
 
 def calc_loss_recovered(seq, layer, esm2_model, sae_model):
@@ -51,16 +51,16 @@ def calc_loss_recovered(seq, layer, esm2_model, sae_model):
     Returns:
         float: The loss recovered.
     """
-    tokens, esm_layer_acts = esm2_model.get_layer_activations(seq, layer)
-    recons, auxk, num_dead = sae_model(esm_layer_acts)
-    logits_recon = esm2_model.get_sequence(recons, layer)
-    logits_orig = esm2_model.get_sequence(esm_layer_acts, layer)
-    
-    zeros_act = torch.zeros_like(esm_layer_acts)
-    logits_zeros = esm2_model.get_sequence(zeros_act, layer)
+    cache = esm2_model.get_prefix_cache(seq, layer)
+    recons = sae_model.forward_val(cache.acts)
+    zeros_act = torch.zeros_like(cache.acts)
+    # Run the original, reconstructed and zeroed activations through the suffix in one batch
+    logits_orig, logits_recon, logits_zeros = esm2_model.run_suffix(
+        cache, torch.cat([cache.acts, recons, zeros_act])
+    )
 
-    diff_CE = diff_cross_entropy(logits_orig, logits_recon, tokens)
-    diff_CE_zeros = diff_cross_entropy(logits_orig, logits_zeros, tokens)
+    diff_CE = diff_cross_entropy(logits_orig, logits_recon, cache.tokens)
+    diff_CE_zeros = diff_cross_entropy(logits_orig, logits_zeros, cache.tokens)
 
     return 1 - (diff_CE / diff_CE_zeros)
 